@@ -1,19 +1,41 @@
 import os
+import sys
 import json
 import zipfile
 import time
 import io
 import uuid
 import tempfile
+import shutil
 import hashlib
+import math
+import gzip
 import logging
+import logging.handlers
 import gc
 import threading
-import traceback
+import queue
+import copy
+import atexit
+import contextvars
+import select
+import socket
+import multiprocessing
+import mimetypes
+import importlib
+import importlib.util
 from datetime import datetime
-from flask import Flask, render_template, request, redirect, url_for, jsonify, send_file
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, Future, CancelledError, TimeoutError as FutureTimeoutError
+
+# Mark the start of module import so the startup import report can measure it
+_IMPORT_STARTED_AT = time.perf_counter()
+
+from flask import Flask, render_template, request, redirect, url_for, jsonify, send_file, abort, Response, g
 from werkzeug.utils import secure_filename
-from PIL import Image, ImageEnhance, ImageFilter, ImageDraw, ImageFont, ImageOps
+from werkzeug.security import safe_join
+from urllib.parse import quote as url_quote
+from PIL import Image, ImageChops, ImageEnhance, ImageFilter, ImageDraw, ImageFont, ImageOps, ImageSequence, GifImagePlugin
 import numpy as np
 from flask_wtf.csrf import CSRFProtect, generate_csrf
 from flask_limiter import Limiter
@@ -21,31 +43,188 @@ from flask_limiter.util import get_remote_address
 from flask_caching import Cache
 from flask_talisman import Talisman
 
+# --- Logging ---
+# Records are put on a queue by the thread that emits them and written by a
+# QueueListener thread, so log I/O never blocks a render. BRANDKIT_LOG_LEVEL
+# sets the level (DEBUG adds per-step render diagnostics, which cost nothing
+# otherwise) and BRANDKIT_LOG_FORMAT=json writes one JSON object per line.
+# Every record carries the correlation id of the request (or CLI job) it was
+# emitted for, including from render, warm-up and preview threads.
+
+LOG_LEVEL = os.environ.get('BRANDKIT_LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.environ.get('BRANDKIT_LOG_FORMAT', 'text').lower()
+correlation_id = contextvars.ContextVar('correlation_id', default='-')
+logger = logging.getLogger('brandkit')
+
+class CorrelationIdFilter(logging.Filter):
+    def filter(self, record):
+        record.correlation_id = correlation_id.get()
+        return True
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # Only merge the arguments here; formatting and tracebacks are left to the listener thread
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+class JsonLogFormatter(logging.Formatter):
+    """One JSON object per record, with the correlation id and any extra fields"""
+    RESERVED = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'asctime', 'correlation_id'}
+    
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'correlation_id': getattr(record, 'correlation_id', '-'),
+            'message': record.getMessage(),
+        }
+        entry.update((k, v) for k, v in vars(record).items() if k not in self.RESERVED)
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+def configure_logging():
+    """Route all logging through a queue to a stderr handler on a listener thread"""
+    handler = logging.StreamHandler()
+    if LOG_FORMAT == 'json':
+        handler.setFormatter(JsonLogFormatter())
+    else:
+        handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - [%(correlation_id)s] %(message)s'))
+    log_queue = queue.SimpleQueue()
+    queue_handler = LogQueueHandler(log_queue)
+    queue_handler.addFilter(CorrelationIdFilter())
+    level = logging.getLevelName(LOG_LEVEL)
+    if not isinstance(level, int):
+        level = logging.INFO
+    root = logging.getLogger()
+    root.handlers[:] = [queue_handler]
+    # Debug output is only wanted from the app, not from Pillow and other libraries
+    root.setLevel(max(level, logging.INFO))
+    logger.setLevel(level)
+    listener = logging.handlers.QueueListener(log_queue, handler)
+    listener.start()
+    
+    def restart_in_child():
+        # A forked worker (e.g. gunicorn --preload) needs its own listener thread
+        listener._thread = None
+        listener.start()
+    os.register_at_fork(after_in_child=restart_in_child)
+    return listener
+
+_log_listener = configure_logging()
+
+def stop_logging():
+    """Write out queued log records and stop the listener thread; safe to call twice"""
+    if _log_listener._thread is not None:
+        _log_listener.stop()
+
+atexit.register(stop_logging)
+
+# --- End Logging ---
+
 # Import psutil if available for memory monitoring
 try:
     import psutil
     PSUTIL_AVAILABLE = True
 except ImportError:
     PSUTIL_AVAILABLE = False
-    print("Warning: psutil not available. Memory monitoring disabled.")
+    logger.warning("Warning: psutil not available. Memory monitoring disabled.")
 
-# Import additional libraries for background removal
-try:
-    from rembg import remove, new_session
-    REMBG_AVAILABLE = True
-    print("Background removal (rembg) is available")
-except ImportError:
-    REMBG_AVAILABLE = False
-    print("Background removal (rembg) not available. Install with: pip install rembg")
+# --- Optional Heavy Dependencies (loaded lazily) ---
+# rembg pulls in onnxruntime, scikit-image, scipy, pymatting and numba, and cv2
+# is a large native extension. Only probe for them here; the modules themselves
+# are imported on first use by _load_rembg() / _load_cv2().
 
-# Import cv2 for advanced image processing if available
-try:
-    import cv2
-    CV2_AVAILABLE = True
-    print("OpenCV (cv2) is available for advanced processing")
-except ImportError:
-    CV2_AVAILABLE = False
-    print("OpenCV not available. Some advanced features may be limited.")
+def _module_available(name):
+    """Check whether a module can be imported without actually importing it"""
+    try:
+        return importlib.util.find_spec(name) is not None
+    except (ImportError, ValueError):
+        return False
+
+REMBG_AVAILABLE = _module_available('rembg')
+if REMBG_AVAILABLE:
+    logger.info("Background removal (rembg) is available (loaded on first use)")
+else:
+    logger.info("Background removal (rembg) not available. Install with: pip install rembg")
+
+CV2_AVAILABLE = _module_available('cv2')
+if CV2_AVAILABLE:
+    logger.info("OpenCV (cv2) is available for advanced processing (loaded on first use)")
+else:
+    logger.info("OpenCV not available. Some advanced features may be limited.")
+
+# Modules that are expensive to import and should not be loaded at startup
+HEAVY_MODULES = ['rembg', 'onnxruntime', 'cv2', 'scipy', 'skimage', 'pymatting', 'numba']
+
+_lazy_import_lock = threading.Lock()
+_rembg_module = None
+_cv2_module = None
+_rembg_sessions = {}
+# Loading a model takes seconds; it must not hold up the other lazy imports
+_rembg_session_lock = threading.Lock()
+
+def _load_rembg():
+    """Import rembg on first use and return the module (None if unavailable)"""
+    global _rembg_module, REMBG_AVAILABLE
+    if _rembg_module is not None or not REMBG_AVAILABLE:
+        return _rembg_module
+    with _lazy_import_lock:
+        if _rembg_module is None:
+            started = time.perf_counter()
+            try:
+                _rembg_module = importlib.import_module('rembg')
+                logger.info(f"Loaded rembg in {(time.perf_counter() - started) * 1000:.0f} ms")
+            except Exception as e:
+                # find_spec succeeded but the import itself failed (e.g. broken onnxruntime)
+                REMBG_AVAILABLE = False
+                logger.error(f"Failed to import rembg: {e}")
+    return _rembg_module
+
+def _load_cv2():
+    """Import cv2 on first use and return the module (None if unavailable)"""
+    global _cv2_module, CV2_AVAILABLE
+    if _cv2_module is not None or not CV2_AVAILABLE:
+        return _cv2_module
+    with _lazy_import_lock:
+        if _cv2_module is None:
+            started = time.perf_counter()
+            try:
+                _cv2_module = importlib.import_module('cv2')
+                logger.info(f"Loaded cv2 in {(time.perf_counter() - started) * 1000:.0f} ms")
+            except Exception as e:
+                CV2_AVAILABLE = False
+                logger.error(f"Failed to import cv2: {e}")
+    return _cv2_module
+
+def get_rembg_session(model_name):
+    """Return a cached rembg session for the given model, creating it on first use"""
+    session = _rembg_sessions.get(model_name)
+    if session is not None:
+        return session
+    rembg = _load_rembg()
+    if rembg is None:
+        return None
+    with _rembg_session_lock:
+        session = _rembg_sessions.get(model_name)
+        if session is None:
+            session = rembg.new_session(model_name)
+            _rembg_sessions[model_name] = session
+    return session
+
+def import_report():
+    """Report which heavy modules are loaded and how long module import took"""
+    return {
+        'import_ms': round((_IMPORT_FINISHED_AT - _IMPORT_STARTED_AT) * 1000, 1),
+        'heavy_modules_loaded': [name for name in HEAVY_MODULES if name in sys.modules],
+        'rembg_available': REMBG_AVAILABLE,
+        'cv2_available': CV2_AVAILABLE,
+    }
+
+# --- End Optional Heavy Dependencies ---
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.urandom(24)
@@ -64,24 +243,68 @@ cache = Cache(app, config={'CACHE_TYPE': 'SimpleCache'})
 Talisman(app, content_security_policy={
     'default-src': "'self'",
     'img-src': "'self' data: blob:",
-    'script-src': "'self' 'unsafe-inline' 'unsafe-eval' https://cdn.tailwindcss.com/ https://cdn.jsdelivr.net/",
+    # Alpine's CSP build never compiles expressions with new Function, so no 'unsafe-eval'
+    'script-src': "'self' 'unsafe-inline'",
     'style-src': "'self' 'unsafe-inline'"
 }, force_https=False)
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
+# Correlation ids: a well-formed client X-Request-ID or a new id, echoed in the response
+@app.before_request
+def assign_correlation_id():
+    supplied = request.headers.get('X-Request-ID', '')
+    valid = 0 < len(supplied) <= 64 and all(c.isalnum() or c in '-_.' for c in supplied)
+    correlation_id.set(supplied if valid else uuid.uuid4().hex[:16])
+
+@app.after_request
+def echo_correlation_id(response):
+    response.headers['X-Request-ID'] = correlation_id.get()
+    return response
+
+@app.teardown_request
+def clear_correlation_id(exc=None):
+    correlation_id.set('-')
 
 # --- Configuration Loading with Environment Variable Overrides ---
+def env_int(name, default):
+    """Read an integer environment variable, falling back to default if unset or invalid"""
+    try:
+        return int(os.environ.get(name, default))
+    except ValueError:
+        return default
+
 DEFAULT_MAX_UPLOAD_MB = 16
-try:
-    max_upload_mb = int(os.environ.get('BRANDKIT_MAX_UPLOAD_MB', DEFAULT_MAX_UPLOAD_MB))
-except ValueError:
-    max_upload_mb = DEFAULT_MAX_UPLOAD_MB
+max_upload_mb = env_int('BRANDKIT_MAX_UPLOAD_MB', DEFAULT_MAX_UPLOAD_MB)
 app.config['MAX_CONTENT_LENGTH'] = max_upload_mb * 1024 * 1024
 
+# Background removal runs segmentation on a proxy no larger than this (0 = full resolution)
+BG_PROXY_SIZE = env_int('BRANDKIT_BG_PROXY_SIZE', 1024)
+
+# Maximum render time per request in seconds; requests may ask for less (0 = no limit)
+RENDER_DEADLINE_S = env_int('BRANDKIT_RENDER_DEADLINE_S', 120)
+
+# Background removal runs in a worker process that is killed after this many seconds
+# (0 = run rembg in-process without a timeout)
+BG_REMOVAL_TIMEOUT_S = env_int('BRANDKIT_BG_REMOVAL_TIMEOUT_S', 60)
+
+# Segmentation requests arriving within this many milliseconds of each other are
+# run as one batched inference per model, up to this many images (1 = no batching)
+BG_BATCH_WINDOW_MS = env_int('BRANDKIT_BG_BATCH_WINDOW_MS', 10)
+BG_BATCH_SIZE = env_int('BRANDKIT_BG_BATCH_SIZE', 8)
+
+# Admission control (per worker process): concurrent render work in work units
+# (one unit is roughly 25 ms of CPU), memory budget for concurrent renders, queue
+# limits, and the per-client upload budget in work units per minute
+ADMISSION_CAPACITY = env_int('BRANDKIT_ADMISSION_CAPACITY', 8000)
+ADMISSION_MEMORY_MB = env_int('BRANDKIT_ADMISSION_MEMORY_MB', 1536)
+ADMISSION_MAX_QUEUE = env_int('BRANDKIT_ADMISSION_MAX_QUEUE', 16)
+ADMISSION_QUEUE_TIMEOUT_S = env_int('BRANDKIT_ADMISSION_QUEUE_TIMEOUT_S', 30)
+UPLOAD_WORK_PER_MINUTE = env_int('BRANDKIT_UPLOAD_WORK_PER_MINUTE', 2400)
+
+# Chunked uploads: chunk size, largest source accepted, and where chunks are assembled
+CHUNK_SIZE_MB = env_int('BRANDKIT_CHUNK_SIZE_MB', 4)
+MAX_CHUNKED_UPLOAD_MB = env_int('BRANDKIT_MAX_CHUNKED_UPLOAD_MB', 200)
+CHUNK_UPLOAD_DIR = os.environ.get('BRANDKIT_CHUNK_DIR', os.path.join(tempfile.gettempdir(), 'brandkit-chunks'))
+
 DEFAULT_CONFIG = {
     "formats": {
         "website": {"width": 1200, "height": 630, "description": "Open Graph, Twitter Cards"},
@@ -117,8 +340,8 @@ DEFAULT_CONFIG = {
         "product_wide": {"width": 1200, "height": 800, "description": "Product Image Wide"},
         
         # Print-ready
-        "print_a4": {"width": 2480, "height": 3508, "description": "A4 Print Ready (300 DPI)"},
-        "print_letter": {"width": 2550, "height": 3300, "description": "Letter Print Ready (300 DPI)"}
+        "print_a4": {"width": 2480, "height": 3508, "description": "A4 Print Ready (300 DPI)", "full_resolution_upload": True},
+        "print_letter": {"width": 2550, "height": 3300, "description": "Letter Print Ready (300 DPI)", "full_resolution_upload": True}
     },
     "format_categories": {
         "Social Media": ["social", "instagram", "instagram_story", "facebook", "twitter", "linkedin", "youtube_thumbnail"],
@@ -128,7 +351,10 @@ DEFAULT_CONFIG = {
         "E-commerce": ["product_square", "product_wide", "square_1024"],
         "Print": ["print_a4", "print_letter", "poster", "business_card"]
     },
-    "output_formats": ["png", "jpg", "webp", "ico"],
+    "output_formats": ["png", "jpg", "webp", "gif", "ico"],
+    "kernel_backend": "auto",
+    "palette_png": True,
+    "palette_min_psnr": 40,
     "preprocessing_options": {
         "grayscale": False,
         "bw": False,
@@ -158,11 +384,14 @@ DEFAULT_CONFIG = {
     }
 }
 
+# Format configuration file, relative to the working directory unless absolute
+CONFIG_PATH = os.environ.get('BRANDKIT_CONFIG', 'config.json')
+
 def load_config():
     """Load configuration with proper deep merging of dictionaries"""
     config = DEFAULT_CONFIG.copy()
     try:
-        with open('config.json', 'r') as f:
+        with open(CONFIG_PATH, 'r') as f:
             file_config = json.load(f)
             # Deep merge the dictionaries
             for key, value in file_config.items():
@@ -173,51 +402,626 @@ def load_config():
                     # Replace or add non-dict values
                     config[key] = value
     except FileNotFoundError:
-        print("Warning: config.json not found. Using default configuration.")
+        logger.warning(f"Warning: {CONFIG_PATH} not found. Using default configuration.")
     except json.JSONDecodeError:
-        print("Error: config.json is not valid JSON. Using default configuration.")
+        logger.error(f"Error: {CONFIG_PATH} is not valid JSON. Using default configuration.")
     return config
 
 # --- End Configuration Loading ---
 
-os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+# --- Output Storage ---
+# Generated assets, render cache entries and ZIPs are written through a storage
+# backend selected with BRANDKIT_STORAGE:
+#   local  - files under BRANDKIT_STORAGE_DIR (default: the uploads folder); point
+#            it at a tmpfs mount and set BRANDKIT_STORAGE_MAX_MB to keep outputs in RAM
+#   memory - in-process RAM with a byte budget, least recently used entries evicted
+#   s3     - an S3-compatible bucket (requires boto3), shared by workers on all nodes
+# Keys are relative names such as "<id>_logo_website.png" or "cache/<key>_WxH.png".
+#
+# Every asset is served from /outputs/<key>?v=<content hash>. The hash doubles as
+# a strong ETag; responses support If-None-Match and Range, and URLs whose hash
+# matches the current bytes are cached as immutable. Keys such as
+# "logo_website.png" are reused by later uploads, so the hash is what makes a
+# URL safe to cache forever.
+#
+# With BRANDKIT_SENDFILE, local assets and ZIPs are served through /outputs/ and
+# the response only carries a header telling the fronting proxy which file to send:
+#   x-accel-redirect - nginx; BRANDKIT_SENDFILE_PREFIX is an internal location
+#                      aliasing the storage directory (see nginx.conf.example)
+#   x-sendfile       - Apache mod_xsendfile / lighttpd; the absolute file path
+# The worker is free again as soon as the request is authorized.
+
+STORAGE_BACKEND = os.environ.get('BRANDKIT_STORAGE', 'local').lower()
+STORAGE_DIR = os.environ.get('BRANDKIT_STORAGE_DIR', app.config['UPLOAD_FOLDER'])
+STORAGE_MAX_MB = env_int('BRANDKIT_STORAGE_MAX_MB', 0)
+SENDFILE_MODE = os.environ.get('BRANDKIT_SENDFILE', '').lower()
+SENDFILE_PREFIX = os.environ.get('BRANDKIT_SENDFILE_PREFIX', '/protected-outputs/')
+if SENDFILE_MODE not in ('', 'x-accel-redirect', 'x-sendfile'):
+    logger.warning(f"Unknown sendfile mode '{SENDFILE_MODE}', serving files from Python")
+    SENDFILE_MODE = ''
+# Werkzeug's send_file sets X-Sendfile itself
+app.config['USE_X_SENDFILE'] = SENDFILE_MODE == 'x-sendfile'
+# Content hashes remembered per worker for local files
+DIGEST_CACHE_SIZE = 4096
+# File extension -> Pillow format for encoding images straight to storage
+IMAGE_SAVE_FORMATS = {'png': 'PNG', 'jpg': 'JPEG', 'jpeg': 'JPEG', 'webp': 'WEBP', 'ico': 'ICO', 'gif': 'GIF'}
+
+def is_valid_storage_key(key):
+    """Whether a key is a relative name without parent directory components"""
+    return bool(key) and safe_join('storage', key) is not None
+
+class LocalStorage:
+    """Files in a local directory, with an optional byte budget"""
+    name = 'local'
+    
+    def __init__(self, root, max_bytes=0):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._digests = {}
+        os.makedirs(root, exist_ok=True)
+        self._used_bytes = sum(size for _, size, _ in self.list()) if max_bytes else 0
+    
+    def local_path(self, key):
+        return safe_join(self.root, key)
+    
+    def put(self, key, data):
+        path = self.local_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write to a temporary name so readers never see a partial file
+        temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, path)
+        self._account(len(data), keep=key)
+    
+    def get(self, key):
+        try:
+            with open(self.local_path(key), 'rb') as f:
+                return f.read()
+        except (FileNotFoundError, IsADirectoryError):
+            return None
+    
+    def stat(self, key):
+        """Return (size, mtime) of a stored key, or None"""
+        try:
+            st = os.stat(self.local_path(key))
+            return st.st_size, st.st_mtime
+        except FileNotFoundError:
+            return None
+    
+    def digest(self, key):
+        """Hex content hash of a stored key, or None; rehashed only when the file changes"""
+        path = self.local_path(key)
+        try:
+            st = os.stat(path)
+            version = (st.st_ino, st.st_size, st.st_mtime_ns)
+            cached = self._digests.get(key)
+            if cached and cached[0] == version:
+                return cached[1]
+            hasher = hashlib.blake2b(digest_size=16)
+            with open(path, 'rb') as f:
+                for block in iter(lambda: f.read(1024 * 1024), b''):
+                    hasher.update(block)
+        except (FileNotFoundError, IsADirectoryError):
+            return None
+        with self._lock:
+            self._digests[key] = (version, hasher.hexdigest())
+            while len(self._digests) > DIGEST_CACHE_SIZE:
+                self._digests.pop(next(iter(self._digests)))
+        return hasher.hexdigest()
+    
+    def delete(self, key):
+        try:
+            size = os.path.getsize(self.local_path(key))
+            os.remove(self.local_path(key))
+            with self._lock:
+                self._used_bytes -= size
+        except FileNotFoundError:
+            pass
+    
+    def link(self, source_key, key):
+        """Store key with the same bytes as source_key (hardlinked when possible)"""
+        source_path, target_path = self.local_path(source_key), self.local_path(key)
+        if os.path.exists(target_path):
+            os.remove(target_path)
+        try:
+            os.link(source_path, target_path)
+        except OSError:
+            shutil.copyfile(source_path, target_path)
+            self._account(os.path.getsize(target_path), keep=key)
+    
+    def list(self, prefix=''):
+        """Yield (key, size, mtime) for every stored key starting with prefix"""
+        for dirpath, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                key = os.path.relpath(path, self.root).replace(os.sep, '/')
+                if key.startswith(prefix) and not key.endswith('.tmp'):
+                    try:
+                        st = os.stat(path)
+                    except FileNotFoundError:
+                        continue
+                    yield key, st.st_size, st.st_mtime
+    
+    def url(self, key):
+        return f"/outputs/{key}"
+    
+    def _account(self, size, keep=None):
+        if not self.max_bytes:
+            return
+        with self._lock:
+            self._used_bytes += size
+            over_budget = self._used_bytes > self.max_bytes
+        if over_budget:
+            # Other workers may share the directory, so recount before evicting
+            entries = sorted(self.list(), key=lambda entry: entry[2])
+            used = sum(entry[1] for entry in entries)
+            for entry_key, size, _ in entries:
+                if used <= self.max_bytes:
+                    break
+                if entry_key == keep or entry_key == 'README.md':
+                    continue
+                try:
+                    os.remove(self.local_path(entry_key))
+                    used -= size
+                except FileNotFoundError:
+                    pass
+            with self._lock:
+                self._used_bytes = used
+
+class MemoryStorage:
+    """In-process RAM with a byte budget; least recently used keys are evicted first"""
+    name = 'memory'
+    
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._entries = {}
+        self._used_bytes = 0
+        self._lock = threading.Lock()
+    
+    def local_path(self, key):
+        return None
+    
+    def put(self, key, data):
+        data = bytes(data)
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = (data, time.time(), hashlib.blake2b(data, digest_size=16).hexdigest())
+            self._used_bytes += len(data)
+            # Evict in insertion (least recently used) order, never the new key
+            for old_key in list(self._entries):
+                if self._used_bytes <= self.max_bytes:
+                    break
+                if old_key != key:
+                    self._remove(old_key)
+    
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+            self._entries[key] = entry
+            return entry[0]
+    
+    def stat(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+        return (len(entry[0]), entry[1]) if entry else None
+    
+    def digest(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+        return entry[2] if entry else None
+    
+    def delete(self, key):
+        with self._lock:
+            self._remove(key)
+    
+    def link(self, source_key, key):
+        data = self.get(source_key)
+        if data is not None:
+            self.put(key, data)
+    
+    def list(self, prefix=''):
+        with self._lock:
+            entries = [(key, len(data), mtime) for key, (data, mtime, _) in self._entries.items() if key.startswith(prefix)]
+        return iter(entries)
+    
+    def url(self, key):
+        return f"/outputs/{key}"
+    
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._used_bytes -= len(entry[0])
+
+class S3Storage:
+    """Objects in an S3-compatible bucket (AWS, MinIO, moto...), shared between nodes"""
+    name = 's3'
+    
+    def __init__(self, bucket, prefix='', endpoint_url=None, region=None):
+        import boto3
+        from botocore.exceptions import ClientError
+        self.client = boto3.client('s3', endpoint_url=endpoint_url or None, region_name=region or None)
+        self.bucket = bucket
+        self.prefix = prefix
+        self.ClientError = ClientError
+    
+    def _missing(self, error):
+        return error.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound')
+    
+    def local_path(self, key):
+        return None
+    
+    def put(self, key, data):
+        self.client.put_object(
+            Bucket=self.bucket,
+            Key=self.prefix + key,
+            Body=bytes(data),
+            ContentType=mimetypes.guess_type(key)[0] or 'application/octet-stream',
+        )
+    
+    def get(self, key):
+        try:
+            return self.client.get_object(Bucket=self.bucket, Key=self.prefix + key)['Body'].read()
+        except self.ClientError as e:
+            if self._missing(e):
+                return None
+            raise
+    
+    def stat(self, key):
+        try:
+            head = self.client.head_object(Bucket=self.bucket, Key=self.prefix + key)
+        except self.ClientError as e:
+            if self._missing(e):
+                return None
+            raise
+        return head['ContentLength'], head['LastModified'].timestamp()
+    
+    def digest(self, key):
+        # The object ETag (MD5 for single-part uploads) changes with the bytes
+        try:
+            return self.client.head_object(Bucket=self.bucket, Key=self.prefix + key)['ETag'].strip('"')
+        except self.ClientError as e:
+            if self._missing(e):
+                return None
+            raise
+    
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=self.prefix + key)
+    
+    def link(self, source_key, key):
+        # Server-side copy; the bytes never pass through the worker
+        self.client.copy_object(
+            Bucket=self.bucket,
+            Key=self.prefix + key,
+            CopySource={'Bucket': self.bucket, 'Key': self.prefix + source_key},
+        )
+    
+    def list(self, prefix=''):
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.prefix + prefix):
+            for obj in page.get('Contents', []):
+                yield obj['Key'][len(self.prefix):], obj['Size'], obj['LastModified'].timestamp()
+    
+    def url(self, key):
+        return f"/outputs/{key}"
+
+def create_storage():
+    """Create the storage backend configured through the environment"""
+    if STORAGE_BACKEND == 'memory':
+        return MemoryStorage((STORAGE_MAX_MB or 512) * 1024 * 1024)
+    if STORAGE_BACKEND == 's3':
+        bucket = os.environ.get('BRANDKIT_S3_BUCKET')
+        if not bucket:
+            logger.warning("BRANDKIT_STORAGE=s3 requires BRANDKIT_S3_BUCKET, using local storage")
+        elif not _module_available('boto3'):
+            logger.warning("S3 storage requires boto3. Install with: pip install -r requirements-s3.txt. Using local storage")
+        else:
+            return S3Storage(
+                bucket,
+                prefix=os.environ.get('BRANDKIT_S3_PREFIX', ''),
+                endpoint_url=os.environ.get('BRANDKIT_S3_ENDPOINT_URL'),
+                region=os.environ.get('BRANDKIT_S3_REGION'),
+            )
+    elif STORAGE_BACKEND != 'local':
+        logger.warning(f"Unknown storage backend '{STORAGE_BACKEND}', using local storage")
+    return LocalStorage(STORAGE_DIR, max_bytes=STORAGE_MAX_MB * 1024 * 1024)
+
+storage = create_storage()
+logger.info(f"Using {storage.name} output storage")
+
+def output_entry(key):
+    """Result entry for a stored asset: its key, content-hashed URL and (for local storage) file path"""
+    digest = storage.digest(key)
+    entry = {'key': key, 'url': f"{storage.url(key)}?v={digest[:16]}" if digest else storage.url(key)}
+    local_path = storage.local_path(key)
+    if local_path:
+        entry['path'] = local_path
+    return entry
+
+def encode_for_key(img, key, **save_opts):
+    """Encode an image in the format given by the key's extension"""
+    extension = key.rsplit('.', 1)[-1].lower()
+    return encode_image_bytes(img, {'format': IMAGE_SAVE_FORMATS.get(extension, extension.upper()), **save_opts})
+
+def save_image_to_storage(img, key, **save_opts):
+    """Encode an image in the format given by the key's extension and store it; returns its size"""
+    data = encode_for_key(img, key, **save_opts)
+    storage.put(key, data)
+    return len(data)
+
+def send_stored(key, as_attachment=False):
+    """Conditional, range-capable response for a stored asset, or None if it does not exist.
+    
+    The content hash is the strong ETag. A "v" query argument matching it marks
+    the URL as content-addressed, which may be cached as immutable.
+    """
+    digest = storage.digest(key)
+    if digest is None:
+        return None
+    local_path = storage.local_path(key)
+    if local_path and SENDFILE_MODE == 'x-accel-redirect':
+        # nginx streams the file (and serves ranges) from its internal location
+        response = Response(mimetype=mimetypes.guess_type(key)[0] or 'application/octet-stream')
+        response.headers['X-Accel-Redirect'] = SENDFILE_PREFIX.rstrip('/') + '/' + url_quote(key)
+        if as_attachment:
+            response.headers.set('Content-Disposition', 'attachment', filename=os.path.basename(key))
+        response.set_etag(digest)
+    elif local_path:
+        response = send_file(local_path, as_attachment=as_attachment, etag=digest, conditional=True)
+    else:
+        data = storage.get(key)
+        if data is None:
+            return None
+        response = send_file(
+            io.BytesIO(data),
+            mimetype=mimetypes.guess_type(key)[0] or 'application/octet-stream',
+            as_attachment=as_attachment,
+            download_name=os.path.basename(key),
+            etag=digest,
+            conditional=True,
+        )
+    
+    if request.args.get('v') == digest[:16]:
+        response.cache_control.no_cache = None
+        response.cache_control.public = True
+        response.cache_control.max_age = 31536000
+        response.cache_control.immutable = True
+    else:
+        # Unversioned (or stale) URLs may change; revalidate with the ETag
+        response.cache_control.no_cache = True
+    if SENDFILE_MODE == 'x-accel-redirect' and local_path:
+        response = response.make_conditional(request)
+        if response.status_code == 304:
+            # Answered here; nginx has nothing to send
+            del response.headers['X-Accel-Redirect']
+    return response
+
+# --- End Output Storage ---
 
 def allowed_file(filename):
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in app.config['ALLOWED_EXTENSIONS']
 
-def preprocess_image(image, options):
+# --- Image Kernel Backends ---
+# Resampling and filter kernels go through a backend so they can run on OpenCV
+# when it is installed. Select with "kernel_backend" in config.json:
+# "pillow", "opencv" or "auto" (OpenCV if available, otherwise Pillow).
+
+def thumbnail_size(image_size, max_size):
+    """Compute the size Image.thumbnail() would produce (None if no resize is needed)"""
+    def round_aspect(number, key):
+        return max(min(math.floor(number), math.ceil(number), key=key), 1)
+    
+    width, height = image_size
+    x, y = (math.floor(v) for v in max_size)
+    if x >= width and y >= height:
+        return None
+    
+    aspect = width / height
+    if x / y >= aspect:
+        x = round_aspect(y * aspect, key=lambda n: abs(aspect - n / y))
+    else:
+        y = round_aspect(x / aspect, key=lambda n: 0 if n == 0 else abs(aspect - x / n))
+    return x, y
+
+class PillowKernels:
+    """Reference kernel implementations using Pillow"""
+    name = 'pillow'
+    
+    def thumbnail(self, image, max_size):
+        """Return a copy of image downscaled to fit max_size, keeping aspect ratio"""
+        result = image.copy()
+        result.thumbnail(max_size, Image.LANCZOS)
+        return result
+    
+    def median_filter(self, image, size):
+        return image.filter(ImageFilter.MedianFilter(size=size))
+    
+    def gaussian_blur(self, image, radius):
+        return image.filter(ImageFilter.GaussianBlur(radius=radius))
+    
+    def unsharp_mask(self, image, radius, percent=150, threshold=3):
+        return image.filter(ImageFilter.UnsharpMask(radius=radius, percent=percent, threshold=threshold))
+    
+    def box_filter(self, arr, radius):
+        """Mean of a float32 array over a (2*radius+1)^2 window, replicating edges"""
+        size = 2 * radius + 1
+        padded = np.pad(arr, radius, mode='edge')
+        # Cumulative sums with a leading zero row/column give each window sum in O(1)
+        c = np.cumsum(padded, axis=0)
+        c = np.concatenate([np.zeros((1, c.shape[1]), c.dtype), c], axis=0)
+        c = c[size:] - c[:-size]
+        c = np.cumsum(c, axis=1)
+        c = np.concatenate([np.zeros((c.shape[0], 1), c.dtype), c], axis=1)
+        c = c[:, size:] - c[:, :-size]
+        return c / (size * size)
+
+class OpenCVKernels(PillowKernels):
+    """OpenCV kernel implementations, falling back to Pillow for unsupported modes"""
+    name = 'opencv'
+    SUPPORTED_MODES = ('L', 'RGB', 'RGBA')
+    
+    def __init__(self, cv2):
+        self.cv2 = cv2
+    
+    def _to_array(self, image):
+        return np.asarray(image)
+    
+    def _from_array(self, arr, mode):
+        return Image.frombytes(mode, (arr.shape[1], arr.shape[0]), np.ascontiguousarray(arr).tobytes())
+    
+    def thumbnail(self, image, max_size):
+        if image.mode not in self.SUPPORTED_MODES:
+            return super().thumbnail(image, max_size)
+        target_size = thumbnail_size(image.size, max_size)
+        if target_size is None:
+            return image.copy()
+        # INTER_AREA is the right filter for downscaling; thumbnail never upscales
+        interpolation = self.cv2.INTER_AREA if target_size[0] < image.width else self.cv2.INTER_LANCZOS4
+        if image.mode == 'RGBA':
+            # Resample premultiplied alpha like Pillow does to avoid dark fringes
+            arr = self._to_array(image.convert('RGBa'))
+            resized = self.cv2.resize(arr, target_size, interpolation=interpolation)
+            return self._from_array(resized, 'RGBa').convert('RGBA')
+        resized = self.cv2.resize(self._to_array(image), target_size, interpolation=interpolation)
+        return self._from_array(resized, image.mode)
+    
+    def median_filter(self, image, size):
+        # cv2.medianBlur handles 8-bit images with 1, 3 or 4 channels
+        if image.mode not in self.SUPPORTED_MODES or size % 2 == 0:
+            return super().median_filter(image, size)
+        return self._from_array(self.cv2.medianBlur(self._to_array(image), size), image.mode)
+    
+    def _blur_array(self, arr, radius):
+        # Pillow's radius is the standard deviation; replicate edges like Pillow
+        return self.cv2.GaussianBlur(arr, (0, 0), sigmaX=radius, sigmaY=radius, borderType=self.cv2.BORDER_REPLICATE)
+    
+    def gaussian_blur(self, image, radius):
+        if image.mode not in self.SUPPORTED_MODES or radius <= 0:
+            return super().gaussian_blur(image, radius)
+        return self._from_array(self._blur_array(self._to_array(image), radius), image.mode)
+    
+    def unsharp_mask(self, image, radius, percent=150, threshold=3):
+        if image.mode not in self.SUPPORTED_MODES or radius <= 0:
+            return super().unsharp_mask(image, radius, percent, threshold)
+        arr = self._to_array(image)
+        diff = arr.astype(np.int16) - self._blur_array(arr, radius)
+        # The adjustment only depends on the difference (-255..255), so it is looked up.
+        # int32 so diff * percent cannot overflow; the division truncates toward zero like Pillow's
+        diffs = np.arange(-255, 256, dtype=np.int32)
+        adjustment = np.where(np.abs(diffs) >= threshold, np.sign(diffs) * (np.abs(diffs) * percent // 100), 0)
+        sharpened = arr + adjustment[diff + 255]
+        return self._from_array(np.clip(sharpened, 0, 255).astype(np.uint8), image.mode)
+    
+    def box_filter(self, arr, radius):
+        size = 2 * radius + 1
+        return self.cv2.blur(arr.astype(np.float32), (size, size), borderType=self.cv2.BORDER_REPLICATE)
+
+_kernels = None
+
+def get_kernels():
+    """Return the configured kernel backend, resolved once per process"""
+    global _kernels
+    if _kernels is None:
+        backend = str(load_config().get('kernel_backend', 'auto')).lower()
+        cv2 = _load_cv2() if backend in ('opencv', 'auto') else None
+        if cv2 is not None:
+            _kernels = OpenCVKernels(cv2)
+        else:
+            if backend == 'opencv':
+                logger.warning("OpenCV kernel backend requested but cv2 is not available, using Pillow")
+            _kernels = PillowKernels()
+        logger.info(f"Using {_kernels.name} image kernels")
+    return _kernels
+
+# --- End Image Kernel Backends ---
+
+# --- Render Deadlines and Cancellation ---
+
+def client_disconnected(environ):
+    """Check whether the client of the current request has closed its connection"""
+    sock = environ.get('gunicorn.socket') or environ.get('werkzeug.socket')
+    if sock is None:
+        return False
+    try:
+        # The request body has been read, so a readable socket with nothing to
+        # peek at means the client sent FIN
+        readable, _, _ = select.select([sock], [], [], 0)
+        if not readable:
+            return False
+        return sock.recv(1, socket.MSG_PEEK) == b''
+    except ValueError:
+        # e.g. TLS sockets don't support MSG_PEEK; assume still connected
+        return False
+    except OSError:
+        return True
+
+class RenderDeadline:
+    """Time budget for one render, also cancelled when the client disconnects.
+    
+    Render loops call expired() between formats and variations and stop early,
+    leaving the reason in `reason` ('deadline', 'client_disconnected' or
+    'background_timeout' when background removal timed out before the deadline).
+    """
+    CLIENT_CHECK_INTERVAL = 0.25
+    
+    def __init__(self, seconds=None, environ=None):
+        self.expires_at = time.monotonic() + seconds if seconds else None
+        self.environ = environ
+        self.reason = None
+        self._last_client_check = 0.0
+    
+    def remaining(self):
+        """Seconds left before the deadline (None if there is no time limit)"""
+        if self.expires_at is None:
+            return None
+        return max(0.0, self.expires_at - time.monotonic())
+    
+    def expired(self):
+        if self.reason:
+            return True
+        now = time.monotonic()
+        if self.expires_at is not None and now >= self.expires_at:
+            self.reason = 'deadline'
+        elif self.environ is not None and now - self._last_client_check >= self.CLIENT_CHECK_INTERVAL:
+            self._last_client_check = now
+            if client_disconnected(self.environ):
+                self.reason = 'client_disconnected'
+        return self.reason is not None
+
+class RenderDeadlineExceeded(Exception):
+    """Raised when a render step cannot complete before the request deadline"""
+
+# --- End Render Deadlines and Cancellation ---
+
+def preprocess_image(image, options, deadline=None):
     """Enhanced preprocessing with background removal and advanced features"""
     
-    # Debug logging
-    print(f"Preprocessing options: remove_background={options.get('remove_background')}, background_color={options.get('background_color')}")
+    logger.debug("Preprocessing options: remove_background=%s, background_color=%s", options.get('remove_background'), options.get('background_color'))
     
     # First, handle background removal if requested
     if options.get('remove_background') and REMBG_AVAILABLE:
         bg_method = options.get('background_removal_method', 'auto')
-        print(f"Removing background using method: {bg_method}")
-        image = remove_background(image, method=bg_method)
-        print("Background removal completed")
+        logger.debug("Removing background using method: %s", bg_method)
+        image = remove_background(image, method=bg_method, deadline=deadline)
     
     # Apply background color if specified and image has transparency
     if image.mode == 'RGBA':
-        # Check if image has transparency
-        alpha_range = image.getchannel('A').getextrema()
-        has_transparency = alpha_range[0] < 255  # Has some transparency
-        
         bg_color = options.get('background_color', 'transparent')
-        print(f"Background color setting: {bg_color}, has_transparency: {has_transparency}")
-        
-        if bg_color and bg_color.lower() != 'transparent' and has_transparency:
-            print(f"Applying background color: {bg_color}")
+        # Only a solid background colour needs the alpha scan
+        if bg_color and bg_color.lower() != 'transparent' and image.getchannel('A').getextrema()[0] < 255:
+            logger.debug("Applying background color: %s", bg_color)
             image = apply_background_color(image, bg_color)
-            # Verify background color was applied
-            new_alpha_range = image.getchannel('A').getextrema()
-            print(f"After background color application - alpha range: {new_alpha_range}")
+            if logger.isEnabledFor(logging.DEBUG):
+                # Verify background color was applied
+                logger.debug("After background color application - alpha range: %s", image.getchannel('A').getextrema())
         else:
-            print("Skipping background color application")
+            logger.debug("No background color to apply (%s)", bg_color)
     else:
-        print(f"Image mode is {image.mode}, not RGBA - skipping transparency checks")
+        logger.debug("Image mode is %s, not RGBA - skipping transparency checks", image.mode)
     
     # Auto crop if requested
     if options.get('auto_crop'):
@@ -255,19 +1059,12 @@ def preprocess_image(image, options):
         image = enhancer.enhance(1.5)
     if options.get('apply_blur'):
         blur_radius = options.get('blur_radius', 2)
-        image = image.filter(ImageFilter.GaussianBlur(radius=blur_radius))
+        image = get_kernels().gaussian_blur(image, blur_radius)
     if options.get('add_watermark') and options.get('watermark_text'):
-        watermark = Image.new('RGBA', image.size, (0, 0, 0, 0))
-        draw = ImageDraw.Draw(watermark)
-        try:
-            font = ImageFont.truetype("Arial", 36)
-        except IOError:
-            font = ImageFont.load_default()
-        text_width, text_height = draw.textbbox((0, 0), options.get('watermark_text'), font=font)[2:4]
-        position = (image.width - text_width - 20, image.height - text_height - 20)
         opacity = int(255 * float(options.get('watermark_opacity', 0.3)))
-        draw.text(position, options.get('watermark_text'), fill=(255, 255, 255, opacity), font=font)
-        image = Image.alpha_composite(image.convert('RGBA'), watermark)
+        text_layer = get_text_layer(options.get('watermark_text'), ("Arial", 36), (255, 255, 255, opacity))
+        position = (image.width - text_layer.width - 20, image.height - text_layer.height - 20)
+        image = composite_region(image.convert('RGBA'), text_layer, position)
     
     # New processing options
     if options.get('vignette'):
@@ -281,7 +1078,7 @@ def preprocess_image(image, options):
         image = enhancer.enhance(options.get('brightness', 1.0))
     if options.get('sharpen'):
         radius = options.get('sharpen_radius', 1.0)
-        image = image.filter(ImageFilter.UnsharpMask(radius=radius))
+        image = get_kernels().unsharp_mask(image, radius)
     
     # Apply shadow effect if requested
     if options.get('shadow_effect'):
@@ -379,227 +1176,1409 @@ def generate_variations():
         {'label': 'Inverted_Blur', 'opts': {'invert': True, 'apply_blur': True, 'blur_radius': 2}},
     ]
 
-def create_favicon(image, filename_without_ext):
+def create_favicon(image, filename_without_ext, palette_min_psnr=None):
     favicon_sizes = [16, 32, 48]
-    output_filename = f"{filename_without_ext}_favicon.ico"
-    output_path = os.path.join(app.config['UPLOAD_FOLDER'], output_filename)
-    favicon_images = []
+    output_key = f"{filename_without_ext}_favicon.ico"
     try:
-        for size in favicon_sizes:
-            img_copy = image.copy()
-            img_copy.thumbnail((size, size), Image.LANCZOS)
-            favicon_images.append(img_copy)
-        favicon_images[0].save(
-            output_path,
-            format='ICO',
-            sizes=[(img.width, img.height) for img in favicon_images]
-        )
-        return {
-            'path': output_path,
-            'url': f"/{app.config['UPLOAD_FOLDER']}/{output_filename}"
-        }
+        _, palette = save_ico(image, output_key, favicon_sizes, palette_min_psnr)
+        result = output_entry(output_key)
+        if palette:
+            result['palette'] = True
+        return result
     except Exception as e:
-        logging.error(f"Error creating favicon: {e}")
+        logger.error(f"Error creating favicon: {e}")
         raise ValueError("Failed to create favicon")
 
+def parse_render_options(form, config):
+    """Parse format selection and preprocessing options from an upload form"""
+    selected_formats = form.getlist('selected_formats')
+    output_formats = form.getlist('output_formats')
+    variations_mode = form.get('variations_mode') == 'true'
+    fill_white_with_prominent = form.get('fill_white_with_prominent') == 'true'
+    
+    # Default to all formats if none selected
+    if not selected_formats:
+        selected_formats = list(config['formats'].keys())
+    
+    # Default to PNG if no output format selected
+    if not output_formats:
+        output_formats = ['png']
+        
+    # Remove ICO if favicon not selected
+    if 'ico' in output_formats and 'favicon' not in selected_formats:
+        output_formats.remove('ico')
+        if not output_formats:
+            output_formats.append('png')
+            
+    # Get preprocessing options from form
+    preprocessing_options = {
+        'grayscale': form.get('grayscale') == 'true',
+        'bw': form.get('bw') == 'true',
+        'invert': form.get('invert') == 'true',
+        'hue_shift': int(float(form.get('hue_shift', 0))),
+        'temperature': int(float(form.get('temperature', 0))),
+        'enhance_contrast': form.get('enhance_contrast') == 'true',
+        'apply_blur': form.get('apply_blur') == 'true',
+        'blur_radius': float(form.get('blur_radius', config.get('preprocessing_options', {}).get('blur_radius', 2.0))),
+        'add_watermark': form.get('add_watermark') == 'true',
+        'watermark_text': form.get('watermark_text', config.get('preprocessing_options', {}).get('watermark_text', '© BrandKit')),
+        'watermark_opacity': float(form.get('watermark_opacity', config.get('preprocessing_options', {}).get('watermark_opacity', 0.3))),
+        'vignette': form.get('vignette') == 'true',
+        'vignette_strength': float(form.get('vignette_strength', config.get('preprocessing_options', {}).get('vignette_strength', 0.5))),
+        'saturation': float(form.get('saturation', config.get('preprocessing_options', {}).get('saturation', 1.0))),
+        'brightness': float(form.get('brightness', config.get('preprocessing_options', {}).get('brightness', 1.0))),
+        'sharpen': form.get('sharpen') == 'true',
+        'sharpen_radius': float(form.get('sharpen_radius', config.get('preprocessing_options', {}).get('sharpen_radius', 1.0))),
+        # New advanced options
+        'remove_background': form.get('remove_background') == 'true',
+        'background_removal_method': form.get('background_removal_method', 'auto'),
+        'background_color': form.get('background_color', 'transparent'),
+        'edge_smooth': form.get('edge_smooth') == 'true',
+        'smooth_radius': float(form.get('smooth_radius', 2.0)),
+        'noise_reduction': form.get('noise_reduction') == 'true',
+        'noise_strength': int(form.get('noise_strength', 1)),
+        'auto_crop': form.get('auto_crop') == 'true',
+        'crop_padding': int(form.get('crop_padding', 10)),
+        'shadow_effect': form.get('shadow_effect') == 'true',
+        'shadow_opacity': float(form.get('shadow_opacity', 0.3)),
+        'shadow_blur': int(form.get('shadow_blur', 4)),
+        'shadow_offset': (int(form.get('shadow_offset_x', 5)), int(form.get('shadow_offset_y', 5))),
+        'enhance_quality': form.get('enhance_quality') == 'true',
+    }
+    
+    # Get additional options
+    quality = int(form.get('quality', 95))
+    strip_metadata = form.get('strip_metadata') == 'true'
+    
+    return {
+        'selected_formats': selected_formats,
+        'output_formats': output_formats,
+        'variations_mode': variations_mode,
+        'fill_white_with_prominent': fill_white_with_prominent,
+        'preprocessing_options': preprocessing_options,
+        'quality': quality,
+        'strip_metadata': strip_metadata,
+    }
+
+# --- Admission Control ---
+# Every render is priced in work units (roughly 25 ms of CPU each) from the source
+# size, the selected formats, variations and options. Renders are admitted against the
+# worker's capacity and memory budget, queued when the worker is busy and
+# rejected when the queue is full or the request can never fit.
+
+# Work per output megapixel for each encoder (PNG uses compress_level=9, WebP method=6)
+ENCODER_WORK = {'png': 3.0, 'webp': 70.0, 'jpg': 0.5, 'jpeg': 0.5, 'gif': 4.0}
+# Extra passes over the source image for the costlier preprocessing options
+PREPROCESS_OPTION_WORK = {
+    'noise_reduction': 2, 'edge_smooth': 1, 'apply_blur': 1, 'sharpen': 1, 'shadow_effect': 2,
+    'vignette': 1, 'hue_shift': 2, 'temperature': 1, 'enhance_quality': 3, 'add_watermark': 1,
+}
+# Background removal inference, independent of source size thanks to the proxy
+BG_REMOVAL_WORK = 40
+BG_REMOVAL_MEMORY_MB = 300
+# Work per output megapixel of the radial gradient fill
+GRADIENT_FILL_WORK = 140
+# Work per output megapixel of the quality search for byte-budget JPEG/WebP outputs
+TARGET_ENCODING_WORK = 40
+# Work per output megapixel of each frame of an animated output (WebP frames use ANIMATED_WEBP_METHOD)
+ANIMATED_ENCODER_WORK = {'gif': 4.0, 'webp': 6.0}
+
+def estimate_render_cost(source_size, formats, selected_formats, output_formats, variations_mode=False, fill_white_with_prominent=False, preprocessing_options=None, preprocessed=False, background_cached=False, frames=1):
+    """Estimate the pixel work and peak memory of a render.
+    
+    preprocessed means the preprocessed image is already cached and
+    background_cached that the background mask is, as for a re-render.
+    frames is the frame count of an animated source (see animation_frame_count);
+    every frame is preprocessed, fitted and encoded for each GIF/WebP geometry.
+    """
+    preprocessing_options = preprocessing_options or {}
+    source_mp = source_size[0] * source_size[1] / 1e6
+    is_square = source_size[0] == source_size[1]
+    passes = len(generate_variations()) if variations_mode else 1
+    
+    # Preprocessing: decode/convert plus one pass per costly option, per variation
+    option_passes = sum(w for opt, w in PREPROCESS_OPTION_WORK.items() if preprocessing_options.get(opt))
+    preprocess_work = source_mp * (2 + option_passes) * passes
+    if preprocessing_options.get('remove_background') and not background_cached:
+        preprocess_work += BG_REMOVAL_WORK * passes
+    if preprocessed and not variations_mode:
+        preprocess_work = 0
+    
+    # Animated outputs redo the preprocessing per frame, background removal included
+    animated_formats = [fmt.lower() for fmt in output_formats if fmt.lower() in ANIMATED_OUTPUT_FORMATS] if frames > 1 and not variations_mode else []
+    frame_work = source_mp * (2 + option_passes)
+    if preprocessing_options.get('remove_background'):
+        frame_work += BG_REMOVAL_WORK
+    
+    # Formats: one render per unique geometry, then each encoder
+    selected = {k: v for k, v in formats.items() if k in selected_formats}
+    format_work = 0.0
+    largest_output_mp = 0.0
+    for (dimensions, gradient_fill), format_names in group_formats_by_geometry(selected, is_square, fill_white_with_prominent).items():
+        output_mp = dimensions[0] * dimensions[1] / 1e6
+        largest_output_mp = max(largest_output_mp, output_mp)
+        format_work += source_mp + output_mp * 2
+        if gradient_fill:
+            format_work += output_mp * GRADIENT_FILL_WORK
+        format_work += output_mp * sum(ENCODER_WORK.get(fmt.lower(), 1.0) for fmt in output_formats if fmt.lower() not in animated_formats and fmt.lower() != 'ico')
+        if animated_formats:
+            format_work += frames * (frame_work + output_mp * (2 + sum(ANIMATED_ENCODER_WORK[fmt] for fmt in animated_formats)))
+        if any(get_encoding_target(formats[name]) for name in format_names):
+            format_work += output_mp * TARGET_ENCODING_WORK * sum(1 for fmt in output_formats if fmt.lower() in TARGET_ENCODING_FORMATS)
+    format_work *= passes
+    
+    # Memory: a few RGBA copies of the source and of the largest output canvas
+    memory_mb = (source_mp * 4 * 4) + (largest_output_mp * 4 * 3) + 50
+    if preprocessing_options.get('remove_background'):
+        memory_mb += BG_REMOVAL_MEMORY_MB
+    
+    return {
+        'work': max(1, int(math.ceil(preprocess_work + format_work))),
+        'memory_mb': int(math.ceil(memory_mb)),
+    }
+
+class AdmissionRejected(Exception):
+    """Raised when a render cannot be admitted; carries the HTTP status to return"""
+    
+    def __init__(self, message, status=503, retry_after=None):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+class AdmissionController:
+    """Admit renders by estimated cost against a work capacity and memory budget.
+    
+    Waiting renders form a FIFO queue. A render behind the queue head may start
+    early only if it still leaves room for the head, so cheap requests fill spare
+    capacity without starving a heavy one. Renders costlier than the whole
+    capacity run alone; renders over the memory budget are rejected.
+    
+    Memory held by caches (set_cache_memory) counts against the budget too.
+    A render that is short of memory only because of them calls reclaim(mb),
+    which should evict at least that much and report the new total.
+    """
+    
+    def __init__(self, capacity, memory_mb, max_queue, queue_timeout):
+        self.capacity = capacity
+        self.memory_mb = memory_mb
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.work_in_use = 0
+        self.memory_in_use = 0
+        self.cache_memory_mb = 0
+        self.reclaim = None
+        self._queue = []
+        self._cond = threading.Condition()
+    
+    def _reserved(self, ticket):
+        head = self._queue[0]
+        return (0, 0) if ticket is head else (head['work'], head['memory_mb'])
+    
+    def _fits(self, ticket, reserved_work=0, reserved_memory=0):
+        return (self.work_in_use + ticket['work'] + reserved_work <= self.capacity and
+                self.memory_in_use + self.cache_memory_mb + ticket['memory_mb'] + reserved_memory <= self.memory_mb)
+    
+    def _can_start(self, ticket):
+        return self._fits(ticket, *self._reserved(ticket))
+    
+    def _reclaim_for(self, ticket):
+        """Evict cached memory a waiting ticket is short of; returns whether it can start now"""
+        if not self.reclaim or not self.cache_memory_mb:
+            return False
+        shortfall = self.memory_in_use + self.cache_memory_mb + ticket['memory_mb'] + self._reserved(ticket)[1] - self.memory_mb
+        if shortfall <= 0:
+            # Waiting for work capacity, which evicting does not free
+            return False
+        self.reclaim(shortfall)
+        return self._can_start(ticket)
+    
+    def set_cache_memory(self, mb):
+        """Report the memory (MB) caches hold, which renders are admitted around"""
+        with self._cond:
+            self.cache_memory_mb = mb
+            self._cond.notify_all()
+    
+    def status(self):
+        with self._cond:
+            return {
+                'work_in_use': self.work_in_use,
+                'memory_in_use_mb': self.memory_in_use,
+                'cache_memory_mb': self.cache_memory_mb,
+                'queued': len(self._queue),
+                'capacity': self.capacity,
+                'memory_budget_mb': self.memory_mb,
+            }
+    
+    def acquire(self, cost, timeout=None):
+        """Block until the render may start; returns a ticket with queue position and wait time.
+        
+        The ticket must be passed to release() when the render ends.
+        """
+        if cost['memory_mb'] > self.memory_mb:
+            raise AdmissionRejected(
+                "This image is too large to render. Upload a smaller image or select fewer formats.",
+                status=413
+            )
+        
+        ticket = {'work': min(cost['work'], self.capacity), 'memory_mb': cost['memory_mb']}
+        timeout = self.queue_timeout if timeout is None else min(timeout, self.queue_timeout)
+        started = time.monotonic()
+        
+        with self._cond:
+            if len(self._queue) >= self.max_queue:
+                raise AdmissionRejected("Server is busy, please try again shortly.", status=503, retry_after=5)
+            ticket['queue_position'] = len(self._queue)
+            self._queue.append(ticket)
+            try:
+                while not self._can_start(ticket) and not self._reclaim_for(ticket):
+                    remaining = started + timeout - time.monotonic()
+                    if remaining <= 0:
+                        raise AdmissionRejected("Timed out waiting for render capacity, please try again.", status=503, retry_after=5)
+                    self._cond.wait(remaining)
+            finally:
+                self._queue.remove(ticket)
+                # The queue head may have changed
+                self._cond.notify_all()
+            self.work_in_use += ticket['work']
+            self.memory_in_use += ticket['memory_mb']
+        
+        ticket['queued_ms'] = int((time.monotonic() - started) * 1000)
+        return ticket
+    
+    def release(self, ticket):
+        with self._cond:
+            self.work_in_use -= ticket['work']
+            self.memory_in_use -= ticket['memory_mb']
+            self._cond.notify_all()
+    
+    @contextmanager
+    def admit(self, cost, timeout=None):
+        """Context manager around acquire() and release(); yields the ticket"""
+        ticket = self.acquire(cost, timeout)
+        try:
+            yield ticket
+        finally:
+            self.release(ticket)
+
+admission_controller = AdmissionController(ADMISSION_CAPACITY, ADMISSION_MEMORY_MB, ADMISSION_MAX_QUEUE, ADMISSION_QUEUE_TIMEOUT_S)
+
+def estimate_options_cost(source_size, config, render_options, warmed=None, frames=1):
+    """Estimate the cost of rendering parsed upload options for a source image size.
+    
+    warmed is the upload's speculative entry; stages it has cached are not counted.
+    frames is the source's animation_frame_count().
+    """
+    preprocessing_options = render_options['preprocessing_options']
+    warmed = warmed or {}
+    return estimate_render_cost(
+        source_size,
+        config['formats'],
+        render_options['selected_formats'],
+        render_options['output_formats'],
+        variations_mode=render_options['variations_mode'],
+        fill_white_with_prominent=render_options['fill_white_with_prominent'],
+        preprocessing_options=preprocessing_options,
+        preprocessed=has_cached_stage(warmed, preprocessing_options),
+        background_cached=preprocessing_options.get('background_removal_method', 'auto') == warmed.get('background_warmed'),
+        frames=frames,
+    )
+
+def animation_frame_count(source, render_options):
+    """Frames a render of parsed upload options encodes per animated output: 1 unless it animates source.
+    
+    source is a path or binary stream. Mirrors generate_formats, which animates
+    GIF/WebP outputs of standard renders up to ANIMATION_MAX_FRAMES frames.
+    """
+    if render_options['variations_mode'] or not any(fmt.lower() in ANIMATED_OUTPUT_FORMATS for fmt in render_options['output_formats']):
+        return 1
+    try:
+        animation = probe_animation(source)
+    except (OSError, ValueError):
+        return 1
+    if not animation or len(animation['durations']) > ANIMATION_MAX_FRAMES:
+        return 1
+    return len(animation['durations'])
+
+def estimate_upload_request_cost():
+    """Estimate the cost of the current /upload request from its form and image header"""
+    if 'upload_cost' in g:
+        return g.upload_cost
+    cost = {'work': 1, 'memory_mb': 0}
+    try:
+        file = request.files.get('file')
+        token = request.form.get('upload_token') or request.form.get('upload_id')
+        entry = get_speculative_entry(token) if not file and token else None
+        source_size = None
+        source = file.stream if file else chunked_upload_data_path((request.view_args or {}).get('upload_id'))
+        if not source and is_upload_token(token):
+            source = storage.local_path(stash_key(token)) or io.BytesIO(storage.get(stash_key(token)) or b'')
+        if entry and entry.get('image') is not None:
+            source_size = entry['image'].size
+        elif source:
+            # Only the image header is read here
+            with Image.open(source) as img:
+                source_size = img.size
+            if file:
+                file.stream.seek(0)
+        if source_size:
+            config = load_config()
+            render_options = parse_render_options(request.form, config)
+            frames = animation_frame_count(source, render_options) if source else 1
+            cost = estimate_options_cost(source_size, config, render_options, warmed=entry, frames=frames)
+    except Exception as e:
+        # Invalid uploads are rejected by the view itself
+        logger.warning(f"Could not estimate upload cost: {e}")
+    g.upload_cost = cost
+    return cost
+
+def upload_rate_limit_cost():
+    """Flask-Limiter cost of an /upload request in work units"""
+    return min(estimate_upload_request_cost()['work'], UPLOAD_WORK_PER_MINUTE)
+
+# --- End Admission Control ---
+
+def get_render_deadline_seconds(requested=None):
+    """Render time budget for a request: the requested value, capped at RENDER_DEADLINE_S"""
+    try:
+        requested = float(requested) if requested else 0
+    except ValueError:
+        requested = 0
+    if requested > 0:
+        return min(requested, RENDER_DEADLINE_S) if RENDER_DEADLINE_S else requested
+    return RENDER_DEADLINE_S
+
 @app.route('/upload', methods=['POST'])
-@limiter.limit("5 per minute")
+@limiter.shared_limit(f"{UPLOAD_WORK_PER_MINUTE} per minute", scope='upload-work', cost=upload_rate_limit_cost)
 def upload_file():
+    # Start the render clock as soon as the request arrives
+    deadline = RenderDeadline(get_render_deadline_seconds(request.form.get('deadline')), environ=request.environ)
+    if 'file' not in request.files and request.form.get('upload_token'):
+        return process_stashed_upload(request.form.get('upload_token'), request.form, deadline)
+    if 'file' not in request.files:
+        return jsonify({'error': 'No file part'}), 400
+    file = request.files['file']
+    if file.filename == '':
+        return jsonify({'error': 'No selected file'}), 400
+    if not allowed_file(file.filename):
+        return jsonify({'error': 'File type not allowed'}), 400
+    
+    # Save the upload to a local working file
+    filename = secure_filename(file.filename)
+    fd, file_path = tempfile.mkstemp(suffix=f"_{filename}")
+    os.close(fd)
     try:
-        if 'file' not in request.files:
-            return jsonify({'error': 'No file part'}), 400
-        file = request.files['file']
-        if file.filename == '':
-            return jsonify({'error': 'No selected file'}), 400
-        if not allowed_file(file.filename):
-            return jsonify({'error': 'File type not allowed'}), 400
+        file.save(file_path)
+    except Exception as e:
+        logger.error(f"Upload error: {e}")
+        os.remove(file_path)
+        return jsonify({'error': f'Server error: {str(e)}'}), 500
+    return process_upload(file_path, filename, request.form, deadline)
+
+@app.route('/render', methods=['POST'])
+@limiter.shared_limit(f"{UPLOAD_WORK_PER_MINUTE} per minute", scope='upload-work', cost=upload_rate_limit_cost)
+def render_stored_upload():
+    """Re-render an earlier upload, referenced by the upload_id /upload returned, with new options"""
+    deadline = RenderDeadline(get_render_deadline_seconds(request.form.get('deadline')), environ=request.environ)
+    return process_stashed_upload(request.form.get('upload_id'), request.form, deadline, ttl=UPLOAD_ID_TTL_S)
+
+def strip_image_metadata(file_path):
+    """Re-save an image file in place from its pixels only, dropping EXIF and other metadata"""
+    with Image.open(file_path) as img:
+        # Animated PNGs are flattened like any other still
+        animated = getattr(img, 'is_animated', False) and img.format in ('GIF', 'WEBP')
+        if not animated:
+            # Same pixels as copying getdata() into a new image, without a Python list per pixel
+            img_without_exif = Image.frombytes(img.mode, img.size, img.tobytes())
+    if animated:
+        # Re-saving from pixels would keep only the first frame
+        with open(file_path, 'rb') as f:
+            data = strip_animation_metadata(f.read())
+        with open(file_path, 'wb') as f:
+            f.write(data)
+        return
+    img_without_exif.save(file_path)
 
-        # Secure filename and create unique ID
-        filename = secure_filename(file.filename)
+def process_upload(file_path, filename, form, deadline, upload_id=None):
+    """Render an uploaded image saved in a local working file and return the response.
+    
+    Strips metadata, stashes the image under its upload id, stores the original
+    under a unique name and renders the formats selected in the form. The
+    working file is removed afterwards. upload_id is given for an image that is
+    already stashed (by /analyze or an earlier render): its file is already
+    stripped, and whatever its entry has warmed is reused.
+    """
+    handed_off = False
+    flight = None
+    try:
+        # Create unique ID; the original is stored under a unique name
         file_id = str(uuid.uuid4())
         filename_without_ext = os.path.splitext(filename)[0]
-        
-        # Save file with unique name
         unique_filename = f"{file_id}_{filename}"
-        file_path = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
-        file.save(file_path)
         
         # Process image with mandatory metadata stripping
         try:
-            with Image.open(file_path) as img:
+            if upload_id is None:
                 # Strip metadata for security
-                data = list(img.getdata())
-                img_without_exif = Image.new(img.mode, img.size)
-                img_without_exif.putdata(data)
-                img_without_exif.save(file_path)
+                strip_image_metadata(file_path)
+            with open(file_path, 'rb') as f:
+                data = f.read()
+            if upload_id is None:
+                # Warm up a speculative background mask only if removal is requested
+                # (False, unlike None, rules out guessing one for a likely logo)
+                background_method = form.get('background_removal_method', 'auto') if form.get('remove_background') == 'true' else False
+                upload_id = stash_image_data(data, background_method)
+            stashed = get_speculative_entry(upload_id) or {}
+            if stashed.get('original_key') and storage.stat(stashed['original_key']):
+                # Re-render of the same image: the stored original is reused
+                unique_filename = stashed['original_key']
+            else:
+                storage.put(unique_filename, data)
+                stashed['original_key'] = unique_filename
+            stashed['filename'] = filename
         except Exception as e:
-            logging.error(f"Error processing image: {e}")
-            os.remove(file_path)
+            logger.error(f"Error processing image: {e}")
             return jsonify({'error': 'Invalid image file'}), 400
 
         # Main processing logic
         try:
-            selected_formats = request.form.getlist('selected_formats')
-            output_formats = request.form.getlist('output_formats')
-            variations_mode = request.form.get('variations_mode') == 'true'
-            fill_white_with_prominent = request.form.get('fill_white_with_prominent') == 'true'
-            
             # Load configuration
             config = load_config()
+            render_options = parse_render_options(form, config)
+            preprocessing_options = render_options['preprocessing_options']
             
-            # Default to all formats if none selected
-            if not selected_formats:
-                selected_formats = list(config['formats'].keys())
-            
-            # Default to PNG if no output format selected
-            if not output_formats:
-                output_formats = ['png']
-                
-            # Remove ICO if favicon not selected
-            if 'ico' in output_formats and 'favicon' not in selected_formats:
-                output_formats.remove('ico')
-                if not output_formats:
-                    output_formats.append('png')
-                    
-            # Get preprocessing options from form
-            preprocessing_options = {
-                'grayscale': request.form.get('grayscale') == 'true',
-                'bw': request.form.get('bw') == 'true',
-                'invert': request.form.get('invert') == 'true',
-                'hue_shift': int(float(request.form.get('hue_shift', 0))),
-                'temperature': int(float(request.form.get('temperature', 0))),
-                'enhance_contrast': request.form.get('enhance_contrast') == 'true',
-                'apply_blur': request.form.get('apply_blur') == 'true',
-                'blur_radius': float(request.form.get('blur_radius', config.get('preprocessing_options', {}).get('blur_radius', 2.0))),
-                'add_watermark': request.form.get('add_watermark') == 'true',
-                'watermark_text': request.form.get('watermark_text', config.get('preprocessing_options', {}).get('watermark_text', '© BrandKit')),
-                'watermark_opacity': float(request.form.get('watermark_opacity', config.get('preprocessing_options', {}).get('watermark_opacity', 0.3))),
-                'vignette': request.form.get('vignette') == 'true',
-                'vignette_strength': float(request.form.get('vignette_strength', config.get('preprocessing_options', {}).get('vignette_strength', 0.5))),
-                'saturation': float(request.form.get('saturation', config.get('preprocessing_options', {}).get('saturation', 1.0))),
-                'brightness': float(request.form.get('brightness', config.get('preprocessing_options', {}).get('brightness', 1.0))),
-                'sharpen': request.form.get('sharpen') == 'true',
-                'sharpen_radius': float(request.form.get('sharpen_radius', config.get('preprocessing_options', {}).get('sharpen_radius', 1.0))),
-                # New advanced options
-                'remove_background': request.form.get('remove_background') == 'true',
-                'background_removal_method': request.form.get('background_removal_method', 'auto'),
-                'background_color': request.form.get('background_color', 'transparent'),
-                'edge_smooth': request.form.get('edge_smooth') == 'true',
-                'smooth_radius': float(request.form.get('smooth_radius', 2.0)),
-                'noise_reduction': request.form.get('noise_reduction') == 'true',
-                'noise_strength': int(request.form.get('noise_strength', 1)),
-                'auto_crop': request.form.get('auto_crop') == 'true',
-                'crop_padding': int(request.form.get('crop_padding', 10)),
-                'shadow_effect': request.form.get('shadow_effect') == 'true',
-                'shadow_opacity': float(request.form.get('shadow_opacity', 0.3)),
-                'shadow_blur': int(request.form.get('shadow_blur', 4)),
-                'shadow_offset': (int(request.form.get('shadow_offset_x', 5)), int(request.form.get('shadow_offset_y', 5))),
-                'enhance_quality': request.form.get('enhance_quality') == 'true',
-            }
-            
-            # Get additional options
-            quality = int(request.form.get('quality', 95))
-            strip_metadata = request.form.get('strip_metadata') == 'true'
+            # An identical render in flight here or in another worker shares its response
+            flight = RenderFlight(render_flight_key(upload_id, filename_without_ext, render_options))
+            shared = flight.join(timeout=deadline.remaining())
+            if shared is not None:
+                logger.info("Identical render in flight or just finished, sharing its response")
+                shared['coalesced'] = True
+                if wants_ndjson():
+                    return stream_shared_response(shared)
+                return jsonify(shared), 200
             
             # Original file is already saved, now generate assets
             original_path = file_path
+            warmed = wait_for_speculative_entry(stashed, deadline, preprocessing_options) if stashed.get('ready') else {}
                 
             # Analyze the image for smart background fill feature
             try:
-                img_for_analysis = Image.open(original_path)
-                prominent_color = get_prominent_color(img_for_analysis)
-                has_white_area, white_area_ratio = has_significant_white_area(img_for_analysis)
-                analysis_results = {
-                    'prominent_color': prominent_color,
-                    'has_white_area': bool(has_white_area),
-                    'white_area_ratio': float(white_area_ratio)
-                }
+                if warmed.get('analysis'):
+                    analysis_results = warmed['analysis']
+                else:
+                    img_for_analysis = Image.open(original_path)
+                    prominent_color = get_prominent_color(img_for_analysis)
+                    has_white_area, white_area_ratio = has_significant_white_area(img_for_analysis)
+                    analysis_results = {
+                        'prominent_color': prominent_color,
+                        'has_white_area': bool(has_white_area),
+                        'white_area_ratio': float(white_area_ratio)
+                    }
             except Exception as e:
-                print(f"Image analysis failed: {e}")
-                traceback.print_exc()
+                logger.exception(f"Image analysis failed: {e}")
                 analysis_results = {
                     'prominent_color': [200, 200, 200],
                     'has_white_area': False,
                     'white_area_ratio': 0.0
                 }
                 
-            # Generate formatted images
-            results = generate_formats(
-                original_path,
-                filename_without_ext,
-                selected_formats,
-                output_formats,
-                preprocessing_options,
-                variations_mode=variations_mode,
-                fill_white_with_prominent=fill_white_with_prominent,
-                quality=quality,
-                strip_metadata=strip_metadata
-            )
-            
-            # Add original to results
-            results['original'] = {
-                'path': original_path,
-                'url': f"/{app.config['UPLOAD_FOLDER']}/{unique_filename}"
+            # Wait for render capacity
+            frames = animation_frame_count(original_path, render_options)
+            if warmed.get('image'):
+                cost = estimate_options_cost(warmed['image'].size, config, render_options, warmed=warmed, frames=frames)
+            else:
+                with Image.open(original_path) as img:
+                    cost = estimate_options_cost(img.size, config, render_options, frames=frames)
+            try:
+                ticket = admission_controller.acquire(cost, timeout=deadline.remaining())
+            except AdmissionRejected as e:
+                logger.warning(f"Upload not admitted: {e}")
+                error_response = jsonify({'error': str(e)})
+                if e.retry_after:
+                    error_response.headers['Retry-After'] = str(e.retry_after)
+                return error_response, e.status
+            admission = {
+                'estimated_work': cost['work'],
+                'estimated_memory_mb': cost['memory_mb'],
+                'queue_position': ticket['queue_position'],
+                'queued_ms': ticket['queued_ms'],
             }
+            render_args = (original_path, unique_filename, filename_without_ext, render_options, analysis_results, deadline, warmed)
             
-            # Add analysis results
-            if analysis_results:
-                results['analysis'] = analysis_results
-                
-            # Create and add zip file
-            zip_info = create_zip_file(results, filename_without_ext)
-            if zip_info:
-                results['zip'] = zip_info
-            
-            # Ensure results are JSON serializable
-            serializable_results = ensure_serializable(results)
-            
-            # Run memory cleanup after processing large batches
-            if len(selected_formats) > 5 or variations_mode:
-                cleanup_memory()
-            
-            return jsonify({
-                'success': True,
-                'message': 'File processed successfully',
-                'results': serializable_results
-            })
-            
+            if wants_ndjson():
+                # The render thread releases the ticket and the flight and removes the working file
+                handed_off = True
+                return stream_upload_response(render_args, ticket, admission, upload_id, flight)
+            try:
+                response, status = render_upload(*render_args)
+            finally:
+                admission_controller.release(ticket)
+            if status == 200:
+                response['admission'] = admission
+                response['upload_id'] = upload_id
+            flight.publish(response, status)
+            return jsonify(response), status
+        
+        except ValueError as ve:
+            logger.warning(f"Value Error during processing: {ve}")
+            return jsonify({'error': str(ve)}), 400
+        except Exception as e:
+            logger.exception(f"An unexpected error occurred: {e}")
+            return jsonify({'error': 'An unexpected error occurred during processing.'}), 500
+    except Exception as e:
+        logger.error(f"Upload error: {e}")
+        return jsonify({'error': f'Server error: {str(e)}'}), 500
+    finally:
+        # The original is in storage; drop the working copy
+        if not handed_off and os.path.exists(file_path):
+            os.remove(file_path)
+        if flight and not handed_off:
+            flight.release()
+
+def render_upload(original_path, unique_filename, filename_without_ext, render_options, analysis_results, deadline, warmed, on_result=None):
+    """Render the selected formats of a stored upload and build the response.
+    
+    Returns (response, status). on_result(key, result, variation) is called as
+    each format, the favicon ICO and finally the ZIP become available.
+    """
+    selected_formats = render_options['selected_formats']
+    variations_mode = render_options['variations_mode']
+    
+    # Generate formatted images
+    results = generate_formats(
+        original_path,
+        filename_without_ext,
+        selected_formats,
+        render_options['output_formats'],
+        render_options['preprocessing_options'],
+        variations_mode=variations_mode,
+        fill_white_with_prominent=render_options['fill_white_with_prominent'],
+        quality=render_options['quality'],
+        strip_metadata=render_options['strip_metadata'],
+        deadline=deadline,
+        source_image=warmed.get('image'),
+        histogram=warmed.get('histogram'),
+        stage_cache=warmed.get('stages'),
+        encode_cache=warmed.get('encodes'),
+        on_result=on_result
+    )
+    if warmed:
+        # The render filled the upload's caches
+        trim_speculative_entries()
+    
+    if deadline.reason == 'client_disconnected':
+        # Nobody is waiting for the response; skip the ZIP
+        logger.info("Client disconnected, render cancelled")
+        return {'error': 'Client disconnected'}, 499
+    
+    # Add original to results
+    results['original'] = output_entry(unique_filename)
+    
+    # Add analysis results
+    if analysis_results:
+        results['analysis'] = analysis_results
+    
+    # Create and add zip file
+    zip_info = create_zip_file(results, filename_without_ext)
+    if zip_info:
+        results['zip'] = zip_info
+        if on_result:
+            on_result('zip', zip_info)
+    
+    # Ensure results are JSON serializable
+    serializable_results = ensure_serializable(results)
+    
+    # Run memory cleanup after processing large batches
+    if len(selected_formats) > 5 or variations_mode:
+        cleanup_memory()
+    
+    response = {
+        'success': True,
+        'message': 'File processed successfully',
+        'results': serializable_results
+    }
+    if deadline.reason:
+        response['partial'] = True
+        response['partial_reason'] = deadline.reason
+        if deadline.reason == 'background_timeout':
+            response['message'] = 'Background removal timed out; returning the formats completed so far'
+        else:
+            response['message'] = 'Render deadline reached; returning the formats completed so far'
+    return response, 200
+
+# --- Streaming Responses ---
+# Clients that send "Accept: application/x-ndjson" get /upload results as
+# newline-delimited JSON while the render runs, one event per line:
+#   {"type": "start", "admission": {...}, "upload_id": ..., "original": {...}, "analysis": {...}}
+#   {"type": "result", "key": "website", "result": {...}[, "variation": "Grayscale"]}
+#   {"type": "result", "key": "zip", "result": {...}}                 (last result)
+#   {"type": "done", "success": true, "message": ...[, "partial": true, ...]}
+#   {"type": "error", "error": ...}                                  (instead of done)
+# The render runs in its own thread so each event is written as soon as it is ready.
+
+def wants_ndjson():
+    return request.accept_mimetypes.best_match(['application/json', 'application/x-ndjson']) == 'application/x-ndjson'
+
+def ndjson_line(event):
+    return json.dumps(ensure_serializable(event)) + '\n'
+
+def stream_upload_response(render_args, ticket, admission, upload_id, flight):
+    """Stream an admitted render as NDJSON; the ticket, flight and working file are released when it ends"""
+    original_path, unique_filename = render_args[0], render_args[1]
+    analysis_results = render_args[4]
+    events = queue.Queue()
+    
+    def on_result(key, result, variation=None):
+        event = {'type': 'result', 'key': key, 'result': result}
+        if variation:
+            event['variation'] = variation
+        events.put(event)
+    
+    def run():
+        try:
+            response, status = render_upload(*render_args, on_result=on_result)
+            flight.publish(dict(response, admission=admission, upload_id=upload_id), status)
+            if status == 200:
+                response.pop('results')
+                events.put(dict(response, type='done', upload_id=upload_id))
+            else:
+                events.put(dict(response, type='error'))
+        except ValueError as ve:
+            logger.warning(f"Value Error during processing: {ve}")
+            events.put({'type': 'error', 'error': str(ve)})
+        except Exception as e:
+            logger.exception(f"An unexpected error occurred: {e}")
+            events.put({'type': 'error', 'error': 'An unexpected error occurred during processing.'})
+        finally:
+            admission_controller.release(ticket)
+            flight.release()
+            if os.path.exists(original_path):
+                os.remove(original_path)
+            events.put(None)
+    
+    # The render thread logs under the request's correlation id
+    threading.Thread(target=contextvars.copy_context().run, args=(run,), daemon=True).start()
+    
+    def generate():
+        yield ndjson_line({'type': 'start', 'admission': admission, 'upload_id': upload_id, 'original': output_entry(unique_filename), 'analysis': analysis_results})
+        while True:
+            event = events.get()
+            if event is None:
+                break
+            yield ndjson_line(event)
+    
+    # Ask proxies not to buffer the stream
+    return Response(generate(), mimetype='application/x-ndjson', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+def stream_shared_response(response):
+    """Replay the response of a coalesced render as the events of a streamed one"""
+    results = dict(response.pop('results'))
+    events = [{'type': 'start', 'admission': response.get('admission'), 'upload_id': response.get('upload_id'),
+               'original': results.pop('original', None), 'analysis': results.pop('analysis', None)}]
+    zip_info = results.pop('zip', None)
+    for key, result in results.items():
+        if key == 'variations':
+            for variation, variation_results in result.items():
+                events.extend({'type': 'result', 'key': name, 'result': r, 'variation': variation} for name, r in variation_results.items())
+        else:
+            events.append({'type': 'result', 'key': key, 'result': result})
+    if zip_info:
+        events.append({'type': 'result', 'key': 'zip', 'result': zip_info})
+    events.append(dict(response, type='done'))
+    return Response(''.join(ndjson_line(event) for event in events), mimetype='application/x-ndjson', headers={'Cache-Control': 'no-cache'})
+
+# --- End Streaming Responses ---
+
+# --- Request Coalescing ---
+# Identical renders (same image content, output name and render options) that
+# arrive while one of them is running share its response instead of each running
+# the whole pipeline over the same output and cache keys. Within a worker, later
+# requests wait on the first one's future; across workers on the same host, the
+# rendering worker holds an flock on <key>.lock in COALESCE_DIR and leaves its
+# response in <key>.json, which identical requests reuse for COALESCE_WINDOW_S.
+
+COALESCE_DIR = os.environ.get('BRANDKIT_COALESCE_DIR', os.path.join(tempfile.gettempdir(), 'brandkit-coalesce'))
+COALESCE_WINDOW_S = env_int('BRANDKIT_COALESCE_WINDOW_S', 10)
+# How often a request checks whether another worker's render has finished
+COALESCE_POLL_S = 0.05
+
+try:
+    import fcntl
+except ImportError:
+    # No flock (Windows): renders are only coalesced within a worker
+    fcntl = None
+
+# Coalescing key -> Future of the render running in this worker
+_flights = {}
+_flights_lock = threading.Lock()
+
+def render_flight_key(upload_id, filename_without_ext, render_options):
+    """Coalescing key of a render: the content hash, output name and canonical options"""
+    canonical = json.dumps([upload_id, filename_without_ext, render_options], sort_keys=True, default=str)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+class RenderFlight:
+    """A request's place among identical renders.
+    
+    join() returns the response of an identical render that finished while
+    waiting, or None when this request has to render; it then publish()es its
+    response. release() must always be called; requests still waiting on a
+    render that failed or was never published take over.
+    """
+    
+    def __init__(self, key):
+        self.key = key
+        self.future = None
+        self.lock_file = None
+    
+    def join(self, timeout=None):
+        expires_at = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with _flights_lock:
+                leader = _flights.get(self.key)
+                if leader is None:
+                    self.future = _flights[self.key] = Future()
+                    break
+            try:
+                shared = leader.result(timeout=None if expires_at is None else max(0.0, expires_at - time.monotonic()))
+            except FutureTimeoutError:
+                # Render without waiting any longer
+                return None
+            if shared is not None:
+                return json.loads(shared)
+            # That render failed; the next request in line renders
+        shared = self._join_workers(expires_at)
+        if shared is None:
+            return None
+        self._finish(shared)
+        return json.loads(shared)
+    
+    def _join_workers(self, expires_at):
+        """Take the key's lock across workers; returns a response another worker left meanwhile"""
+        if fcntl is None:
+            return None
+        try:
+            os.makedirs(COALESCE_DIR, exist_ok=True)
+            lock_file = open(os.path.join(COALESCE_DIR, f"{self.key}.lock"), 'a')
+        except OSError as e:
+            logger.warning(f"Could not coalesce the render with other workers: {e}")
+            return None
+        while True:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                if expires_at is not None and time.monotonic() >= expires_at:
+                    lock_file.close()
+                    return None
+                time.sleep(COALESCE_POLL_S)
+        self.lock_file = lock_file
+        return self._read_result()
+    
+    def _result_path(self):
+        return os.path.join(COALESCE_DIR, f"{self.key}.json")
+    
+    def _read_result(self):
+        path = self._result_path()
+        try:
+            if time.time() - os.path.getmtime(path) > COALESCE_WINDOW_S:
+                os.remove(path)
+                return None
+            with open(path) as f:
+                return f.read()
+        except OSError:
+            return None
+    
+    def publish(self, response, status):
+        """Share a finished render with the identical requests waiting for it"""
+        if self.future is None or self.future.done():
+            return
+        if status != 200 or response.get('partial'):
+            # Waiting requests render for themselves
+            return
+        shared = json.dumps(ensure_serializable(response))
+        if self.lock_file is not None and COALESCE_WINDOW_S > 0:
+            # Written while the lock is held, so other workers see it once they get the lock
+            path = self._result_path()
+            temp_path = f"{path}.{os.getpid()}.tmp"
+            try:
+                with open(temp_path, 'w') as f:
+                    f.write(shared)
+                os.replace(temp_path, path)
+            except OSError as e:
+                logger.warning(f"Could not share the render with other workers: {e}")
+        self._finish(shared)
+    
+    def release(self):
+        if self.lock_file is not None:
+            # Closing the file drops the flock
+            self.lock_file.close()
+            self.lock_file = None
+        if self.future is not None and not self.future.done():
+            self._finish(None)
+    
+    def _finish(self, shared):
+        with _flights_lock:
+            if _flights.get(self.key) is self.future:
+                del _flights[self.key]
+        self.future.set_result(shared)
+
+def cleanup_render_flights(max_age_hours=24):
+    """Remove old coalescing locks and responses; returns the number removed"""
+    removed = 0
+    if not os.path.isdir(COALESCE_DIR):
+        return removed
+    for name in os.listdir(COALESCE_DIR):
+        path = os.path.join(COALESCE_DIR, name)
+        try:
+            if (time.time() - os.path.getmtime(path)) / 3600 <= max_age_hours:
+                continue
+            if name.endswith('.lock') and fcntl is not None:
+                # Skip locks a render holds right now
+                with open(path, 'a') as lock_file:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    os.remove(path)
+            else:
+                os.remove(path)
+            removed += 1
+        except OSError:
+            continue
+    return removed
+
+# --- End Request Coalescing ---
+
+# --- Chunked Uploads ---
+# Large sources are sent in fixed-size chunks that can be retried and resumed:
+#   POST /uploads                        start an upload ({filename, size[, sha256]})
+#   PUT  /uploads/<id>/chunks/<index>    send one chunk (optional X-Chunk-SHA256 header)
+#   GET  /uploads/<id>                   received and missing chunks, to resume
+#   POST /uploads/<id>/finalize          render it with the same form fields as /upload;
+#                                        the upload is removed once a render of it succeeds
+# Chunks are hashed as they stream in and written straight into a preallocated
+# file, so any worker can take any chunk and no request holds a whole upload.
+
+def chunked_upload_dir(upload_id):
+    """Directory of a chunked upload, or None for an unknown or malformed id"""
+    try:
+        upload_id = uuid.UUID(hex=upload_id).hex
+    except (TypeError, ValueError):
+        return None
+    upload_dir = os.path.join(CHUNK_UPLOAD_DIR, upload_id)
+    return upload_dir if os.path.isdir(upload_dir) else None
+
+def chunked_upload_data_path(upload_id):
+    upload_dir = chunked_upload_dir(upload_id)
+    return os.path.join(upload_dir, 'data') if upload_dir else None
+
+def load_chunked_upload(upload_id):
+    """Metadata of a chunked upload plus its received chunk indexes, or None"""
+    upload_dir = chunked_upload_dir(upload_id)
+    if not upload_dir:
+        return None
+    try:
+        with open(os.path.join(upload_dir, 'meta.json')) as f:
+            meta = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+    meta['dir'] = upload_dir
+    meta['chunk_count'] = max(1, math.ceil(meta['size'] / meta['chunk_size']))
+    # One marker file per chunk, so concurrent chunk requests never rewrite shared state
+    meta['received'] = sorted(int(name) for name in os.listdir(os.path.join(upload_dir, 'chunks')) if name.isdigit())
+    return meta
+
+def chunked_upload_status(meta):
+    received = set(meta['received'])
+    return {
+        'upload_id': os.path.basename(meta['dir']),
+        'filename': meta['filename'],
+        'size': meta['size'],
+        'chunk_size': meta['chunk_size'],
+        'chunk_count': meta['chunk_count'],
+        'received': meta['received'],
+        'missing': [index for index in range(meta['chunk_count']) if index not in received],
+    }
+
+@app.route('/uploads', methods=['POST'])
+def init_chunked_upload():
+    data = request.get_json(silent=True) or {}
+    filename = secure_filename(str(data.get('filename', '')))
+    try:
+        size = int(data.get('size', 0))
+    except (TypeError, ValueError):
+        size = 0
+    if not filename or not allowed_file(filename):
+        return jsonify({'error': 'File type not allowed'}), 400
+    if size <= 0:
+        return jsonify({'error': 'Invalid file size'}), 400
+    if size > MAX_CHUNKED_UPLOAD_MB * 1024 * 1024:
+        return jsonify({'error': f'File too large (max {MAX_CHUNKED_UPLOAD_MB}MB)'}), 413
+    
+    # Chunks must fit in a single request body
+    chunk_size = min(CHUNK_SIZE_MB, max_upload_mb) * 1024 * 1024
+    upload_id = uuid.uuid4().hex
+    upload_dir = os.path.join(CHUNK_UPLOAD_DIR, upload_id)
+    os.makedirs(os.path.join(upload_dir, 'chunks'))
+    with open(os.path.join(upload_dir, 'data'), 'wb') as f:
+        f.truncate(size)
+    with open(os.path.join(upload_dir, 'meta.json'), 'w') as f:
+        json.dump({
+            'filename': filename,
+            'size': size,
+            'chunk_size': chunk_size,
+            'sha256': str(data['sha256']).lower() if data.get('sha256') else None,
+            'created': time.time(),
+        }, f)
+    
+    return jsonify(chunked_upload_status(load_chunked_upload(upload_id))), 201
+
+@app.route('/uploads/<upload_id>', methods=['GET'])
+@limiter.exempt
+def get_chunked_upload(upload_id):
+    meta = load_chunked_upload(upload_id)
+    if not meta:
+        return jsonify({'error': 'Upload not found'}), 404
+    return jsonify(chunked_upload_status(meta))
+
+@app.route('/uploads/<upload_id>/chunks/<int:index>', methods=['PUT'])
+@limiter.exempt
+def put_upload_chunk(upload_id, index):
+    meta = load_chunked_upload(upload_id)
+    if not meta:
+        return jsonify({'error': 'Upload not found'}), 404
+    if index >= meta['chunk_count']:
+        return jsonify({'error': 'Chunk index out of range'}), 400
+    
+    offset = index * meta['chunk_size']
+    expected_length = min(meta['chunk_size'], meta['size'] - offset)
+    hasher = hashlib.sha256()
+    received_length = 0
+    
+    # Stream the body straight into place while hashing it
+    with open(os.path.join(meta['dir'], 'data'), 'r+b') as f:
+        f.seek(offset)
+        while True:
+            block = request.stream.read(64 * 1024)
+            if not block:
+                break
+            received_length += len(block)
+            if received_length > expected_length:
+                return jsonify({'error': 'Chunk larger than expected'}), 400
+            hasher.update(block)
+            f.write(block)
+    
+    if received_length != expected_length:
+        return jsonify({'error': f'Incomplete chunk: received {received_length} of {expected_length} bytes'}), 400
+    digest = hasher.hexdigest()
+    expected_digest = request.headers.get('X-Chunk-SHA256')
+    if expected_digest and expected_digest.lower() != digest:
+        return jsonify({'error': 'Chunk checksum mismatch'}), 400
+    
+    # Record the chunk only once its bytes are in place
+    marker_path = os.path.join(meta['dir'], 'chunks', str(index))
+    with open(f"{marker_path}.tmp", 'w') as f:
+        f.write(digest)
+    os.replace(f"{marker_path}.tmp", marker_path)
+    return jsonify({'index': index, 'sha256': digest, 'received': len(set(meta['received']) | {index})})
+
+@app.route('/uploads/<upload_id>/finalize', methods=['POST'])
+@limiter.shared_limit(f"{UPLOAD_WORK_PER_MINUTE} per minute", scope='upload-work', cost=upload_rate_limit_cost)
+def finalize_chunked_upload(upload_id):
+    # Start the render clock as soon as the request arrives
+    deadline = RenderDeadline(get_render_deadline_seconds(request.form.get('deadline')), environ=request.environ)
+    meta = load_chunked_upload(upload_id)
+    if not meta:
+        return jsonify({'error': 'Upload not found'}), 404
+    status = chunked_upload_status(meta)
+    if status['missing']:
+        return jsonify(dict(status, error='Upload incomplete')), 409
+    
+    data_path = os.path.join(meta['dir'], 'data')
+    if meta.get('sha256'):
+        hasher = hashlib.sha256()
+        with open(data_path, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                hasher.update(block)
+        if hasher.hexdigest() != meta['sha256']:
+            return jsonify(dict(status, error='Upload checksum mismatch')), 400
+    
+    # Hand a copy of the assembled file to the regular pipeline as its working file.
+    # The upload is kept until a render of it succeeds, so a failed one can be retried.
+    fd, file_path = tempfile.mkstemp(suffix=f"_{meta['filename']}")
+    os.close(fd)
+    shutil.copyfile(data_path, file_path)
+    response = process_upload(file_path, meta['filename'], request.form, deadline)
+    if isinstance(response, Response):
+        # Streamed: the outcome is only known when the render ends
+        return discard_chunked_upload_when_done(response, meta['dir'])
+    if 200 <= response[1] < 300:
+        shutil.rmtree(meta['dir'], ignore_errors=True)
+    return response
+
+def discard_chunked_upload_when_done(response, upload_dir):
+    """Pass an NDJSON render through, removing the chunked upload if it ends with a done event"""
+    body = response.response
+    
+    def generate():
+        last_line = b''
+        for chunk in body:
+            chunk = chunk.encode('utf-8') if isinstance(chunk, str) else chunk
+            if chunk.strip():
+                last_line = chunk.rstrip(b'\n').rsplit(b'\n', 1)[-1]
+            yield chunk
+        if json.loads(last_line or b'{}').get('type') == 'done':
+            shutil.rmtree(upload_dir, ignore_errors=True)
+    
+    response.response = generate()
+    return response
+
+def cleanup_chunked_uploads(max_age_hours=24):
+    """Remove chunked uploads that were never finalized; returns the number removed"""
+    removed = 0
+    if not os.path.isdir(CHUNK_UPLOAD_DIR):
+        return removed
+    for upload_id in os.listdir(CHUNK_UPLOAD_DIR):
+        upload_dir = os.path.join(CHUNK_UPLOAD_DIR, upload_id)
+        try:
+            age_hours = (time.time() - os.path.getmtime(upload_dir)) / 3600
+        except FileNotFoundError:
+            continue
+        if age_hours > max_age_hours:
+            shutil.rmtree(upload_dir, ignore_errors=True)
+            removed += 1
+    return removed
+
+# --- End Chunked Uploads ---
+
+# --- Speculative Pre-processing ---
+# The UI calls /analyze as soon as a file is chosen. With stash=true the image
+# is stripped and stashed in storage under its SHA-256 (the upload token), and
+# the option-independent work starts in the background while the user picks
+# formats: decode, colour histogram, prominent colour and white-area analysis,
+# plus the background-removal mask when removal is requested or likely. /upload
+# then takes upload_token and filename instead of the file. Any worker can
+# resolve a token from storage; the warmed state lives in the worker that
+# stashed it.
+
+SPECULATIVE_TTL_S = env_int('BRANDKIT_SPECULATIVE_TTL_S', 900)
+SPECULATIVE_ANALYZE_WAIT_S = 10
+# Every render is stashed the same way, so /upload returns the token as a
+# durable upload_id and /render re-renders it with new options. Each entry
+# also keeps the preprocessed images of its last few option sets and its
+# recent encoded outputs: a render whose preprocessing options did not change
+# goes straight to the formats, and only changed outputs are encoded again.
+# The entries, warm-up results included, are bounded by their estimated
+# bytes, which are charged against the admission memory budget; a render short
+# of memory evicts the least recently used entries first.
+SPECULATIVE_CACHE_MB = env_int('BRANDKIT_SPECULATIVE_CACHE_MB', 256)
+UPLOAD_ID_TTL_S = env_int('BRANDKIT_UPLOAD_ID_TTL_S', 3600)
+STAGE_CACHE_SIZE = env_int('BRANDKIT_STAGE_CACHE_SIZE', 3)
+ENCODE_CACHE_SIZE = 32
+_speculative_lock = threading.Lock()
+_speculative_entries = {}
+
+def stash_key(token):
+    return f"stash/{token}"
+
+def is_upload_token(token):
+    return isinstance(token, str) and len(token) == 64 and all(c in '0123456789abcdef' for c in token)
+
+def stash_upload(file_path, background_method=None):
+    """Strip and stash an analyzed image, start warming it, and return its upload token.
+    
+    background_method is the removal method to warm a mask for, or None to
+    warm one only if the image looks like a logo on a plain background.
+    """
+    strip_image_metadata(file_path)
+    with open(file_path, 'rb') as f:
+        data = f.read()
+    return stash_image_data(data, background_method)
+
+def stash_image_data(data, background_method=None):
+    """Stash stripped image bytes under their SHA-256, start warming them, and return the token"""
+    token = hashlib.sha256(data).hexdigest()
+    storage.put(stash_key(token), data)
+    remember_stashed_image(token, data, background_method)
+    return token
+
+def remember_stashed_image(token, data, background_method=None):
+    """Return this worker's entry for a stashed image, creating and warming it if needed"""
+    with _speculative_lock:
+        entry = _speculative_entries.pop(token, None)
+        if entry is None:
+            entry = {'ready': threading.Event(), 'background_ready': threading.Event(), 'stages': {}, 'encodes': {}, 'previews': {}}
+            threading.Thread(target=contextvars.copy_context().run, args=(warm_speculative_entry, entry, data, background_method), daemon=True).start()
+        # Re-insert to keep the dict in least-recently-used order
+        _speculative_entries[token] = entry
+    trim_speculative_entries()
+    return entry
+
+def image_nbytes(image):
+    return image.width * image.height * len(image.getbands())
+
+def speculative_entry_bytes(entry):
+    """Estimated bytes held by an entry: its warm-up results and its stage, encode and preview caches"""
+    total = image_nbytes(entry['image']) if entry.get('image') is not None else 0
+    if entry.get('histogram') is not None:
+        total += sum(array.nbytes for array in entry['histogram'])
+    with _overlay_cache_lock:
+        total += sum(image_nbytes(image) for image in entry['stages'].values())
+        total += sum(len(data or b'') for data, _ in entry['encodes'].values())
+        total += sum(len(data) for data in entry['previews'].values())
+    return total
+
+def trim_speculative_entries(max_bytes=None):
+    """Evict least recently used entries until they fit max_bytes (SPECULATIVE_CACHE_MB by default).
+    
+    Reports what is kept to the admission controller and returns it in bytes.
+    An evicted entry's memory is freed once renders using it finish.
+    """
+    if max_bytes is None:
+        max_bytes = SPECULATIVE_CACHE_MB * 1024 * 1024
+    with _speculative_lock:
+        sizes = {token: speculative_entry_bytes(entry) for token, entry in _speculative_entries.items()}
+        total = sum(sizes.values())
+        for token, size in sizes.items():
+            if total <= max_bytes:
+                break
+            del _speculative_entries[token]
+            total -= size
+    admission_controller.set_cache_memory(int(math.ceil(total / (1024 * 1024))))
+    return total
+
+def reclaim_speculative_memory(mb):
+    """Admission reclaim hook: evict entries holding at least mb MB"""
+    trim_speculative_entries(max(0, admission_controller.cache_memory_mb - mb) * 1024 * 1024)
+
+admission_controller.reclaim = reclaim_speculative_memory
+
+def warm_speculative_entry(entry, data, background_method=None):
+    """Decode and analyze a stashed image, then warm its background-removal mask"""
+    try:
+        image = Image.open(io.BytesIO(data))
+        if image.mode != 'RGBA':
+            image = image.convert('RGBA')
+        histogram = color_histogram(image)
+        has_white_area, white_area_ratio = has_significant_white_area(image)
+        entry['image'] = image
+        entry['histogram'] = histogram
+        entry['analysis'] = {
+            'prominent_color': get_prominent_color(image, histogram=histogram),
+            'has_white_area': bool(has_white_area),
+            'white_area_ratio': float(white_area_ratio)
+        }
+        trim_speculative_entries()
+    except Exception as e:
+        logger.exception(f"Speculative decode failed: {e}")
+        entry['background_ready'].set()
+        return
+    finally:
+        entry['ready'].set()
+    
+    try:
+        # An opaque image on a plain background is the usual candidate for removal
+        if background_method is None and image.getchannel('A').getextrema()[0] == 255 and has_white_area:
+            background_method = 'auto'
+        if background_method and REMBG_AVAILABLE:
+            entry['background_method'] = background_method
+            # Only use spare capacity; real renders are never queued behind speculation
+            with admission_controller.admit({'work': BG_REMOVAL_WORK, 'memory_mb': BG_REMOVAL_MEMORY_MB}, timeout=0):
+                # The mask stays in the background mask cache for the render to reuse
+                remove_background(image, method=background_method)
+            entry['background_warmed'] = background_method
+    except AdmissionRejected:
+        logger.info("Skipping speculative background removal, server busy")
+    except TimeoutError as e:
+        logger.warning(f"Speculative background removal timed out: {e}")
+    except Exception as e:
+        logger.exception(f"Speculative background removal failed: {e}")
+    finally:
+        entry['background_ready'].set()
+
+def get_speculative_entry(token):
+    with _speculative_lock:
+        return _speculative_entries.get(token)
+
+def wait_for_speculative_entry(entry, deadline, preprocessing_options):
+    """Wait (within the deadline) for warming a render will reuse; returns the entry"""
+    entry['ready'].wait(deadline.remaining())
+    if (preprocessing_options.get('remove_background') and
+            preprocessing_options.get('background_removal_method', 'auto') == entry.get('background_method')):
+        # Running the model again would take longer than waiting for the warm-up
+        entry['background_ready'].wait(deadline.remaining())
+    return entry
+
+def process_stashed_upload(token, form, deadline, ttl=SPECULATIVE_TTL_S):
+    """Render a stashed image referenced by its upload token (or upload id)"""
+    if not is_upload_token(token):
+        return jsonify({'error': 'Invalid upload token'}), 400
+    stat = storage.stat(stash_key(token))
+    data = storage.get(stash_key(token)) if stat and time.time() - stat[1] <= ttl else None
+    if data is None:
+        # The client falls back to sending the file
+        return jsonify({'error': 'Upload token expired', 'token_expired': True}), 410
+    
+    entry = get_speculative_entry(token)
+    filename = secure_filename(form.get('filename') or (entry or {}).get('filename', ''))
+    if not filename or not allowed_file(filename):
+        return jsonify({'error': 'File type not allowed'}), 400
+    
+    fd, file_path = tempfile.mkstemp(suffix=f"_{filename}")
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    if entry is None:
+        # Stashed by another worker; decode it here so later renders find it warm
+        remember_stashed_image(token, data, background_method=False)
+    return process_upload(file_path, filename, form, deadline, upload_id=token)
+
+def preprocess_stage(original, options, deadline=None, stage_cache=None):
+    """preprocess_image, memoized per option set in an upload's stage cache.
+    
+    The cached image is shared between renders and must not be modified.
+    """
+    if stage_cache is None:
+        return preprocess_image(original.copy(), options, deadline=deadline)
+    key = json.dumps(options, sort_keys=True, default=str)
+    processed = _cache_get(stage_cache, key)
+    if processed is None:
+        processed = _cache_put(stage_cache, key, preprocess_image(original.copy(), options, deadline=deadline), max_size=STAGE_CACHE_SIZE)
+    return processed
+
+def has_cached_stage(entry, options):
+    """Whether an upload's stage cache already holds the preprocessed image for options"""
+    return bool(entry) and json.dumps(options, sort_keys=True, default=str) in entry.get('stages', {})
+
+# --- End Speculative Pre-processing ---
+
+# --- Live Preview ---
+# GET /preview?upload_id=...&<preprocessing options> applies the options to a
+# PREVIEW_EDGE proxy of a stashed upload and returns a small WebP, so sliders
+# can be tuned without a render. Previews run in their own small thread pool
+# outside admission control, so full renders cannot queue them. A newer preview
+# of the same upload cancels one that has not started yet (204), and results
+# are cached per upload and carry an ETag for the browser cache. Pixel-sized
+# options are scaled to the proxy; the background cutout of the proxy is
+# computed once per method.
+
+PREVIEW_EDGE = 512
+PREVIEW_WORKERS = env_int('BRANDKIT_PREVIEW_WORKERS', 2)
+PREVIEW_PER_MINUTE = env_int('BRANDKIT_PREVIEW_PER_MINUTE', 600)
+PREVIEW_TIMEOUT_S = 10
+PREVIEW_CACHE_SIZE = 32
+PREVIEW_PIXEL_OPTIONS = ('blur_radius', 'sharpen_radius', 'smooth_radius', 'crop_padding', 'shadow_blur')
+_preview_executor = ThreadPoolExecutor(max_workers=PREVIEW_WORKERS, thread_name_prefix='preview')
+_preview_lock = threading.Lock()
+_preview_pending = {}
+
+def preview_proxy(entry, background_method=None):
+    """The upload's PREVIEW_EDGE proxy, with its background removed when a method is given"""
+    proxies = entry.setdefault('preview_proxies', {})
+    proxy = proxies.get(background_method)
+    if proxy is None:
+        if background_method:
+            proxy = remove_background(preview_proxy(entry), method=background_method)
+        else:
+            proxy = get_kernels().thumbnail(entry['image'], (PREVIEW_EDGE, PREVIEW_EDGE))
+        proxies[background_method] = proxy
+    return proxy
+
+def scale_pixel_options(options, scale):
+    """Scale options measured in pixels by scale, keeping their types"""
+    scaled = dict(options)
+    for name in PREVIEW_PIXEL_OPTIONS:
+        scaled[name] = type(options[name])(options[name] * scale)
+    scaled['shadow_offset'] = tuple(int(round(v * scale)) for v in options['shadow_offset'])
+    return scaled
+
+def render_preview(entry, options):
+    """Encode a WebP preview of an upload with preprocessing options applied"""
+    entry['ready'].wait(PREVIEW_TIMEOUT_S)
+    if entry.get('image') is None:
+        raise ValueError('Could not decode the uploaded image')
+    background_method = options.get('background_removal_method', 'auto') if options.get('remove_background') and REMBG_AVAILABLE else None
+    proxy = preview_proxy(entry, background_method)
+    # The background is already removed from the proxy
+    preview_options = scale_pixel_options(dict(options, remove_background=False), proxy.width / entry['image'].width)
+    preview = preprocess_image(proxy.copy(), preview_options)
+    return encode_image_bytes(preview, {'format': 'WEBP', 'quality': 80, 'method': 0})
+
+@app.route('/preview', methods=['GET'])
+@limiter.limit(f"{PREVIEW_PER_MINUTE} per minute")
+def preview_upload():
+    upload_id = request.args.get('upload_id')
+    if not is_upload_token(upload_id):
+        return jsonify({'error': 'Invalid upload id'}), 400
+    entry = get_speculative_entry(upload_id)
+    if entry is None:
+        stat = storage.stat(stash_key(upload_id))
+        data = storage.get(stash_key(upload_id)) if stat and time.time() - stat[1] <= UPLOAD_ID_TTL_S else None
+        if data is None:
+            return jsonify({'error': 'Upload id expired', 'token_expired': True}), 410
+        entry = remember_stashed_image(upload_id, data, background_method=False)
+    try:
+        options = parse_render_options(request.args, load_config())['preprocessing_options']
+    except ValueError as ve:
+        return jsonify({'error': str(ve)}), 400
+    
+    options_key = json.dumps(options, sort_keys=True)
+    etag = hashlib.blake2b(f"{upload_id}:{options_key}".encode(), digest_size=16).hexdigest()
+    if etag in request.if_none_match:
+        return Response(status=304, headers={'ETag': f'"{etag}"'})
+    
+    previews = entry['previews']
+    data = _cache_get(previews, options_key)
+    if data is None:
+        with _preview_lock:
+            # Only the latest position of a slider is worth rendering
+            superseded = _preview_pending.get(upload_id)
+            if superseded:
+                superseded.cancel()
+            future = _preview_executor.submit(contextvars.copy_context().run, render_preview, entry, options)
+            _preview_pending[upload_id] = future
+        try:
+            data = future.result(timeout=PREVIEW_TIMEOUT_S)
+        except CancelledError:
+            return Response(status=204)
+        except FutureTimeoutError:
+            return jsonify({'error': 'Preview timed out'}), 503
         except ValueError as ve:
-            print(f"Value Error during processing: {ve}")
             return jsonify({'error': str(ve)}), 400
         except Exception as e:
-            print(f"An unexpected error occurred: {e}")
-            import traceback
-            traceback.print_exc()
-            return jsonify({'error': 'An unexpected error occurred during processing.'}), 500
-    except Exception as e:
-        logging.error(f"Upload error: {e}")
-        return jsonify({'error': f'Server error: {str(e)}'}), 500
+            logger.exception(f"Preview failed: {e}")
+            return jsonify({'error': 'Could not render the preview'}), 500
+        finally:
+            with _preview_lock:
+                if _preview_pending.get(upload_id) is future:
+                    del _preview_pending[upload_id]
+        _cache_put(previews, options_key, data, max_size=PREVIEW_CACHE_SIZE)
+        trim_speculative_entries()
+    
+    response = Response(data, mimetype='image/webp')
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, max-age=3600'
+    return response
+
+# --- End Live Preview ---
 
 def save_to_cache(img, cache_key, width, height):
     """Save a processed image to cache"""
-    cache_dir = os.path.join(app.config['UPLOAD_FOLDER'], 'cache')
-    os.makedirs(cache_dir, exist_ok=True)
-    
-    cache_path = os.path.join(cache_dir, f"{cache_key}_{width}x{height}.png")
     try:
-        img.save(cache_path, "PNG")
+        save_image_to_storage(img, f"cache/{cache_key}_{width}x{height}.png")
     except Exception as e:
-        print(f"Error saving to cache: {e}")
+        logger.error(f"Error saving to cache: {e}")
 
 def get_from_cache(cache_key, width, height):
     """Try to get a processed image from cache"""
-    cache_dir = os.path.join(app.config['UPLOAD_FOLDER'], 'cache')
-    cache_path = os.path.join(cache_dir, f"{cache_key}_{width}x{height}.png")
+    cache_key = f"cache/{cache_key}_{width}x{height}.png"
+    stat = storage.stat(cache_key)
     
-    if os.path.exists(cache_path):
+    if stat:
         try:
             # Check if file is not too old (24 hours)
-            file_age = datetime.now() - datetime.fromtimestamp(os.path.getmtime(cache_path))
-            if file_age.total_seconds() < 86400:  # 24 hours in seconds
-                return Image.open(cache_path)
+            file_age = time.time() - stat[1]
+            data = storage.get(cache_key) if file_age < 86400 else None  # 24 hours in seconds
+            if data is not None:
+                return Image.open(io.BytesIO(data))
         except Exception as e:
-            print(f"Error retrieving from cache: {e}")
+            logger.error(f"Error retrieving from cache: {e}")
     
     return None
 
@@ -611,12 +2590,232 @@ def generate_cache_key(original_path, preprocessing_options):
         options_hash = hashlib.md5(json.dumps(preprocessing_options, sort_keys=True).encode()).hexdigest()
         return f"{file_hash}_{options_hash[:10]}"
     except Exception as e:
-        print(f"Error generating cache key: {e}")
+        logger.error(f"Error generating cache key: {e}")
         # Fallback to a timestamp-based key 
         return f"fallback_{int(time.time())}"
 
-def generate_formats(original_path, filename_without_ext, selected_formats, output_formats, preprocessing_options, variations_mode=False, fill_white_with_prominent=True, quality=95, strip_metadata=False):
-    """Generate image formats with comprehensive error handling"""
+def uses_gradient_fill(dimensions, is_square, fill_white_with_prominent):
+    """Whether a format is filled with the prominent-colour radial gradient"""
+    return not is_square and dimensions[0] != dimensions[1] and fill_white_with_prominent
+
+def render_format_image(image, dimensions, is_square, prominent_color, fill_white_with_prominent):
+    """Resize an image to fit the target dimensions and place it on a canvas of that size"""
+    # Resize the image maintaining aspect ratio
+    img_copy = get_kernels().thumbnail(image, dimensions)
+    paste_pos = ((dimensions[0] - img_copy.width) // 2, (dimensions[1] - img_copy.height) // 2)
+    
+    # Apply smart fill if appropriate
+    if uses_gradient_fill(dimensions, is_square, fill_white_with_prominent):
+        center_color = darken_color(prominent_color, 0.7)
+        edge_color = prominent_color
+        bg = create_radial_gradient(dimensions, center_color, edge_color)
+        bg.paste(img_copy, paste_pos, img_copy)
+        return bg
+    
+    # Check if the preprocessed image has a background color applied
+    # If it does, preserve it; otherwise use transparent background
+    if img_copy.mode == 'RGBA':
+        # Check if image has transparency after preprocessing
+        alpha_range = img_copy.getchannel('A').getextrema()
+        has_transparency = alpha_range[0] < 255
+        
+        if has_transparency:
+            # Image still has transparency, use transparent background
+            new_img = Image.new("RGBA", dimensions, (0, 0, 0, 0))
+            new_img.paste(img_copy, paste_pos, img_copy)
+        else:
+            # Image has no transparency (background color was applied), preserve it
+            # Create background with the same color as the processed image
+            # Sample the background color from a corner pixel
+            bg_color = img_copy.getpixel((0, 0))[:3]  # Get RGB, ignore alpha
+            new_img = Image.new("RGBA", dimensions, bg_color + (255,))
+            new_img.paste(img_copy, paste_pos)
+    else:
+        # Not RGBA, paste normally
+        new_img = Image.new("RGBA", dimensions, (0, 0, 0, 0))
+        new_img.paste(img_copy, paste_pos)
+    return new_img
+
+def group_formats_by_geometry(formats_to_generate, is_square, fill_white_with_prominent):
+    """Group format names that render to identical pixels (same size and fill mode)"""
+    groups = {}
+    for format_name, format_config in formats_to_generate.items():
+        dimensions = (format_config['width'], format_config['height'])
+        gradient_fill = uses_gradient_fill(dimensions, is_square, fill_white_with_prominent)
+        groups.setdefault((dimensions, gradient_fill), []).append(format_name)
+    return groups
+
+# Long side of the WebP previews the results gallery shows instead of the outputs
+THUMBNAIL_EDGE = 128
+
+def save_thumbnail(image, key, encode_cache=None, reuse_key=None):
+    """Store a small WebP preview of a rendered format and return its output entry"""
+    reused = _cache_get(encode_cache, reuse_key) if encode_cache is not None else None
+    if reused:
+        data, encode_info = reused
+    else:
+        thumbnail = get_kernels().thumbnail(image, (THUMBNAIL_EDGE, THUMBNAIL_EDGE))
+        if thumbnail.mode not in ('RGB', 'RGBA'):
+            thumbnail = thumbnail.convert('RGBA')
+        data = encode_image_bytes(thumbnail, {'format': 'WEBP', 'quality': 75, 'method': 0})
+        encode_info = {'bytes': len(data)}
+        if encode_cache is not None:
+            _cache_put(encode_cache, reuse_key, (data, encode_info), max_size=ENCODE_CACHE_SIZE)
+    storage.put(key, data)
+    return {**output_entry(key), **encode_info}
+
+def render_formats(processed_image, formats_to_generate, output_formats, filename_prefix, cache_key, is_square, prominent_color, fill_white_with_prominent=True, quality=95, strip_metadata=False, skip_formats=(), deadline=None, palette_min_psnr=None, encode_cache=None, thumbnails=True, animation=None, on_result=None):
+    """Render and encode every format for one processed image.
+    
+    Formats sharing the same geometry are rendered and encoded once; the other
+    format names get hardlinks to the same bytes and are marked with 'alias_of'.
+    Stops early, returning what was rendered so far, once the deadline expires.
+    PNG and ICO outputs are palette-quantized when palette_min_psnr is set.
+    encode_cache keeps encoded bytes across renders of one upload, so only
+    outputs whose pixels or encoder settings changed are encoded again.
+    With thumbnails, each result gets a small WebP 'thumbnail' for the gallery.
+    With animation (from probe_animation, plus the source path and options),
+    GIF and WebP outputs are animated; processed_image is its first frame.
+    on_result(format_name, result) is called as each format is finished.
+    """
+    results = {}
+    formats_to_render = {k: v for k, v in formats_to_generate.items() if k not in skip_formats}
+    animated_formats = [fmt.lower() for fmt in output_formats if fmt.lower() in ANIMATED_OUTPUT_FORMATS] if animation else []
+    geometry_groups = group_formats_by_geometry(formats_to_render, is_square, fill_white_with_prominent)
+    
+    for (dimensions, gradient_fill), format_names in geometry_groups.items():
+        if deadline is not None and deadline.expired():
+            break
+        try:
+            # Check cache first
+            cached_img = get_from_cache(cache_key, dimensions[0], dimensions[1])
+            
+            if cached_img:
+                new_img = cached_img
+            else:
+                new_img = render_format_image(processed_image, dimensions, is_square, prominent_color, fill_white_with_prominent)
+                # Save to cache for future use
+                save_to_cache(new_img, cache_key, dimensions[0], dimensions[1])
+        except Exception as e:
+            logger.exception(f"Error processing format {', '.join(format_names)} ({filename_prefix}): {e}")
+            continue
+        
+        # Gallery preview, shared by every format of this geometry
+        thumbnail = None
+        if thumbnails:
+            try:
+                thumbnail = save_thumbnail(new_img, f"{filename_prefix}_{format_names[0]}.thumb.webp", encode_cache, (cache_key, dimensions, 'thumbnail'))
+            except Exception as e:
+                logger.exception(f"Error creating thumbnail for {filename_prefix} {format_names[0]}: {e}")
+        
+        # Encoded files for this geometry: output format -> (path, format name)
+        encoded_outputs = {}
+        # Animated outputs of this geometry, encoded together on first use
+        animated_data = None
+        
+        for format_name in format_names:
+            format_results = {}
+            alias_of = None
+            
+            # Save in each requested output format
+            for output_format in output_formats:
+                try:
+                    output_format_lower = output_format.lower()
+                    
+                    # Skip ICO format except for favicon
+                    if output_format_lower == 'ico' and format_name != 'favicon':
+                        continue
+                    
+                    output_key = f"{filename_prefix}_{format_name}.{output_format_lower}"
+                    
+                    # Formats with a byte budget or quality floor get their own JPEG/WebP encode
+                    target = None
+                    animated = output_format_lower in animated_formats
+                    if output_format_lower in TARGET_ENCODING_FORMATS and not animated:
+                        target = get_encoding_target(formats_to_generate[format_name])
+                    encode_key = (output_format_lower, 'animated' if animated else target)
+                    
+                    # The cache key covers the source pixels and preprocessing options
+                    reuse_key = (cache_key, dimensions, encode_key, quality, strip_metadata)
+                    reused = _cache_get(encode_cache, reuse_key) if encode_cache is not None and output_format_lower != 'ico' else None
+                    
+                    if encode_key in encoded_outputs:
+                        # Same pixels already encoded for another format, reuse the bytes
+                        source_key, alias_of, encode_info = encoded_outputs[encode_key]
+                        storage.link(source_key, output_key)
+                    elif reused:
+                        # Encoded by an earlier render of this upload
+                        data, encode_info = reused
+                        storage.put(output_key, data)
+                        encoded_outputs[encode_key] = (output_key, format_name, encode_info)
+                    else:
+                        # Apply format-specific optimizations
+                        save_img, save_opts = optimize_image(new_img, output_format, quality, strip_metadata)
+                        
+                        use_palette = palette_min_psnr is not None and not gradient_fill
+                        data = None
+                        if animated:
+                            if animated_data is None:
+                                # Left empty if encoding fails, so aliases of this geometry do not retry it
+                                animated_data = {}
+                                canvas = animation_canvas(processed_image, dimensions, is_square, prominent_color, fill_white_with_prominent)
+                                animated_data = encode_animation(animation, canvas, animated_formats, quality, deadline)
+                            data = animated_data[output_format_lower]
+                            encode_info = {'bytes': len(data), 'frames': len(animation['durations'])}
+                        elif target:
+                            data, encode_info = encode_to_target(save_img, output_format_lower, save_opts, *target)
+                        elif output_format_lower == 'ico':
+                            size, palette = save_ico(save_img, output_key, palette_min_psnr=palette_min_psnr if use_palette else None)
+                            encode_info = {'bytes': size, 'palette': True} if palette else {'bytes': size}
+                        elif output_format_lower == 'png' and use_palette:
+                            paletted = quantize_palette(save_img, palette_min_psnr)
+                            data = encode_for_key(paletted or save_img, output_key, **save_opts)
+                            encode_info = {'bytes': len(data), 'palette': True} if paletted else {'bytes': len(data)}
+                        else:
+                            # Save with optimized parameters
+                            data = encode_for_key(save_img, output_key, **save_opts)
+                            encode_info = {'bytes': len(data)}
+                        if data is not None:
+                            storage.put(output_key, data)
+                            if encode_cache is not None:
+                                _cache_put(encode_cache, reuse_key, (data, encode_info), max_size=ENCODE_CACHE_SIZE)
+                        encoded_outputs[encode_key] = (output_key, format_name, encode_info)
+                    
+                    format_results[output_format] = {**output_entry(output_key), **encode_info}
+                except RenderDeadlineExceeded:
+                    break
+                except Exception as e:
+                    logger.exception(f"Error saving {filename_prefix} {format_name} as {output_format}: {e}")
+            
+            # Add to results if any formats were successfully saved
+            if format_results:
+                results[format_name] = {
+                    'outputs': format_results,
+                    'dimensions': dimensions,
+                    'description': formats_to_generate[format_name].get('description', '')
+                }
+                if alias_of:
+                    results[format_name]['alias_of'] = alias_of
+                if thumbnail:
+                    results[format_name]['thumbnail'] = thumbnail
+                if on_result:
+                    on_result(format_name, results[format_name])
+    
+    # Keep the configured format order
+    return {name: results[name] for name in formats_to_generate if name in results}
+
+def generate_formats(original_path, filename_without_ext, selected_formats, output_formats, preprocessing_options, variations_mode=False, fill_white_with_prominent=True, quality=95, strip_metadata=False, deadline=None, source_image=None, histogram=None, stage_cache=None, encode_cache=None, thumbnails=True, on_result=None):
+    """Generate image formats with comprehensive error handling
+    
+    If a RenderDeadline is given it is checked between variations and formats;
+    when it expires the results rendered so far are returned and
+    deadline.reason says why the render stopped. source_image (the decoded RGBA
+    original) and its colour histogram may be passed when already computed.
+    stage_cache memoizes the standard-mode preprocessed image and encode_cache
+    the encoded outputs across renders of one upload. thumbnails adds gallery
+    previews to the results.
+    on_result(key, result, variation) is called as each format is finished.
+    """
     config = load_config()
     all_available_formats = config['formats']
     formats_to_generate = {k: v for k, v in all_available_formats.items() if k in selected_formats}
@@ -625,34 +2824,49 @@ def generate_formats(original_path, filename_without_ext, selected_formats, outp
     try:
         # Open and validate original image
         try:
-            original = Image.open(original_path)
+            original = source_image if source_image is not None else Image.open(original_path)
             # Convert to RGBA to ensure consistent processing
             if original.mode != 'RGBA':
                 original = original.convert('RGBA')
         except Exception as e:
-            print(f"Error opening image: {e}")
-            import traceback
-            traceback.print_exc()
+            logger.exception(f"Error opening image: {e}")
             raise ValueError(f"Could not open or process the uploaded image: {str(e)}")
             
         # Check if image is square for smart fill feature
         is_square = original.width == original.height
         
-        # Get prominent color for smart fill
+        # Get prominent color for smart fill; the histogram also detects flat-colour logos
+        palette_min_psnr = None
         try:
-            prominent_color = get_prominent_color(original)
+            if histogram is None:
+                histogram = color_histogram(original)
+            prominent_color = get_prominent_color(original, histogram=histogram)
+            if config.get('palette_png', True) and is_low_color(histogram):
+                palette_min_psnr = float(config.get('palette_min_psnr', 40))
         except Exception as e:
-            print(f"Error getting prominent color: {e}")
-            import traceback
-            traceback.print_exc()
+            logger.exception(f"Error getting prominent color: {e}")
             prominent_color = [200, 200, 200]  # Default color
         
+        render_options = {
+            'is_square': is_square,
+            'prominent_color': prominent_color,
+            'fill_white_with_prominent': fill_white_with_prominent,
+            'quality': quality,
+            'strip_metadata': strip_metadata,
+            'deadline': deadline,
+            'palette_min_psnr': palette_min_psnr,
+            'encode_cache': encode_cache,
+            'thumbnails': thumbnails,
+        }
+        
         # Process in variations mode
         if variations_mode:
             variations_results = {}
             variation_definitions = generate_variations()
             
             for variation in variation_definitions:
+                if deadline is not None and deadline.expired():
+                    break
                 variation_label = variation['label']
                 try:
                     # Combine base options with variation-specific options
@@ -661,289 +2875,701 @@ def generate_formats(original_path, filename_without_ext, selected_formats, outp
                         combined_options[opt_key] = opt_value
                     
                     # Process the image with this variation's options
-                    variation_img = preprocess_image(original.copy(), combined_options)
+                    variation_img = preprocess_image(original.copy(), combined_options, deadline=deadline)
                     
                     # Generate formats for this variation
-                    variation_data = {}
-                    
-                    for format_name, format_config in formats_to_generate.items():
-                        try:
-                            dimensions = (format_config['width'], format_config['height'])
-                            img_copy = variation_img.copy()
-                            
-                            # Check cache first
-                            cache_key = generate_cache_key(original_path, preprocessing_options)
-                            cached_img = get_from_cache(cache_key, dimensions[0], dimensions[1])
-                            
-                            if cached_img:
-                                new_img = cached_img
-                            else:
-                                # Resize the image maintaining aspect ratio
-                                img_copy.thumbnail(dimensions, Image.LANCZOS)
-                                
-                                # Apply smart fill if appropriate
-                                if not is_square and dimensions[0] != dimensions[1] and fill_white_with_prominent:
-                                    center_color = darken_color(prominent_color, 0.7)
-                                    edge_color = prominent_color
-                                    bg = create_radial_gradient(dimensions, center_color, edge_color)
-                                    paste_pos = ((dimensions[0] - img_copy.width) // 2, (dimensions[1] - img_copy.height) // 2)
-                                    bg.paste(img_copy, paste_pos, img_copy)
-                                    new_img = bg
-                                else:
-                                    # Check if the preprocessed image has a background color applied
-                                    # If it does, preserve it; otherwise use transparent background
-                                    if img_copy.mode == 'RGBA':
-                                        # Check if image has transparency after preprocessing
-                                        alpha_range = img_copy.getchannel('A').getextrema()
-                                        has_transparency = alpha_range[0] < 255
-                                        
-                                        if has_transparency:
-                                            # Image still has transparency, use transparent background
-                                            new_img = Image.new("RGBA", dimensions, (0, 0, 0, 0))
-                                            paste_pos = ((dimensions[0] - img_copy.width) // 2, (dimensions[1] - img_copy.height) // 2)
-                                            new_img.paste(img_copy, paste_pos, img_copy)
-                                        else:
-                                            # Image has no transparency (background color was applied), preserve it
-                                            # Create background with the same color as the processed image
-                                            # Sample the background color from a corner pixel
-                                            bg_color = img_copy.getpixel((0, 0))[:3]  # Get RGB, ignore alpha
-                                            new_img = Image.new("RGBA", dimensions, bg_color + (255,))
-                                            paste_pos = ((dimensions[0] - img_copy.width) // 2, (dimensions[1] - img_copy.height) // 2)
-                                            new_img.paste(img_copy, paste_pos)
-                                    else:
-                                        # Not RGBA, paste normally
-                                        new_img = Image.new("RGBA", dimensions, (0, 0, 0, 0))
-                                        paste_pos = ((dimensions[0] - img_copy.width) // 2, (dimensions[1] - img_copy.height) // 2)
-                                        new_img.paste(img_copy, paste_pos)
-                                        
-                                # Save to cache for future use
-                                save_to_cache(new_img, cache_key, dimensions[0], dimensions[1])
-                            
-                            # Save in each requested output format
-                            format_results = {}
-                            for output_format in output_formats:
-                                try:
-                                    output_format_lower = output_format.lower()
-                                    
-                                    # Skip ICO format except for favicon
-                                    if output_format_lower == 'ico' and format_name != 'favicon':
-                                        continue
-                                    
-                                    variation_filename = f"{filename_without_ext}_{variation_label}_{format_name}.{output_format_lower}"
-                                    output_path = os.path.join(app.config['UPLOAD_FOLDER'], variation_filename)
-                                    
-                                    # Apply format-specific optimizations
-                                    save_img, save_opts = optimize_image(new_img, output_format, quality, strip_metadata)
-                                    
-                                    # Save with optimized parameters
-                                    save_img.save(output_path, **save_opts)
-                                    
-                                    format_results[output_format] = {
-                                        'path': output_path,
-                                        'url': f"/{app.config['UPLOAD_FOLDER']}/{variation_filename}",
-                                    }
-                                except Exception as e:
-                                    print(f"Error saving {variation_label} {format_name} as {output_format}: {e}")
-                                    import traceback
-                                    traceback.print_exc()
-                            
-                            # Add to results if any formats were successfully saved
-                            if format_results:
-                                variation_data[format_name] = {
-                                    'outputs': format_results,
-                                    'dimensions': dimensions,
-                                    'description': format_config.get('description', '')
-                                }
-                        except Exception as e:
-                            print(f"Error processing format {format_name} for variation {variation_label}: {e}")
-                            import traceback
-                            traceback.print_exc()
+                    cache_key = generate_cache_key(original_path, dict(combined_options, fill_white_with_prominent=fill_white_with_prominent))
+                    variation_data = render_formats(
+                        variation_img,
+                        formats_to_generate,
+                        output_formats,
+                        f"{filename_without_ext}_{variation_label}",
+                        cache_key,
+                        on_result=(lambda name, result, label=variation_label: on_result(name, result, label)) if on_result else None,
+                        **render_options
+                    )
                     
                     if variation_data:
                         variations_results[variation_label] = variation_data
                 
+                except RenderDeadlineExceeded:
+                    break
                 except Exception as e:
-                    print(f"Error processing variation {variation_label}: {e}")
-                    import traceback
-                    traceback.print_exc()
+                    logger.exception(f"Error processing variation {variation_label}: {e}")
             
             # If we have any variations, add them to the results
             if variations_results:
                 results['variations'] = variations_results
             
             # Also generate favicon in variations mode if requested
-            if 'favicon' in selected_formats and 'ico' in output_formats:
+            if 'favicon' in selected_formats and 'ico' in output_formats and not (deadline and deadline.expired()):
                 try:
                     # Use the "Original" variation settings for favicon
                     original_opts = next((v['opts'] for v in variation_definitions if v['label'] == 'Original'), {})
                     favicon_img = preprocess_image(original.copy(), original_opts)
-                    results['favicon_ico'] = create_favicon(favicon_img, filename_without_ext)
+                    results['favicon_ico'] = create_favicon(favicon_img, filename_without_ext, palette_min_psnr)
+                    if on_result:
+                        on_result('favicon_ico', results['favicon_ico'])
                 except Exception as e:
-                    print(f"Error creating favicon in variations mode: {e}")
-                    import traceback
-                    traceback.print_exc()
+                    logger.exception(f"Error creating favicon in variations mode: {e}")
         
         # Process in standard mode
         else:
             try:
-                processed_image = preprocess_image(original.copy(), preprocessing_options)
+                processed_image = preprocess_stage(original, preprocessing_options, deadline=deadline, stage_cache=stage_cache)
+            except RenderDeadlineExceeded:
+                return results
             except Exception as e:
-                print(f"Error during initial preprocessing: {e}")
-                import traceback
-                traceback.print_exc()
+                logger.exception(f"Error during initial preprocessing: {e}")
                 raise ValueError(f"Could not preprocess the image with selected options: {str(e)}")
                 
             # Generate favicon if requested
             if 'favicon' in selected_formats and 'ico' in output_formats:
                 try:
-                    results['favicon_ico'] = create_favicon(processed_image.copy(), filename_without_ext)
+                    results['favicon_ico'] = create_favicon(processed_image.copy(), filename_without_ext, palette_min_psnr)
+                    if on_result:
+                        on_result('favicon_ico', results['favicon_ico'])
                 except Exception as e:
-                    print(f"Error creating favicon: {e}")
-                    import traceback
-                    traceback.print_exc()
+                    logger.exception(f"Error creating favicon: {e}")
                     
-            # Process each selected format
-            for format_name, format_config in formats_to_generate.items():
+            # Animated sources keep their frames in GIF and WebP outputs
+            animation = None
+            if any(fmt.lower() in ANIMATED_OUTPUT_FORMATS for fmt in output_formats):
                 try:
-                    # Skip favicon if already created
-                    if format_name == 'favicon' and 'favicon_ico' in results:
-                        continue
-                        
-                    dimensions = (format_config['width'], format_config['height'])
-                    img_copy = processed_image.copy()
-                    
-                    # Check cache first
-                    cache_key = generate_cache_key(original_path, preprocessing_options)
-                    cached_img = get_from_cache(cache_key, dimensions[0], dimensions[1])
-                    
-                    if cached_img:
-                        new_img = cached_img
-                    else:
-                        # Resize the image maintaining aspect ratio
-                        img_copy.thumbnail(dimensions, Image.LANCZOS)
-                        
-                        # Apply smart fill if appropriate
-                        if not is_square and dimensions[0] != dimensions[1] and fill_white_with_prominent:
-                            center_color = darken_color(prominent_color, 0.7)
-                            edge_color = prominent_color
-                            bg = create_radial_gradient(dimensions, center_color, edge_color)
-                            paste_pos = ((dimensions[0] - img_copy.width) // 2, (dimensions[1] - img_copy.height) // 2)
-                            bg.paste(img_copy, paste_pos, img_copy)
-                            new_img = bg
-                        else:
-                            # Check if the preprocessed image has a background color applied
-                            # If it does, preserve it; otherwise use transparent background
-                            if img_copy.mode == 'RGBA':
-                                # Check if image has transparency after preprocessing
-                                alpha_range = img_copy.getchannel('A').getextrema()
-                                has_transparency = alpha_range[0] < 255
-                                
-                                if has_transparency:
-                                    # Image still has transparency, use transparent background
-                                    new_img = Image.new("RGBA", dimensions, (0, 0, 0, 0))
-                                    paste_pos = ((dimensions[0] - img_copy.width) // 2, (dimensions[1] - img_copy.height) // 2)
-                                    new_img.paste(img_copy, paste_pos, img_copy)
-                                else:
-                                    # Image has no transparency (background color was applied), preserve it
-                                    # Create background with the same color as the processed image
-                                    # Sample the background color from a corner pixel
-                                    bg_color = img_copy.getpixel((0, 0))[:3]  # Get RGB, ignore alpha
-                                    new_img = Image.new("RGBA", dimensions, bg_color + (255,))
-                                    paste_pos = ((dimensions[0] - img_copy.width) // 2, (dimensions[1] - img_copy.height) // 2)
-                                    new_img.paste(img_copy, paste_pos)
-                            else:
-                                # Not RGBA, paste normally
-                                new_img = Image.new("RGBA", dimensions, (0, 0, 0, 0))
-                                paste_pos = ((dimensions[0] - img_copy.width) // 2, (dimensions[1] - img_copy.height) // 2)
-                                new_img.paste(img_copy, paste_pos)
-                                
-                        # Save to cache for future use
-                        save_to_cache(new_img, cache_key, dimensions[0], dimensions[1])
-                            
-                    # Save in each requested output format
-                    format_results = {}
-                    for output_format in output_formats:
-                        try:
-                            output_format_lower = output_format.lower()
-                            
-                            # Skip ICO format except for favicon
-                            if output_format_lower == 'ico' and format_name != 'favicon':
-                                continue
-                                
-                            output_filename = f"{filename_without_ext}_{format_name}.{output_format_lower}"
-                            output_path = os.path.join(app.config['UPLOAD_FOLDER'], output_filename)
-                            
-                            # Apply format-specific optimizations
-                            save_img, save_opts = optimize_image(new_img, output_format, quality, strip_metadata)
-                            
-                            # Save with optimized parameters
-                            save_img.save(output_path, **save_opts)
-                            
-                            format_results[output_format] = {
-                                'path': output_path,
-                                'url': f"/{app.config['UPLOAD_FOLDER']}/{output_filename}",
-                            }
-                        except Exception as e:
-                            print(f"Error saving {format_name} as {output_format}: {e}")
-                            import traceback
-                            traceback.print_exc()
-                            
-                    # Add to results if any formats were successfully saved
-                    if format_results:
-                        results[format_name] = {
-                            'outputs': format_results,
-                            'dimensions': dimensions,
-                            'description': format_config.get('description', '')
-                        }
-                except Exception as e:
-                    print(f"Error processing format {format_name}: {e}")
-                    import traceback
-                    traceback.print_exc()
+                    animation = probe_animation(original_path)
+                except (OSError, ValueError) as e:
+                    logger.warning(f"Could not read the frames of {filename_without_ext}, rendering it as a still: {e}")
+                if animation and len(animation['durations']) > ANIMATION_MAX_FRAMES:
+                    logger.warning(f"{filename_without_ext} has {len(animation['durations'])} frames (limit {ANIMATION_MAX_FRAMES}), rendering it as a still")
+                    animation = None
+                if animation:
+                    animation.update(path=original_path, options=preprocessing_options)
+            
+            # Process each selected format (skip favicon if already created)
+            cache_key = generate_cache_key(original_path, dict(preprocessing_options, fill_white_with_prominent=fill_white_with_prominent))
+            results.update(render_formats(
+                processed_image,
+                formats_to_generate,
+                output_formats,
+                filename_without_ext,
+                cache_key,
+                skip_formats=('favicon',) if 'favicon_ico' in results else (),
+                animation=animation,
+                on_result=on_result,
+                **render_options
+            ))
                 
         return results
         
     except Exception as e:
-        print(f"Unhandled error in generate_formats: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception(f"Unhandled error in generate_formats: {e}")
         raise
 
+# --- Animated Images ---
+# Animated GIF and WebP sources keep their animation in GIF and WebP outputs of
+# standard renders; PNG, JPEG, ICO, thumbnails and variations use the first
+# frame. Frames are decoded, preprocessed, fitted and encoded one at a time, so
+# memory holds a few frames whatever the frame count. Frame timing comes from
+# the container, read without decoding.
+
+ANIMATED_OUTPUT_FORMATS = ('gif', 'webp')
+# Longer animations are rendered from their first frame only
+ANIMATION_MAX_FRAMES = env_int('BRANDKIT_ANIMATION_MAX_FRAMES', 300)
+# Browsers show frames without a delay for about this long
+DEFAULT_FRAME_DURATION_MS = 100
+# Per-frame WebP effort; method 6 (used for stills) is several times slower per frame
+ANIMATED_WEBP_METHOD = 4
+# Options that need more than the pixel itself (neighbours, image size or global
+# statistics); without them a changed region of a frame is processed on its own
+NON_LOCAL_OPTIONS = (
+    'remove_background', 'auto_crop', 'noise_reduction', 'edge_smooth', 'enhance_contrast', 'apply_blur',
+    'add_watermark', 'vignette', 'sharpen', 'shadow_effect', 'enhance_quality',
+)
+
+def _skip_gif_sub_blocks(data, pos):
+    while data[pos]:
+        pos += data[pos] + 1
+    return pos + 1
+
+def iter_gif_blocks(data):
+    """Yield (kind, label, bytes) for the header and each block of a GIF.
+    
+    kind is 'header' (with the global colour table), 'extension', 'image' or
+    'trailer'; label is the extension label.
+    """
+    try:
+        flags = data[10]
+        pos = 13 + (3 << ((flags & 7) + 1) if flags & 0x80 else 0)
+        yield 'header', None, data[:pos]
+        while pos < len(data):
+            start = pos
+            if data[pos] == 0x3B:
+                yield 'trailer', None, data[pos:pos + 1]
+                return
+            if data[pos] == 0x21:
+                pos = _skip_gif_sub_blocks(data, pos + 2)
+                yield 'extension', data[start + 1], data[start:pos]
+            elif data[pos] == 0x2C:
+                flags = data[pos + 9]
+                # Descriptor, local colour table and LZW code size, then the image data
+                pos = _skip_gif_sub_blocks(data, pos + 11 + (3 << ((flags & 7) + 1) if flags & 0x80 else 0))
+                yield 'image', None, data[start:pos]
+            else:
+                raise ValueError(f"unexpected GIF block 0x{data[pos]:02x}")
+    except IndexError:
+        raise ValueError("truncated GIF")
+
+def iter_webp_chunks(data):
+    """Yield (fourcc, bytes) for each chunk of a WebP file"""
+    if data[:4] != b'RIFF' or data[8:12] != b'WEBP':
+        raise ValueError("not a WebP file")
+    pos = 12
+    while pos + 8 <= len(data):
+        size = int.from_bytes(data[pos + 4:pos + 8], 'little')
+        end = pos + 8 + size + (size & 1)
+        yield data[pos:pos + 4], data[pos:end]
+        pos = end
+
+def strip_animation_metadata(data):
+    """Animated GIF or WebP bytes without comments, EXIF, XMP or ICC data; frames are copied as is"""
+    if data[:6] in (b'GIF87a', b'GIF89a'):
+        kept = []
+        for kind, label, block in iter_gif_blocks(data):
+            # Keep frame timing (0xF9) and the loop count; drop comments and other application data
+            if kind == 'extension' and (label == 0xFE or (label == 0xFF and block[3:14] not in (b'NETSCAPE2.0', b'ANIMEXTS1.0'))):
+                continue
+            kept.append(block)
+        return b''.join(kept)
+    chunks = []
+    for fourcc, chunk in iter_webp_chunks(data):
+        if fourcc in (b'EXIF', b'XMP ', b'ICCP'):
+            continue
+        if fourcc == b'VP8X':
+            # Clear the ICC, EXIF and XMP flags
+            chunk = chunk[:8] + bytes([chunk[8] & ~0x2C & 0xFF]) + chunk[9:]
+        chunks.append(chunk)
+    body = b'WEBP' + b''.join(chunks)
+    return b'RIFF' + len(body).to_bytes(4, 'little') + body
+
+def probe_animation(source):
+    """Frame durations (ms) and loop count of an animated GIF or WebP path or binary stream, or None for a still image"""
+    if hasattr(source, 'read'):
+        position = source.tell()
+        data = source.read()
+        source.seek(position)
+    else:
+        with open(source, 'rb') as f:
+            data = f.read()
+    durations, loop = [], None
+    if data[:6] in (b'GIF87a', b'GIF89a'):
+        delay = None
+        for kind, label, block in iter_gif_blocks(data):
+            if kind == 'extension' and label == 0xF9:
+                delay = int.from_bytes(block[4:6], 'little') * 10
+            elif kind == 'extension' and label == 0xFF and block[3:14] == b'NETSCAPE2.0':
+                loop = int.from_bytes(block[16:18], 'little')
+            elif kind == 'image':
+                durations.append(delay or DEFAULT_FRAME_DURATION_MS)
+                delay = None
+    elif data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        for fourcc, chunk in iter_webp_chunks(data):
+            if fourcc == b'ANIM':
+                loop = int.from_bytes(chunk[12:14], 'little')
+            elif fourcc == b'ANMF':
+                durations.append(int.from_bytes(chunk[20:23], 'little') or DEFAULT_FRAME_DURATION_MS)
+    if len(durations) < 2:
+        return None
+    return {'durations': durations, 'loop': loop}
+
+def changed_bbox(previous, current):
+    """Bounding box of the pixels that differ between two RGBA images of one size, or None"""
+    return ImageChops.difference(previous, current).getbbox(alpha_only=False)
+
+def animation_frames(animation, deadline=None):
+    """Yield (preprocessed RGBA frame, duration) for each frame of an animated source.
+    
+    A frame identical to the one before reuses its result, which is yielded
+    again as the same object. With only per-pixel options, just the changed
+    rectangle of a frame is processed and pasted over the previous result.
+    """
+    options = animation['options']
+    local = not any(options.get(key) for key in NON_LOCAL_OPTIONS)
+    previous_source = previous = None
+    with Image.open(animation['path']) as source:
+        for frame, duration in zip(ImageSequence.Iterator(source), animation['durations']):
+            if deadline is not None and deadline.expired():
+                raise RenderDeadlineExceeded(deadline.reason)
+            current = frame.convert('RGBA')
+            bbox = changed_bbox(previous_source, current) if previous_source is not None else (0, 0) + current.size
+            if bbox is None:
+                processed = previous
+            elif local and previous is not None:
+                processed = previous.copy()
+                processed.paste(preprocess_image(current.crop(bbox), options).convert('RGBA'), bbox[:2])
+            else:
+                processed = preprocess_image(current, options, deadline=deadline).convert('RGBA')
+            previous_source, previous = current, processed
+            yield processed, duration
+
+def animation_canvas(first_frame, dimensions, is_square, prominent_color, fill_white_with_prominent):
+    """Blank canvas shared by every frame of an animated format, chosen from the first frame as render_format_image does"""
+    if uses_gradient_fill(dimensions, is_square, fill_white_with_prominent):
+        return create_radial_gradient(dimensions, darken_color(prominent_color, 0.7), prominent_color)
+    first_frame = first_frame.convert('RGBA')
+    if first_frame.getchannel('A').getextrema()[0] < 255:
+        return Image.new('RGBA', dimensions, (0, 0, 0, 0))
+    return Image.new('RGBA', dimensions, first_frame.getpixel((0, 0))[:3] + (255,))
+
+def fitted_frames(animation, canvas, deadline=None):
+    """Yield (frame, duration) of an animated source fitted onto canvas"""
+    previous = fitted = None
+    for frame, duration in animation_frames(animation, deadline):
+        if frame is not previous:
+            resized = get_kernels().thumbnail(frame, canvas.size)
+            fitted = canvas.copy()
+            fitted.paste(resized, ((canvas.width - resized.width) // 2, (canvas.height - resized.height) // 2), resized)
+            previous = frame
+        yield fitted, duration
+
+class GifAnimationWriter:
+    """Animated GIF encoder that takes frames one at a time.
+    
+    Each frame gets its own palette with index 255 for transparency. After the
+    first frame only the rectangle that changed is written over the previous
+    one; where pixels turn transparent the previous frame is written whole and
+    disposed to the background. One frame is held back until the next shows
+    which of the two it needs.
+    """
+    
+    def __init__(self, loop=None):
+        self.loop = loop
+        self.frames = 0
+        self._chunks = []
+        self._previous = None
+        # [frame, bbox, duration] of the frame waiting to be written
+        self._pending = None
+    
+    def add(self, frame, duration):
+        if self._previous is None:
+            self._pending = [frame, (0, 0) + frame.size, duration]
+        else:
+            bbox = changed_bbox(self._previous, frame) if frame is not self._previous else None
+            if bbox is None:
+                # Same picture: show the waiting frame for longer
+                self._pending[2] += duration
+                return
+            # Pixels can only turn transparent inside the changed rectangle
+            cleared = np.any((np.asarray(self._previous.getchannel('A').crop(bbox)) >= 128) & (np.asarray(frame.getchannel('A').crop(bbox)) < 128))
+            self._write(disposal=2 if cleared else 1, whole=cleared)
+            self._pending = [frame, (0, 0) + frame.size if cleared else bbox, duration]
+        self._previous = frame
+    
+    def _write(self, disposal, whole=False):
+        frame, bbox, duration = self._pending
+        if whole:
+            bbox = (0, 0) + frame.size
+        region = frame.crop(bbox)
+        quantized = region.convert('RGB').quantize(255, method=Image.Quantize.FASTOCTREE)
+        indices = np.asarray(quantized).copy()
+        indices[np.asarray(region.getchannel('A')) < 128] = 255
+        paletted = Image.frombytes('P', region.size, indices.tobytes())
+        palette = quantized.getpalette()[:255 * 3]
+        paletted.putpalette(palette + [0] * (768 - len(palette)))
+        if not self._chunks:
+            info = {'transparency': 255}
+            if self.loop is not None:
+                info['loop'] = self.loop
+            header, _ = GifImagePlugin.getheader(paletted, info=info)
+            self._chunks.extend(header)
+        self._chunks.extend(GifImagePlugin.getdata(paletted, offset=bbox[:2], duration=duration, transparency=255, disposal=disposal, include_color_table=True))
+        self.frames += 1
+    
+    def finish(self):
+        """Write the last frame and return the GIF bytes"""
+        if self._pending:
+            self._write(disposal=1)
+            self._pending = None
+        self._chunks.append(b';')
+        return b''.join(self._chunks)
+
+class FrameSequence(Image.Image):
+    """Multi-frame image whose frames are pulled from an iterator as it is seeked.
+    
+    Only the current frame is held, so a writer that walks the frames in order,
+    as Pillow's animated WebP writer does, encodes any number of frames in
+    bounded memory. Frames already passed cannot be revisited.
+    """
+    
+    def __init__(self, frames, n_frames):
+        super().__init__()
+        self._frames = iter(frames)
+        self._frame = -1
+        self.n_frames = n_frames
+        self.is_animated = n_frames > 1
+        self.seek(0)
+    
+    def seek(self, frame):
+        while self._frame < frame:
+            try:
+                image = next(self._frames)
+            except StopIteration:
+                raise EOFError("no more frames")
+            self.im = image.im
+            self._mode = image.mode
+            self._size = image.size
+            self._frame += 1
+    
+    def tell(self):
+        return self._frame
+
+def encode_animation(animation, canvas, formats, quality=95, deadline=None):
+    """Encode an animated source fitted onto canvas in each of formats, in one pass over its frames.
+    
+    Returns {output format: bytes}.
+    """
+    gif = GifAnimationWriter(animation['loop']) if 'gif' in formats else None
+    
+    def frames():
+        # The GIF is written from the same frames the WebP writer pulls
+        for frame, duration in fitted_frames(animation, canvas, deadline):
+            if gif is not None:
+                gif.add(frame, duration)
+            yield frame
+    
+    encoded = {}
+    if 'webp' in formats:
+        buffer = io.BytesIO()
+        loop = animation['loop'] if animation['loop'] is not None else 1
+        FrameSequence(frames(), len(animation['durations'])).save(
+            buffer, 'WEBP', save_all=True, duration=animation['durations'], loop=loop,
+            quality=quality, method=ANIMATED_WEBP_METHOD)
+        encoded['webp'] = buffer.getvalue()
+    else:
+        for _ in frames():
+            pass
+    if gif is not None:
+        encoded['gif'] = gif.finish()
+    return encoded
+
+# --- End Animated Images ---
+
 # --- Helper Functions for Advanced Image Processing ---
 
-def remove_background(image, method='auto'):
-    """Remove background from image using various methods"""
+def guided_filter(guide, src, radius, eps=1e-3):
+    """Edge-preserving smoothing of src following the edges of guide (He et al.)"""
+    box_filter = get_kernels().box_filter
+    mean_i = box_filter(guide, radius)
+    mean_p = box_filter(src, radius)
+    cov_ip = box_filter(guide * src, radius) - mean_i * mean_p
+    var_i = box_filter(guide * guide, radius) - mean_i * mean_i
+    a = cov_ip / (var_i + eps)
+    b = mean_p - a * mean_i
+    return box_filter(a, radius) * guide + box_filter(b, radius)
+
+def upsample_mask(mask, image):
+    """Upscale a segmentation mask to the image size, refining it along the mask boundary.
+    
+    The mask is resized bilinearly, then a guided filter using the full-resolution
+    image as guide snaps the soft boundary band to real image edges. Pixels away
+    from the boundary keep the plain upscaled value.
+    """
+    scale = max(image.width / mask.width, image.height / mask.height)
+    upscaled = mask.resize(image.size, Image.BILINEAR)
+    if scale <= 1:
+        return upscaled
+    
+    m = np.asarray(upscaled).astype(np.float32) / 255.0
+    radius = max(2, int(math.ceil(scale)) * 2)
+    
+    # Boundary band: partially transparent pixels, widened by the filter radius
+    edge = ((m > 0.03) & (m < 0.97)).astype(np.float32)
+    if not edge.any():
+        return upscaled
+    rows = np.flatnonzero(edge.any(axis=1))
+    cols = np.flatnonzero(edge.any(axis=0))
+    pad = radius * 2
+    top, bottom = max(0, rows[0] - pad), min(m.shape[0], rows[-1] + pad + 1)
+    left, right = max(0, cols[0] - pad), min(m.shape[1], cols[-1] + pad + 1)
+    
+    # Only filter the bounding box of the band
+    guide = np.asarray(image.convert('L').crop((left, top, right, bottom))).astype(np.float32) / 255.0
+    region = m[top:bottom, left:right]
+    band = get_kernels().box_filter(edge[top:bottom, left:right], radius) > 0
+    refined = np.clip(guided_filter(guide, region, radius), 0, 1)
+    region[band] = refined[band]
+    
+    return Image.fromarray((m * 255 + 0.5).astype(np.uint8))
+
+# Input normalization (mean, std, model input size) of the rembg models whose
+# ONNX graph is run on a whole batch directly; other models go through rembg.remove
+BATCHABLE_MODELS = {
+    'u2net': ((0.485, 0.456, 0.406), (0.229, 0.224, 0.225), (320, 320)),
+    'u2net_human_seg': ((0.485, 0.456, 0.406), (0.229, 0.224, 0.225), (320, 320)),
+    'isnet-anime': ((0.485, 0.456, 0.406), (1.0, 1.0, 1.0), (1024, 1024)),
+}
+# Models whose exported graph turned out to have a fixed batch size of one
+_unbatchable_models = set()
+
+def run_mask_batch(session, model_inputs, proxy_arrays):
+    """One ONNX inference over a batch, with the pre- and post-processing of rembg's U2net sessions"""
+    mean, std, size = model_inputs
+    images = [Image.fromarray(array) for array in proxy_arrays]
+    inputs = [session.normalize(img, mean, std, size) for img in images]
+    input_name = next(iter(inputs[0]))
+    outputs = session.inner_session.run(None, {input_name: np.concatenate([i[input_name] for i in inputs])})
+    masks = []
+    for img, pred in zip(images, outputs[0][:, 0, :, :]):
+        # Scale each mask on its own, as a batch of one would be
+        lo, hi = pred.min(), pred.max()
+        pred = (pred - lo) / max(hi - lo, 1e-8)
+        mask = Image.fromarray((pred * 255).astype(np.uint8)).resize(img.size, Image.LANCZOS)
+        masks.append(np.asarray(mask))
+    return masks
+
+def segment_masks(model_name, proxy_arrays):
+    """Segmentation masks for a list of RGB proxy arrays, in one inference where the model allows"""
+    session = get_rembg_session(model_name)
+    if session is None:
+        raise RuntimeError("rembg failed to load")
+    if len(proxy_arrays) > 1 and model_name in BATCHABLE_MODELS and model_name not in _unbatchable_models:
+        try:
+            return run_mask_batch(session, BATCHABLE_MODELS[model_name], proxy_arrays)
+        except Exception as e:
+            _unbatchable_models.add(model_name)
+            logger.warning(f"Model {model_name} does not accept batches, segmenting one image at a time: {e}")
+    rembg = _load_rembg()
+    return [rembg.remove(array, session=session, only_mask=True) for array in proxy_arrays]
+
+def _bg_removal_worker_main(conn):
+    """Entry point of the background removal worker process: serve mask batches until closed"""
+    while True:
+        try:
+            model_name, proxy_arrays = conn.recv()
+        except (EOFError, OSError):
+            break
+        try:
+            conn.send(('ok', segment_masks(model_name, proxy_arrays)))
+        except Exception as e:
+            conn.send(('error', str(e)))
+
+class BackgroundRemovalWorker:
+    """Runs rembg in a separate process so a stuck inference can be killed.
+    
+    The process keeps its rembg sessions warm between calls; it is killed on
+    timeout and started again on the next call.
+    """
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._process = None
+        self._conn = None
+        os.register_at_fork(after_in_child=self._forget)
+    
+    def _forget(self):
+        # A forked worker (e.g. gunicorn --preload) starts its own process; the parent's is not its child
+        self._lock = threading.Lock()
+        self._process = None
+        self._conn = None
+    
+    def _start(self):
+        ctx = multiprocessing.get_context('spawn')
+        parent_conn, child_conn = ctx.Pipe()
+        self._process = ctx.Process(target=_bg_removal_worker_main, args=(child_conn,), daemon=True)
+        self._process.start()
+        child_conn.close()
+        self._conn = parent_conn
+    
+    def _kill(self):
+        if self._process is not None:
+            self._process.kill()
+            self._process.join(5)
+        if self._conn is not None:
+            self._conn.close()
+        self._process = None
+        self._conn = None
+    
+    def predict_masks(self, model_name, proxy_arrays, timeout):
+        """Return the masks for proxy_arrays, raising TimeoutError after timeout seconds"""
+        with self._lock:
+            if self._process is None or not self._process.is_alive():
+                self._start()
+            try:
+                self._conn.send((model_name, proxy_arrays))
+                finished = self._conn.poll(timeout)
+                if finished:
+                    status, payload = self._conn.recv()
+            except (EOFError, OSError) as e:
+                self._kill()
+                raise RuntimeError(f"background removal worker died: {e}")
+            if not finished:
+                self._kill()
+                raise TimeoutError(f"background removal did not finish within {timeout:.0f}s")
+        if status != 'ok':
+            raise RuntimeError(payload)
+        return payload
+    
+    def warm_up(self, model_name, timeout):
+        """Start the process and load a model's session in it"""
+        self.predict_masks(model_name, [], timeout)
+
+bg_removal_worker = BackgroundRemovalWorker()
+
+def run_segmentation(model_name, proxy_arrays, timeout=None):
+    """Segment proxy arrays, in the killable worker process when a timeout is configured"""
+    if not BG_REMOVAL_TIMEOUT_S:
+        return segment_masks(model_name, proxy_arrays)
+    return bg_removal_worker.predict_masks(model_name, proxy_arrays, timeout or BG_REMOVAL_TIMEOUT_S)
+
+class MaskBatcher:
+    """Groups concurrent segmentation requests into batched inferences.
+    
+    A dispatcher thread waits BG_BATCH_WINDOW_MS after the first pending
+    request for others to arrive, then segments them as one batch per model.
+    Requests that come in while a batch runs form the next one. Each caller
+    waits on its own future, so a caller whose deadline passes gives up
+    without cancelling the rest of its batch.
+    """
+    
+    def __init__(self, window_ms, max_batch):
+        self.window = window_ms / 1000
+        self.max_batch = max_batch
+        self._lock = threading.Lock()
+        self._pending = None
+        self._thread = None
+        self.stats = {'batches': 0, 'requests': 0, 'largest_batch': 0}
+    
+    def _ensure_dispatcher(self):
+        with self._lock:
+            # Also restarts the dispatcher in a forked worker, which does not inherit threads
+            if self._thread is None or not self._thread.is_alive():
+                self._pending = queue.Queue()
+                self._thread = threading.Thread(target=self._dispatch, args=(self._pending,), daemon=True, name='mask-batcher')
+                self._thread.start()
+            return self._pending
+    
+    def submit(self, model_name, proxy_array, timeout=None):
+        """Return the mask for proxy_array, raising TimeoutError after timeout seconds"""
+        future = Future()
+        expires = time.monotonic() + timeout if timeout else None
+        self._ensure_dispatcher().put((model_name, proxy_array, expires, future))
+        try:
+            return future.result(timeout)
+        except FutureTimeoutError:
+            future.cancel()
+            raise TimeoutError(f"background removal did not finish within {timeout:.1f}s")
+    
+    def _dispatch(self, pending):
+        while True:
+            batch = [pending.get()]
+            closes = time.monotonic() + self.window
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(pending.get(timeout=max(0, closes - time.monotonic())))
+                except queue.Empty:
+                    break
+            by_model = {}
+            for request in batch:
+                # Skip callers that already gave up
+                if request[3].set_running_or_notify_cancel():
+                    by_model.setdefault(request[0], []).append(request)
+            for model_name, requests in by_model.items():
+                self._segment(model_name, requests)
+    
+    def _segment(self, model_name, requests):
+        # The batch may run until its most patient caller gives up
+        expires = [request[2] for request in requests]
+        timeout = None if None in expires else max(0.1, max(expires) - time.monotonic())
+        started = time.perf_counter()
+        try:
+            masks = run_segmentation(model_name, [request[1] for request in requests], timeout)
+        except Exception as e:
+            for request in requests:
+                request[3].set_exception(e)
+            return
+        for request, mask in zip(requests, masks):
+            request[3].set_result(mask)
+        self.stats['batches'] += 1
+        self.stats['requests'] += len(requests)
+        self.stats['largest_batch'] = max(self.stats['largest_batch'], len(requests))
+        logger.debug("Segmented a batch of %d with %s in %.0f ms", len(requests), model_name, (time.perf_counter() - started) * 1000)
+
+mask_batcher = MaskBatcher(BG_BATCH_WINDOW_MS, BG_BATCH_SIZE)
+
+def predict_background_mask(model_name, proxy, deadline=None):
+    """Segment a proxy image, batched with concurrent requests for the same model"""
+    timeout = BG_REMOVAL_TIMEOUT_S or None
+    remaining = deadline.remaining() if deadline is not None else None
+    if remaining is not None:
+        if remaining <= 0:
+            raise TimeoutError("request deadline reached before background removal")
+        timeout = min(timeout, remaining) if timeout else remaining
+    if BG_BATCH_SIZE <= 1:
+        return run_segmentation(model_name, [np.asarray(proxy)], timeout)[0]
+    return mask_batcher.submit(model_name, np.asarray(proxy), timeout)
+
+# Segmentation masks by proxy content and model, so variations and speculative
+# warm-ups of the same image run the model once
+_background_mask_cache = {}
+
+def remove_background(image, method='auto', proxy_size=None, deadline=None):
+    """Remove background from image using various methods
+    
+    Segmentation runs on a proxy no larger than proxy_size (BG_PROXY_SIZE by
+    default, 0 for full resolution) passed to rembg as an array, and the mask is
+    upsampled back with edge-aware refinement. Raises RenderDeadlineExceeded if
+    the request deadline passes or the model times out while rendering for a
+    request, and TimeoutError for a model timeout without a deadline.
+    """
     if not REMBG_AVAILABLE:
-        print("Background removal not available - rembg not installed")
+        logger.warning("Background removal not available - rembg not installed")
         return image
     
     try:
-        # Convert PIL image to bytes
-        img_bytes = io.BytesIO()
-        image.save(img_bytes, format='PNG')
-        img_bytes.seek(0)
+        if image.mode != 'RGBA':
+            image = image.convert('RGBA')
+        if proxy_size is None:
+            proxy_size = BG_PROXY_SIZE
         
         # Use different models based on method
         if method == 'person':
-            session = new_session('u2net_human_seg')
+            model_name = 'u2net_human_seg'
         elif method == 'object':
-            session = new_session('u2net')
+            model_name = 'u2net'
         elif method == 'anime':
-            session = new_session('u2net_anime')
+            model_name = 'isnet-anime'
         else:  # auto
-            session = new_session('u2net')
+            model_name = 'u2net'
         
-        # Remove background
-        output = remove(img_bytes.getvalue(), session=session)
+        # Segment a bounded-size proxy; the model works at 320px internally anyway
+        proxy = image.convert('RGB')
+        if proxy_size:
+            proxy = get_kernels().thumbnail(proxy, (proxy_size, proxy_size))
+        mask_key = (hashlib.blake2b(proxy.tobytes(), digest_size=16).digest(), proxy.size, model_name)
+        mask = _cache_get(_background_mask_cache, mask_key)
+        if mask is None:
+            mask = _cache_put(_background_mask_cache, mask_key, Image.fromarray(predict_background_mask(model_name, proxy, deadline)))
         
-        # Convert back to PIL Image
-        result = Image.open(io.BytesIO(output)).convert('RGBA')
+        if mask.size != image.size:
+            mask = upsample_mask(mask, image)
         
-        print(f"Background removed successfully using method: {method}")
+        # Keep the original colours and combine the mask with any existing alpha
+        alpha = ImageChops.multiply(image.getchannel('A'), mask)
+        result = image.copy()
+        result.putalpha(alpha)
+        
+        logger.debug("Background removed using method: %s (segmented at %dx%d)", method, proxy.size[0], proxy.size[1])
         return result
         
+    except TimeoutError as e:
+        logger.error(f"Error removing background: {e}")
+        if deadline is None:
+            raise
+        # Outputs with the background left in would pass for a successful removal
+        if not deadline.expired():
+            deadline.reason = 'background_timeout'
+        raise RenderDeadlineExceeded(str(e))
     except Exception as e:
-        print(f"Error removing background: {e}")
-        traceback.print_exc()
+        logger.exception(f"Error removing background: {e}")
         return image
 
 def apply_background_color(image, bg_color="#FFFFFF"):
@@ -967,7 +3593,7 @@ def apply_background_color(image, bg_color="#FFFFFF"):
                 # Short hex format (e.g., #000 -> #000000)
                 hex_color = ''.join([c*2 for c in hex_color])
             elif len(hex_color) != 6:
-                print(f"Invalid hex color format: {bg_color}, using white")
+                logger.warning(f"Invalid hex color format: {bg_color}, using white")
                 hex_color = "FFFFFF"
             
             # Convert hex to RGB
@@ -976,7 +3602,7 @@ def apply_background_color(image, bg_color="#FFFFFF"):
                 g = int(hex_color[2:4], 16)
                 b = int(hex_color[4:6], 16)
             except ValueError:
-                print(f"Invalid hex color: {bg_color}, using white")
+                logger.warning(f"Invalid hex color: {bg_color}, using white")
                 r, g, b = 255, 255, 255
         else:
             # Handle RGB tuple
@@ -988,13 +3614,11 @@ def apply_background_color(image, bg_color="#FFFFFF"):
         # Composite the image on the background
         result = Image.alpha_composite(background, image)
         
-        print(f"Applied background color: RGB({r}, {g}, {b})")
+        logger.debug("Applied background color: RGB(%d, %d, %d)", r, g, b)
         return result
         
     except Exception as e:
-        print(f"Error applying background color: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception(f"Error applying background color: {e}")
         return image
 
 def smooth_edges(image, radius=2):
@@ -1007,7 +3631,7 @@ def smooth_edges(image, radius=2):
         r, g, b, a = image.split()
         
         # Apply slight blur to alpha channel to smooth edges
-        smoothed_alpha = a.filter(ImageFilter.GaussianBlur(radius=radius))
+        smoothed_alpha = get_kernels().gaussian_blur(a, radius)
         
         # Recombine channels
         result = Image.merge('RGBA', (r, g, b, smoothed_alpha))
@@ -1015,7 +3639,7 @@ def smooth_edges(image, radius=2):
         return result
         
     except Exception as e:
-        print(f"Error smoothing edges: {e}")
+        logger.error(f"Error smoothing edges: {e}")
         return image
 
 def reduce_noise(image, strength=1):
@@ -1023,16 +3647,16 @@ def reduce_noise(image, strength=1):
     try:
         # Apply median filter to reduce noise
         if strength == 1:
-            result = image.filter(ImageFilter.MedianFilter(size=3))
+            result = get_kernels().median_filter(image, 3)
         elif strength == 2:
-            result = image.filter(ImageFilter.MedianFilter(size=5))
+            result = get_kernels().median_filter(image, 5)
         else:
             result = image.filter(ImageFilter.SMOOTH_MORE)
         
         return result
         
     except Exception as e:
-        print(f"Error reducing noise: {e}")
+        logger.error(f"Error reducing noise: {e}")
         return image
 
 def auto_crop_image(image, padding=10):
@@ -1056,53 +3680,131 @@ def auto_crop_image(image, padding=10):
             # Crop the image
             result = image.crop((left, top, right, bottom))
             
-            print(f"Auto-cropped image from {image.size} to {result.size}")
+            logger.debug("Auto-cropped image from %s to %s", image.size, result.size)
             return result
         else:
             return image
         
     except Exception as e:
-        print(f"Error auto-cropping image: {e}")
+        logger.error(f"Error auto-cropping image: {e}")
         return image
 
+# --- Overlays ---
+# Watermarks and drop shadows only touch the region they change. Fonts, rendered
+# text layers and blurred shadow masks are cached, so repeated renders (and every
+# variation of the same image) reuse them.
+
+OVERLAY_CACHE_SIZE = 32
+_overlay_cache_lock = threading.Lock()
+_font_cache = {}
+_text_layer_cache = {}
+_shadow_mask_cache = {}
+
+def _cache_get(cache, key):
+    with _overlay_cache_lock:
+        value = cache.pop(key, None)
+        if value is not None:
+            # Re-insert to keep the dict in least-recently-used order
+            cache[key] = value
+        return value
+
+def _cache_put(cache, key, value, max_size=None):
+    with _overlay_cache_lock:
+        cache[key] = value
+        while len(cache) > (max_size or OVERLAY_CACHE_SIZE):
+            cache.pop(next(iter(cache)))
+    return value
+
+def get_font(name, size):
+    """Load a TrueType font once, falling back to Pillow's default font"""
+    font = _cache_get(_font_cache, (name, size))
+    if font is None:
+        try:
+            font = ImageFont.truetype(name, size)
+        except IOError:
+            font = ImageFont.load_default()
+        _cache_put(_font_cache, (name, size), font)
+    return font
+
+def get_text_layer(text, font_spec, fill):
+    """Render text onto a transparent layer just large enough to hold it"""
+    key = (text, font_spec, fill)
+    layer = _cache_get(_text_layer_cache, key)
+    if layer is None:
+        font = get_font(*font_spec)
+        right, bottom = ImageDraw.Draw(Image.new('RGBA', (1, 1))).textbbox((0, 0), text, font=font)[2:4]
+        layer = Image.new('RGBA', (max(1, right), max(1, bottom)), (0, 0, 0, 0))
+        ImageDraw.Draw(layer).text((0, 0), text, fill=fill, font=font)
+        _cache_put(_text_layer_cache, key, layer)
+    return layer
+
+def composite_region(image, overlay, position):
+    """Alpha-composite an overlay onto an RGBA image in place, clipping it to the image"""
+    source = (max(0, -position[0]), max(0, -position[1]))
+    dest = (max(0, position[0]), max(0, position[1]))
+    if source[0] < overlay.width and source[1] < overlay.height and dest[0] < image.width and dest[1] < image.height:
+        image.alpha_composite(overlay, dest=dest, source=source)
+    return image
+
+def get_shadow_mask(alpha, blur_radius, opacity):
+    """Blurred, opacity-scaled shadow mask for an alpha channel.
+    
+    Only the visible bounding box (plus the blur's reach) is blurred. Returns
+    (mask, (x, y)) with the mask's offset in the alpha channel, or (None, None)
+    when the image is fully transparent.
+    """
+    key = (hashlib.blake2b(alpha.tobytes(), digest_size=16).digest(), alpha.size, blur_radius, opacity)
+    cached = _cache_get(_shadow_mask_cache, key)
+    if cached is not None:
+        return cached
+    
+    bbox = alpha.getbbox()
+    if bbox is None:
+        return _cache_put(_shadow_mask_cache, key, (None, None))
+    
+    reach = int(math.ceil(blur_radius * 4)) + 2
+    region = (max(0, bbox[0] - reach), max(0, bbox[1] - reach), min(alpha.width, bbox[2] + reach), min(alpha.height, bbox[3] + reach))
+    mask = alpha.crop(region)
+    if blur_radius > 0:
+        mask = get_kernels().gaussian_blur(mask, blur_radius)
+    if opacity < 1:
+        mask = mask.point(lambda value: int(value * opacity))
+    return _cache_put(_shadow_mask_cache, key, (mask, region[:2]))
+
+# --- End Overlays ---
+
 def add_drop_shadow(image, offset=(5, 5), blur_radius=4, shadow_color=(0, 0, 0), opacity=0.3):
     """Add a drop shadow effect to the image"""
     try:
         if image.mode != 'RGBA':
             image = image.convert('RGBA')
         
-        # Create shadow layer
+        # Create the output canvas
         shadow = Image.new('RGBA', 
                           (image.width + abs(offset[0]) + blur_radius * 2, 
                            image.height + abs(offset[1]) + blur_radius * 2), 
                           (0, 0, 0, 0))
         
-        # Create shadow shape
-        shadow_color_with_alpha = shadow_color + (int(255 * opacity),)
-        shadow_img = Image.new('RGBA', image.size, (0, 0, 0, 0))
-        
-        # Extract alpha channel and create shadow
-        _, _, _, alpha = image.split()
-        shadow_layer = Image.new('RGBA', image.size, shadow_color_with_alpha)
-        shadow_layer.putalpha(alpha)
-        
-        # Blur the shadow
-        shadow_layer = shadow_layer.filter(ImageFilter.GaussianBlur(radius=blur_radius))
-        
-        # Position shadow
-        shadow_x = blur_radius + max(0, offset[0])
-        shadow_y = blur_radius + max(0, offset[1])
-        shadow.paste(shadow_layer, (shadow_x, shadow_y), shadow_layer)
+        # Blurred shadow of the visible region only
+        shadow_mask, mask_offset = get_shadow_mask(image.getchannel('A'), blur_radius, opacity)
+        if shadow_mask is not None:
+            shadow_layer = Image.new('RGBA', shadow_mask.size, tuple(shadow_color) + (255,))
+            shadow_layer.putalpha(shadow_mask)
+            
+            # Position shadow
+            shadow_x = blur_radius + max(0, offset[0]) + mask_offset[0]
+            shadow_y = blur_radius + max(0, offset[1]) + mask_offset[1]
+            shadow.paste(shadow_layer, (shadow_x, shadow_y))
         
-        # Position original image
+        # Position original image over the shadow
         orig_x = blur_radius + max(0, -offset[0])
         orig_y = blur_radius + max(0, -offset[1])
-        shadow.paste(image, (orig_x, orig_y), image)
+        shadow.alpha_composite(image, dest=(orig_x, orig_y))
         
         return shadow
         
     except Exception as e:
-        print(f"Error adding drop shadow: {e}")
+        logger.error(f"Error adding drop shadow: {e}")
         return image
 
 def enhance_image_quality(image):
@@ -1123,7 +3825,7 @@ def enhance_image_quality(image):
         return image
         
     except Exception as e:
-        print(f"Error enhancing image quality: {e}")
+        logger.error(f"Error enhancing image quality: {e}")
         return image
 
 # --- End Helper Functions ---
@@ -1132,63 +3834,48 @@ def enhance_image_quality(image):
 
 # Add a cleanup function to remove old files (can be called periodically)
 def cleanup_old_files(max_age_hours=24):
-    """Remove files older than max_age_hours from the uploads folder"""
-    current_time = datetime.now()
-    upload_dir = app.config['UPLOAD_FOLDER']
+    """Remove outputs and cache entries older than max_age_hours from storage"""
+    current_time = time.time()
     
     deleted_count = 0
     total_bytes_recovered = 0
     
     try:
-        for filename in os.listdir(upload_dir):
+        for key, file_size, mtime in list(storage.list()):
             # Skip the README.md file
-            if filename == 'README.md':
+            if key == 'README.md':
                 continue
-                
-            file_path = os.path.join(upload_dir, filename)
-            # Check if it's a file (not a directory)
-            if os.path.isfile(file_path):
-                # Get file modification time
-                file_time = datetime.fromtimestamp(os.path.getmtime(file_path))
-                # Calculate age in hours
-                age_hours = (current_time - file_time).total_seconds() / 3600
-                
-                # Remove files older than max_age_hours
-                if age_hours > max_age_hours:
-                    try:
-                        file_size = os.path.getsize(file_path)
-                        os.remove(file_path)
-                        deleted_count += 1
-                        total_bytes_recovered += file_size
-                        print(f"Removed old file: {filename} ({file_size / 1024:.1f} KB)")
-                    except Exception as e:
-                        print(f"Error removing file {filename}: {e}")
+            
+            # Remove files older than max_age_hours
+            age_hours = (current_time - mtime) / 3600
+            if age_hours > max_age_hours:
+                try:
+                    storage.delete(key)
+                    deleted_count += 1
+                    total_bytes_recovered += file_size
+                    logger.debug("Removed old file: %s (%.1f KB)", key, file_size / 1024)
+                except Exception as e:
+                    logger.error(f"Error removing file {key}: {e}")
     except Exception as e:
-        print(f"Error during cleanup: {e}")
+        logger.error(f"Error during cleanup: {e}")
     
-    # Also clean the cache directory
-    cache_dir = os.path.join(app.config['UPLOAD_FOLDER'], 'cache')
-    if os.path.exists(cache_dir):
-        try:
-            for filename in os.listdir(cache_dir):
-                file_path = os.path.join(cache_dir, filename)
-                if os.path.isfile(file_path):
-                    file_time = datetime.fromtimestamp(os.path.getmtime(file_path))
-                    age_hours = (current_time - file_time).total_seconds() / 3600
-                    
-                    if age_hours > max_age_hours:
-                        try:
-                            file_size = os.path.getsize(file_path)
-                            os.remove(file_path)
-                            deleted_count += 1
-                            total_bytes_recovered += file_size
-                            print(f"Removed old cached file: {filename} ({file_size / 1024:.1f} KB)")
-                        except Exception as e:
-                            print(f"Error removing cached file {filename}: {e}")
-        except Exception as e:
-            print(f"Error during cache cleanup: {e}")
+    # Abandoned chunked uploads
+    try:
+        abandoned = cleanup_chunked_uploads(max_age_hours)
+        if abandoned:
+            logger.info(f"Removed {abandoned} abandoned chunked uploads")
+    except Exception as e:
+        logger.error(f"Error cleaning chunked uploads: {e}")
+    
+    # Leftover render coalescing locks and responses
+    try:
+        stale = cleanup_render_flights(max_age_hours)
+        if stale:
+            logger.info(f"Removed {stale} render coalescing files")
+    except Exception as e:
+        logger.error(f"Error cleaning render coalescing files: {e}")
             
-    print(f"Cleanup completed: {deleted_count} files removed, {total_bytes_recovered / (1024*1024):.2f} MB recovered")
+    logger.info(f"Cleanup completed: {deleted_count} files removed, {total_bytes_recovered / (1024*1024):.2f} MB recovered")
     return {"files_deleted": deleted_count, "space_recovered_mb": total_bytes_recovered / (1024*1024)}
 
 # Add a memory manager to limit RAM usage
@@ -1204,21 +3891,115 @@ def cleanup_memory():
             process = psutil.Process(os.getpid())
             # Get memory info in MB
             memory_usage = process.memory_info().rss / 1024 / 1024
-            print(f"Memory cleanup: collected {collected} objects, current usage: {memory_usage:.2f} MB")
+            logger.info(f"Memory cleanup: collected {collected} objects, current usage: {memory_usage:.2f} MB")
             return memory_usage
         except Exception as e:
-            print(f"Error getting memory info: {e}")
+            logger.error(f"Error getting memory info: {e}")
     else:
-        print(f"Memory cleanup: collected {collected} objects")
+        logger.info(f"Memory cleanup: collected {collected} objects")
     
     return collected
 
 # --- End Cleanup and Optimization Functions ---
 
+# --- Static Asset Fingerprinting ---
+# Vendor JS and the prebuilt stylesheet are served under content-hashed names
+# with precompressed gzip variants, so browsers can cache them forever.
+
+FINGERPRINTED_ASSETS = ['css/brandkit.css', 'vendor/@alpinejs/csp/dist/cdn.min.js']
+ASSET_CACHE_MAX_AGE = 365 * 24 * 3600
+ASSET_MIMETYPES = {'.css': 'text/css; charset=utf-8', '.js': 'application/javascript; charset=utf-8'}
+
+_asset_lock = threading.Lock()
+_assets_by_source = {}   # source filename -> asset entry
+_assets_by_hashed = {}   # hashed filename -> asset entry
+
+def _load_asset(filename):
+    """Read a static asset, fingerprint it and build its gzip variant (cached by mtime)"""
+    source_path = os.path.join(app.static_folder, filename)
+    try:
+        mtime = os.path.getmtime(source_path)
+    except OSError:
+        return None
+
+    entry = _assets_by_source.get(filename)
+    if entry and entry['mtime'] == mtime:
+        return entry
+
+    with _asset_lock:
+        with open(source_path, 'rb') as f:
+            data = f.read()
+        digest = hashlib.sha256(data).hexdigest()[:12]
+        base, ext = os.path.splitext(filename)
+        hashed_name = f"{base}.{digest}{ext}"
+        entry = {
+            'mtime': mtime,
+            'hashed_name': hashed_name,
+            'etag': digest,
+            'mimetype': ASSET_MIMETYPES.get(ext, 'application/octet-stream'),
+            'data': data,
+            # mtime=0 keeps the gzip bytes deterministic across workers
+            'gzip': gzip.compress(data, compresslevel=9, mtime=0),
+        }
+        old_entry = _assets_by_source.get(filename)
+        if old_entry:
+            _assets_by_hashed.pop(old_entry['hashed_name'], None)
+        _assets_by_source[filename] = entry
+        _assets_by_hashed[hashed_name] = entry
+    return entry
+
+def asset_url(filename):
+    """Return the content-hashed URL for a static asset (plain static URL as fallback)"""
+    if filename in FINGERPRINTED_ASSETS:
+        entry = _load_asset(filename)
+        if entry:
+            return url_for('serve_asset', hashed_name=entry['hashed_name'])
+    return url_for('static', filename=filename)
+
+app.jinja_env.globals['asset_url'] = asset_url
+
+@app.route('/assets/<path:hashed_name>')
+@limiter.exempt
+def serve_asset(hashed_name):
+    """Serve a fingerprinted asset with immutable caching and gzip if accepted"""
+    entry = _assets_by_hashed.get(hashed_name)
+    if entry is None:
+        # Another worker may have rendered the page; build the manifest on demand
+        for filename in FINGERPRINTED_ASSETS:
+            _load_asset(filename)
+        entry = _assets_by_hashed.get(hashed_name)
+    if entry is None:
+        abort(404)
+
+    headers = {
+        'Cache-Control': f'public, max-age={ASSET_CACHE_MAX_AGE}, immutable',
+        'ETag': f'"{entry["etag"]}"',
+        'Vary': 'Accept-Encoding',
+    }
+    if entry['etag'] in request.if_none_match:
+        return Response(status=304, headers=headers)
+
+    if 'gzip' in request.accept_encodings:
+        body = entry['gzip']
+        headers['Content-Encoding'] = 'gzip'
+    else:
+        body = entry['data']
+    return Response(body, content_type=entry['mimetype'], headers=headers)
+
+# --- End Static Asset Fingerprinting ---
+
 @app.route('/')
 def index():
     config = load_config()
-    return render_template('index.html', config=config, max_upload_mb=app.config['MAX_CONTENT_LENGTH'] // (1024 * 1024), csrf_token=generate_csrf())
+    direct_upload_mb = app.config['MAX_CONTENT_LENGTH'] // (1024 * 1024)
+    return render_template(
+        'index.html',
+        config=config,
+        max_upload_mb=max(direct_upload_mb, MAX_CHUNKED_UPLOAD_MB),
+        direct_upload_mb=direct_upload_mb,
+        chunk_size_mb=min(CHUNK_SIZE_MB, direct_upload_mb),
+        csrf_token=generate_csrf()
+    )
 
 @app.route('/analyze', methods=['POST'])
 def analyze_image_endpoint():
@@ -1243,6 +4024,20 @@ def analyze_image_endpoint():
             temp_file_path = temp_file.name
             file.save(temp_file_path)
             temp_file.close()
+            
+            # Stash the image for /upload and reuse the analysis from its warm-up
+            if request.form.get('stash') == 'true':
+                background_method = None
+                if request.form.get('remove_background') == 'true':
+                    background_method = request.form.get('background_removal_method', 'auto')
+                upload_token = stash_upload(temp_file_path, background_method)
+                entry = get_speculative_entry(upload_token)
+                if entry and entry['ready'].wait(SPECULATIVE_ANALYZE_WAIT_S) and entry.get('analysis'):
+                    return jsonify({
+                        'success': True,
+                        'analysis': entry['analysis'],
+                        'upload_token': upload_token
+                    })
 
             # Process image for analysis
             with Image.open(temp_file_path) as img:
@@ -1255,7 +4050,7 @@ def analyze_image_endpoint():
                 try:
                     prominent_color = get_prominent_color(img)
                 except Exception as e:
-                    print(f"Error getting prominent color: {e}")
+                    logger.error(f"Error getting prominent color: {e}")
                 
                 # Check for white areas
                 has_white_area = False
@@ -1263,7 +4058,7 @@ def analyze_image_endpoint():
                 try:
                     has_white_area, white_area_ratio = has_significant_white_area(img)
                 except Exception as e:
-                    print(f"Error detecting white areas: {e}")
+                    logger.error(f"Error detecting white areas: {e}")
                 
                 # Prepare analysis results
                 analysis_results = {
@@ -1278,9 +4073,7 @@ def analyze_image_endpoint():
                 })
         
         except Exception as e:
-            import traceback
-            traceback.print_exc()
-            print(f"Error analyzing image: {e}")
+            logger.exception(f"Error analyzing image: {e}")
             return jsonify({
                 'success': False,
                 'error': f'Error analyzing image: {str(e)}'
@@ -1292,12 +4085,10 @@ def analyze_image_endpoint():
                 try:
                     os.unlink(temp_file_path)
                 except Exception as e:
-                    print(f"Error removing temp file: {e}")
+                    logger.error(f"Error removing temp file: {e}")
     
     except Exception as e:
-        import traceback
-        traceback.print_exc()
-        print(f"Unexpected error in analyze endpoint: {e}")
+        logger.exception(f"Unexpected error in analyze endpoint: {e}")
         return jsonify({
             'success': False,
             'error': f'Server error: {str(e)}'
@@ -1324,11 +4115,20 @@ def ensure_serializable(obj):
 
 @app.route('/download-zip/<filename>')
 def download_zip(filename):
-    zip_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-    if os.path.exists(zip_path):
-        return send_file(zip_path, as_attachment=True)
+    response = send_stored(filename, as_attachment=True) if is_valid_storage_key(filename) else None
+    if response is not None:
+        return response
     return jsonify({'error': 'File not found'}), 404
 
+@app.route('/outputs/<path:key>')
+@limiter.exempt
+def serve_output(key):
+    """Serve a generated asset from the storage backend"""
+    response = send_stored(key) if is_valid_storage_key(key) else None
+    if response is None:
+        abort(404)
+    return response
+
 @app.route('/format-info', methods=['GET'])
 def format_info():
     """Return detailed information about available formats"""
@@ -1358,17 +4158,24 @@ def format_info():
         'recommendations': recommendations
     })
 
-def get_prominent_color(image, exclude_white=True):
+def color_histogram(image):
+    """Distinct RGBA colours of a 64x64 thumbnail and their pixel counts, most frequent first"""
     img = image.convert('RGBA').resize((64, 64))
-    arr = np.array(img)
-    pixels = arr.reshape(-1, 4)
-    pixels = pixels[pixels[:, 3] > 0]  # Filter out fully transparent pixels
+    pixels = np.array(img).reshape(-1, 4)
+    colors, counts = np.unique(pixels, axis=0, return_counts=True)
+    order = np.argsort(-counts, kind='stable')
+    return colors[order], counts[order]
+
+def get_prominent_color(image, exclude_white=True, histogram=None):
+    colors, counts = histogram if histogram is not None else color_histogram(image)
+    keep = colors[:, 3] > 0  # Filter out fully transparent pixels
     if exclude_white:
-        pixels = pixels[(pixels[:, 0:3] < 245).any(axis=1)]  # Filter out white pixels
-    if len(pixels) == 0:
+        keep &= (colors[:, 0:3] < 245).any(axis=1)  # Filter out white pixels
+    if not keep.any():
         return [200, 200, 200]  # Default color if no valid pixels - return list instead of tuple
-    colors, counts = np.unique(pixels[:, :3], axis=0, return_counts=True)
-    prominent = colors[counts.argmax()]
+    rgb, inverse = np.unique(colors[keep, :3], axis=0, return_inverse=True)
+    rgb_counts = np.bincount(inverse.ravel(), weights=counts[keep])
+    prominent = rgb[rgb_counts.argmax()]
     return [int(x) for x in prominent]  # Return list instead of tuple
 
 def has_significant_white_area(image, threshold=0.15):
@@ -1415,50 +4222,292 @@ def optimize_image(img, output_format, quality=95, strip_metadata=False):
     else:
         return img, {}
 
+# --- Targeted Encoding ---
+# Formats may declare "max_bytes" and/or "min_ssim" in config.json. Their JPEG
+# and WebP outputs search the encoder quality on the already rendered image
+# instead of using the global quality setting.
+
+TARGET_ENCODING_FORMATS = ('jpg', 'jpeg', 'webp')
+TARGET_MIN_QUALITY = 10
+# JPEG chroma subsampling modes searched: 4:4:4 and 4:2:0
+JPEG_SUBSAMPLING_CHOICES = {0: '4:4:4', 2: '4:2:0'}
+# WebP effort used while probing qualities; the final encode uses the configured method
+WEBP_PROBE_METHOD = 4
+
+def get_encoding_target(format_config):
+    """Return the (max_bytes, min_ssim) target declared by a format, or None"""
+    max_bytes = format_config.get('max_bytes')
+    min_ssim = format_config.get('min_ssim')
+    if not max_bytes and not min_ssim:
+        return None
+    return (int(max_bytes) if max_bytes else None, float(min_ssim) if min_ssim else None)
+
+def luma_on_white(image):
+    """Luma of an image composited over white, for quality comparisons"""
+    if image.mode != 'RGBA':
+        return image.convert('L')
+    background = Image.new('RGBA', image.size, (255, 255, 255, 255))
+    background.alpha_composite(image)
+    return background.convert('L')
+
+def ssim(reference, candidate):
+    """Mean structural similarity of two same-size images on luma, using 7x7 windows"""
+    x = np.asarray(luma_on_white(reference), dtype=np.float32)
+    y = np.asarray(luma_on_white(candidate), dtype=np.float32)
+    box_filter = get_kernels().box_filter
+    c1, c2 = (0.01 * 255) ** 2, (0.03 * 255) ** 2
+    mu_x, mu_y = box_filter(x, 3), box_filter(y, 3)
+    var_x = box_filter(x * x, 3) - mu_x * mu_x
+    var_y = box_filter(y * y, 3) - mu_y * mu_y
+    cov_xy = box_filter(x * y, 3) - mu_x * mu_y
+    ssim_map = ((2 * mu_x * mu_y + c1) * (2 * cov_xy + c2)) / ((mu_x * mu_x + mu_y * mu_y + c1) * (var_x + var_y + c2))
+    return float(ssim_map.mean())
+
+def decoded_ssim(reference, data):
+    """SSIM of encoded image bytes against the reference image"""
+    with Image.open(io.BytesIO(data)) as decoded:
+        decoded.load()
+        return ssim(reference, decoded)
+
+def encode_image_bytes(img, save_opts):
+    buffer = io.BytesIO()
+    img.save(buffer, **save_opts)
+    return buffer.getvalue()
+
+def search_quality(encode, reference, max_quality, max_bytes=None, min_ssim=None):
+    """Binary-search the encoder quality for one encoder variant.
+    
+    With max_bytes, the highest quality that fits; with min_ssim, the lowest
+    quality reaching it. When both cannot be met the byte budget wins.
+    Returns the chosen quality.
+    """
+    encoded = {}
+    def encode_cached(quality):
+        if quality not in encoded:
+            encoded[quality] = encode(quality)
+        return encoded[quality]
+    
+    # Highest quality within the byte budget
+    best_fit = max_quality
+    if max_bytes:
+        lo, hi, best_fit = TARGET_MIN_QUALITY, max_quality, TARGET_MIN_QUALITY
+        while lo <= hi:
+            mid = (lo + hi) // 2
+            if len(encode_cached(mid)) <= max_bytes:
+                best_fit, lo = mid, mid + 1
+            else:
+                hi = mid - 1
+    
+    # Lowest quality within that range meeting the SSIM floor
+    if min_ssim:
+        lo, hi, floor_quality = TARGET_MIN_QUALITY, best_fit, None
+        while lo <= hi:
+            mid = (lo + hi) // 2
+            if decoded_ssim(reference, encode_cached(mid)) >= min_ssim:
+                floor_quality, hi = mid, mid - 1
+            else:
+                lo = mid + 1
+        if floor_quality is not None:
+            return floor_quality
+    return best_fit
+
+def encode_to_target(img, output_format, save_opts, max_bytes=None, min_ssim=None):
+    """Encode a JPEG or WebP image to a byte budget and/or SSIM floor.
+    
+    The global quality in save_opts is the upper bound of the search. JPEG
+    outputs are progressive and both chroma subsampling modes are searched,
+    keeping the better result. Returns (data, info) where info reports the
+    chosen quality, bytes, SSIM and whether the target was met.
+    """
+    max_quality = int(save_opts.get('quality', 95))
+    is_jpeg = output_format.lower() in ('jpg', 'jpeg')
+    
+    if is_jpeg:
+        variants = [
+            ({**save_opts, 'format': 'JPEG', 'progressive': True, 'optimize': True, 'subsampling': subsampling}, None)
+            for subsampling in JPEG_SUBSAMPLING_CHOICES
+        ]
+    else:
+        final_opts = {**save_opts, 'format': 'WEBP'}
+        variants = [(final_opts, {**final_opts, 'method': min(final_opts.get('method', 6), WEBP_PROBE_METHOD)})]
+    
+    candidates = []
+    for final_opts, probe_opts in variants:
+        probe_opts = probe_opts or final_opts
+        quality = search_quality(
+            lambda q: encode_image_bytes(img, {**probe_opts, 'quality': q}),
+            img, max_quality, max_bytes, min_ssim
+        )
+        data = encode_image_bytes(img, {**final_opts, 'quality': quality})
+        # The final encoder settings can land slightly over a budget met while probing
+        while max_bytes and len(data) > max_bytes and quality > TARGET_MIN_QUALITY:
+            quality = max(TARGET_MIN_QUALITY, quality - 5)
+            data = encode_image_bytes(img, {**final_opts, 'quality': quality})
+        score = decoded_ssim(img, data)
+        # ...or slightly under a quality floor met while probing
+        while min_ssim and score < min_ssim and quality < max_quality:
+            next_quality = min(max_quality, quality + 2)
+            next_data = encode_image_bytes(img, {**final_opts, 'quality': next_quality})
+            if max_bytes and len(next_data) > max_bytes:
+                break
+            quality, data = next_quality, next_data
+            score = decoded_ssim(img, data)
+        info = {
+            'quality': quality,
+            'bytes': len(data),
+            'ssim': round(score, 4),
+            'target_met': (not max_bytes or len(data) <= max_bytes) and (not min_ssim or score >= min_ssim),
+        }
+        if is_jpeg:
+            info['subsampling'] = JPEG_SUBSAMPLING_CHOICES[final_opts['subsampling']]
+            info['progressive'] = True
+        candidates.append((data, info))
+    
+    # Prefer met targets; then the higher SSIM within a byte budget, otherwise the smaller file
+    def rank(candidate):
+        data, info = candidate
+        if info['target_met'] and not min_ssim:
+            return (False, -info['ssim'])
+        return (not info['target_met'], len(data))
+    return min(candidates, key=rank)
+
+# --- End Targeted Encoding ---
+
+# --- Palette Quantization ---
+# Flat-colour logos are detected from the colour histogram computed alongside
+# the prominent colour. Their PNG and ICO outputs are saved as 256-colour
+# palette images with alpha when quantization keeps at least
+# "palette_min_psnr" dB (config.json); gradient-filled canvases are skipped.
+
+# A logo is low-colour when this many colours cover this share of its visible pixels
+PALETTE_HISTOGRAM_COLORS = 32
+PALETTE_HISTOGRAM_COVERAGE = 0.9
+ICO_SIZES = (16, 24, 32, 48, 64, 128, 256)
+
+def is_low_color(histogram):
+    """Whether a handful of colours covers nearly all visible pixels of a color_histogram()"""
+    colors, counts = histogram
+    visible_counts = counts[colors[:, 3] > 0]
+    if not visible_counts.sum():
+        return False
+    return visible_counts[:PALETTE_HISTOGRAM_COLORS].sum() / visible_counts.sum() >= PALETTE_HISTOGRAM_COVERAGE
+
+def quantize_palette(img, min_psnr):
+    """Quantize an RGB/RGBA image to a palette with alpha, or None if PSNR drops below min_psnr"""
+    if img.mode not in ('RGB', 'RGBA'):
+        return None
+    paletted = img.quantize(256, method=Image.Quantize.FASTOCTREE, dither=Image.Dither.NONE)
+    
+    # Compare premultiplied colours so invisible pixels do not count; the squared
+    # error is summed from the difference histogram instead of per pixel
+    compare_mode = 'RGBa' if img.mode == 'RGBA' else 'RGB'
+    difference = ImageChops.difference(img.convert(compare_mode), paletted.convert(img.mode).convert(compare_mode))
+    histogram = np.array(difference.histogram(), dtype=np.float64).reshape(-1, 256)
+    mse = float((histogram * np.arange(256) ** 2).sum() / histogram.sum())
+    if mse and 10 * math.log10(255 ** 2 / mse) < min_psnr:
+        return None
+    return paletted
+
+def save_ico(image, output_key, sizes=None, palette_min_psnr=None):
+    """Store an ICO with one resampled frame per size.
+    
+    The frames are indexed when every frame passes the palette fidelity check
+    and the indexed file is smaller. Returns the stored size and whether the
+    palette was used.
+    """
+    sizes = sizes or [size for size in ICO_SIZES if size <= min(image.size)]
+    frames = [get_kernels().thumbnail(image, (size, size)) for size in sorted(sizes, reverse=True)]
+    
+    def encode_frames(frames):
+        return encode_image_bytes(frames[0], {
+            'format': 'ICO',
+            'sizes': [frame.size for frame in frames],
+            'append_images': frames[1:],
+        })
+    
+    data = encode_frames(frames)
+    palette = False
+    if palette_min_psnr is not None:
+        paletted_frames = [quantize_palette(frame, palette_min_psnr) for frame in frames]
+        if all(frame is not None for frame in paletted_frames):
+            paletted_data = encode_frames(paletted_frames)
+            # Palette overhead can outweigh the savings on tiny frames
+            if len(paletted_data) < len(data):
+                data, palette = paletted_data, True
+    
+    storage.put(output_key, data)
+    return len(data), palette
+
+# --- End Palette Quantization ---
+
 def create_zip_file(results, filename_without_ext):
     """Create a zip file containing all generated assets"""
     timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
     zip_filename = f"{filename_without_ext}_brandkit_{timestamp}.zip"
-    zip_path = os.path.join(app.config['UPLOAD_FOLDER'], zip_filename)
+    zip_buffer = io.BytesIO()
     
     try:
-        with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
+        with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zipf:
+            def add_to_zip(entry):
+                data = storage.get(entry['key'])
+                if data is not None:
+                    zipf.writestr(os.path.basename(entry['key']), data)
+            
             # Add original file
             if 'original' in results:
-                original_path = results['original']['path']
-                zipf.write(original_path, os.path.basename(original_path))
+                add_to_zip(results['original'])
             
             # Handle variations
             if 'variations' in results:
                 for variation_label, variation_data in results['variations'].items():
                     for format_name, format_data in variation_data.items():
                         for output_format, output_data in format_data['outputs'].items():
-                            file_path = output_data['path']
-                            zipf.write(file_path, os.path.basename(file_path))
+                            add_to_zip(output_data)
             
             # Handle regular formats
             for key, data in results.items():
                 if key not in ['original', 'variations', 'zip', 'analysis', 'favicon_ico']:
                     for output_format, output_data in data['outputs'].items():
-                        file_path = output_data['path']
-                        zipf.write(file_path, os.path.basename(file_path))
+                        add_to_zip(output_data)
             
             # Handle favicon
             if 'favicon_ico' in results:
-                file_path = results['favicon_ico']['path']
-                zipf.write(file_path, os.path.basename(file_path))
+                add_to_zip(results['favicon_ico'])
         
-        return {
-            'path': zip_path,
-            'url': f"/{app.config['UPLOAD_FOLDER']}/{zip_filename}",
-            'filename': zip_filename
-        }
+        storage.put(zip_filename, zip_buffer.getvalue())
+        return dict(output_entry(zip_filename), filename=zip_filename)
     except Exception as e:
-        print(f"Error creating zip file: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception(f"Error creating zip file: {e}")
         return None
 
+_IMPORT_FINISHED_AT = time.perf_counter()
+_startup_report = import_report()
+logger.info(
+    f"Startup import report: app imported in {_startup_report['import_ms']} ms, "
+    f"heavy modules loaded: {', '.join(_startup_report['heavy_modules_loaded']) or 'none'}"
+)
+
+# Optionally warm rembg in the background so the first background removal
+# doesn't pay for the import and model load (off by default for fast startup).
+# The model is loaded where segmentation runs: the worker process, unless
+# BRANDKIT_BG_REMOVAL_TIMEOUT_S=0 runs it in this one.
+# A first run may download the model, so the warm-up gets longer than a request
+REMBG_PRELOAD_TIMEOUT_S = 600
+
+def preload_rembg(model_name='u2net'):
+    started = time.perf_counter()
+    try:
+        if BG_REMOVAL_TIMEOUT_S:
+            bg_removal_worker.warm_up(model_name, REMBG_PRELOAD_TIMEOUT_S)
+        else:
+            get_rembg_session(model_name)
+        logger.info(f"Preloaded rembg model {model_name} in {(time.perf_counter() - started) * 1000:.0f} ms")
+    except Exception as e:
+        logger.warning(f"Could not preload rembg model {model_name}: {e}")
+
+if os.environ.get('BRANDKIT_PRELOAD_REMBG', '').lower() in ('1', 'true', 'yes') and REMBG_AVAILABLE:
+    threading.Thread(target=preload_rembg, daemon=True).start()
+
 if __name__ == '__main__':
     # Schedule periodic cleanup (if using a production server)
     if os.environ.get('FLASK_ENV') != 'development':
@@ -0,0 +1,196 @@
+"""Headless batch mode: render brand assets for many images without the web app.
+
+    python cli.py logos/ "brand/**/*.png" -o dist/brand --options options.json
+
+Inputs are files, directories (their images, not recursive) or glob patterns.
+The options file is JSON with the same fields as the /upload form, e.g.
+{"selected_formats": ["website", "favicon"], "output_formats": ["png", "ico"],
+"remove_background": true, "quality": 90}; missing fields use the form
+defaults. Images are rendered in parallel by a process pool, one image per
+task. Outputs are written to the output directory with a manifest.json that
+lists every file, and throughput is printed at the end.
+"""
+import os
+import sys
+import json
+import glob
+import time
+import shutil
+import argparse
+import multiprocessing
+import multiprocessing.util
+
+from PIL import Image
+
+# Set by init_worker (and by main for the parent process)
+brandkit = None
+
+def configure_environment(output_dir, config_path, verbose=False):
+    """Point the app module at the output directory and config before it is imported"""
+    os.environ['BRANDKIT_STORAGE'] = 'local'
+    os.environ['BRANDKIT_STORAGE_DIR'] = os.path.abspath(output_dir)
+    os.environ.pop('BRANDKIT_STORAGE_MAX_MB', None)
+    if config_path:
+        os.environ['BRANDKIT_CONFIG'] = os.path.abspath(config_path)
+    # No deadlines to enforce here, so background removal can run in-process
+    os.environ.setdefault('BRANDKIT_BG_REMOVAL_TIMEOUT_S', '0')
+    # One image per process, so there is nothing to batch background removal with
+    os.environ.setdefault('BRANDKIT_BG_BATCH_SIZE', '1')
+    # Keep the progress lines readable unless the render log is wanted
+    os.environ['BRANDKIT_LOG_LEVEL'] = 'DEBUG' if verbose else os.environ.get('BRANDKIT_LOG_LEVEL', 'WARNING')
+
+def init_worker():
+    global brandkit
+    import app as brandkit
+    # Pool workers skip atexit; flush the log queue when they exit
+    multiprocessing.util.Finalize(None, brandkit.stop_logging, exitpriority=10)
+
+def options_form(options):
+    """Turn JSON options into the form fields parse_render_options expects"""
+    from werkzeug.datastructures import MultiDict
+    form = MultiDict()
+    for key, value in options.items():
+        for item in (value if isinstance(value, list) else [value]):
+            form.add(key, ('true' if item else 'false') if isinstance(item, bool) else str(item))
+    return form
+
+def collect_images(inputs):
+    """Expand files, directories and glob patterns into a sorted list of image paths"""
+    paths = []
+    for pattern in inputs:
+        if os.path.isdir(pattern):
+            matches = [os.path.join(pattern, name) for name in os.listdir(pattern)]
+        else:
+            matches = glob.glob(pattern, recursive=True)
+            if not matches:
+                print(f"Warning: no files match {pattern}")
+        paths.extend(path for path in matches if os.path.isfile(path) and brandkit.allowed_file(path))
+    # Each image once, in a stable order
+    return sorted(set(os.path.abspath(path) for path in paths))
+
+def output_prefixes(paths):
+    """Unique output name prefixes, from the file names"""
+    prefixes = []
+    seen = set()
+    for path in paths:
+        base = brandkit.secure_filename(os.path.splitext(os.path.basename(path))[0]) or 'image'
+        prefix, n = base, 2
+        while prefix in seen:
+            prefix, n = f"{base}_{n}", n + 1
+        seen.add(prefix)
+        prefixes.append(prefix)
+    return prefixes
+
+def manifest_results(results):
+    """Render results without the web-only url and local path fields"""
+    if isinstance(results, dict):
+        return {k: manifest_results(v) for k, v in results.items() if k not in ('url', 'path')}
+    if isinstance(results, (list, tuple)):
+        return [manifest_results(v) for v in results]
+    return results
+
+def count_outputs(results, output_dir):
+    """Number and total size of the output files in render results"""
+    if isinstance(results, dict):
+        if 'key' in results:
+            return 1, results.get('bytes') or os.path.getsize(os.path.join(output_dir, results['key']))
+        totals = [count_outputs(v, output_dir) for v in results.values()]
+        return sum(t[0] for t in totals), sum(t[1] for t in totals)
+    return 0, 0
+
+def render_image(job):
+    """Render one image; runs in a pool worker"""
+    source, prefix, options = job
+    started = time.perf_counter()
+    record = {'source': source, 'prefix': prefix}
+    # Log records of this image carry its output prefix as correlation id
+    brandkit.correlation_id.set(prefix)
+    try:
+        config = brandkit.load_config()
+        render_options = brandkit.parse_render_options(options_form(options), config)
+        with Image.open(source) as img:
+            record['size'] = list(img.size)
+        results = brandkit.generate_formats(
+            source,
+            prefix,
+            render_options['selected_formats'],
+            render_options['output_formats'],
+            render_options['preprocessing_options'],
+            variations_mode=render_options['variations_mode'],
+            fill_white_with_prominent=render_options['fill_white_with_prominent'],
+            quality=render_options['quality'],
+            strip_metadata=render_options['strip_metadata'],
+            thumbnails=False,
+        )
+        record['results'] = manifest_results(brandkit.ensure_serializable(results))
+    except Exception as e:
+        record['error'] = str(e)
+    record['seconds'] = round(time.perf_counter() - started, 3)
+    return record
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Render BrandKit formats for a batch of images.')
+    parser.add_argument('inputs', nargs='+', help='image files, directories or glob patterns')
+    parser.add_argument('-o', '--output', required=True, help='directory for the outputs and manifest.json')
+    parser.add_argument('--config', help='format configuration (default: config.json or BRANDKIT_CONFIG)')
+    parser.add_argument('--options', help='JSON file with render options, as in the /upload form')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1, help='worker processes (default: CPU count)')
+    parser.add_argument('--keep-cache', action='store_true', help='keep the render cache in the output directory')
+    parser.add_argument('-v', '--verbose', action='store_true', help='log every render step (BRANDKIT_LOG_LEVEL=DEBUG)')
+    args = parser.parse_args(argv)
+    
+    options = {}
+    if args.options:
+        with open(args.options) as f:
+            options = json.load(f)
+    
+    configure_environment(args.output, args.config, args.verbose)
+    init_worker()
+    paths = collect_images(args.inputs)
+    if not paths:
+        print("No images to render")
+        return 1
+    jobs = [(path, prefix, options) for path, prefix in zip(paths, output_prefixes(paths))]
+    
+    started = time.perf_counter()
+    records = []
+    workers = max(1, min(args.jobs, len(jobs)))
+    print(f"Rendering {len(jobs)} images with {workers} worker processes")
+    # Spawned workers import the app with the environment configured above
+    with multiprocessing.get_context('spawn').Pool(workers, initializer=init_worker) as pool:
+        for record in pool.imap_unordered(render_image, jobs):
+            records.append(record)
+            status = f"error: {record['error']}" if 'error' in record else f"{count_outputs(record['results'], args.output)[0]} outputs"
+            print(f"[{len(records)}/{len(jobs)}] {record['source']}: {status} in {record['seconds']:.2f}s")
+        pool.close()
+        pool.join()
+    elapsed = time.perf_counter() - started
+    
+    if not args.keep_cache:
+        shutil.rmtree(os.path.join(args.output, 'cache'), ignore_errors=True)
+    
+    totals = [count_outputs(r.get('results', {}), args.output) for r in records]
+    outputs, output_bytes = sum(t[0] for t in totals), sum(t[1] for t in totals)
+    megapixels = sum(r['size'][0] * r['size'][1] for r in records if 'size' in r) / 1e6
+    failed = sum(1 for r in records if 'error' in r)
+    summary = {
+        'images': len(records),
+        'failed': failed,
+        'outputs': outputs,
+        'output_bytes': output_bytes,
+        'seconds': round(elapsed, 3),
+        'images_per_second': round(len(records) / elapsed, 2),
+        'megapixels_per_second': round(megapixels / elapsed, 2),
+        'workers': workers,
+    }
+    manifest = {'summary': summary, 'images': sorted(records, key=lambda r: r['source'])}
+    with open(os.path.join(args.output, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    
+    print(f"Rendered {len(records) - failed}/{len(records)} images, {outputs} outputs "
+          f"({output_bytes / (1024 * 1024):.1f} MB) in {elapsed:.2f}s: "
+          f"{summary['images_per_second']} images/s, {summary['megapixels_per_second']} MP/s")
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,10 @@
+// Tailwind CSS configuration used to prebuild static/css/brandkit.css.
+// Rebuild after changing classes in the templates:
+//   npx tailwindcss@3.4.17 -c tailwind.config.js -o static/css/brandkit.css --minify
+module.exports = {
+  content: ['./templates/**/*.html'],
+  theme: {
+    extend: {},
+  },
+  plugins: [],
+}
@@ -0,0 +1,70 @@
+"""Time each image kernel on the Pillow and OpenCV backends.
+
+    python tests/benchmark_kernels.py [--size 2400x1500] [--repeat 5]
+
+Prints the median time of every kernel on both backends and the speedup.
+"""
+import os
+import sys
+import time
+import argparse
+import statistics
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app
+
+def source_image(width, height):
+    """RGBA logo-like image with gradients, noise and hard alpha edges"""
+    rng = np.random.default_rng(0)
+    y, x = np.mgrid[0:height, 0:width]
+    rgb = np.stack([x * 255 // width, y * 255 // height, (x + y) % 256], -1) + rng.normal(0, 8, (height, width, 3))
+    img = Image.fromarray(np.clip(rgb, 0, 255).astype(np.uint8)).convert('RGBA')
+    mask = Image.new('L', img.size, 0)
+    ImageDraw.Draw(mask).ellipse((width // 10, height // 10, width * 9 // 10, height * 9 // 10), fill=255)
+    img.putalpha(mask)
+    return img
+
+def median_ms(func, repeat):
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        times.append((time.perf_counter() - started) * 1000)
+    return statistics.median(times)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the Pillow and OpenCV image kernels.')
+    parser.add_argument('--size', default='2400x1500', help='source size, WIDTHxHEIGHT')
+    parser.add_argument('--repeat', type=int, default=5, help='runs per kernel (median is reported)')
+    args = parser.parse_args(argv)
+    
+    cv2 = app._load_cv2()
+    if cv2 is None:
+        print("OpenCV is not installed; nothing to compare")
+        return 1
+    width, height = (int(v) for v in args.size.lower().split('x'))
+    image = source_image(width, height)
+    alpha = np.asarray(image.getchannel('A'), np.float32)
+    kernels = {
+        'thumbnail 512': lambda k: k.thumbnail(image, (512, 512)),
+        'median_filter 3': lambda k: k.median_filter(image, 3),
+        'median_filter 5': lambda k: k.median_filter(image, 5),
+        'gaussian_blur 2': lambda k: k.gaussian_blur(image, 2),
+        'gaussian_blur 8': lambda k: k.gaussian_blur(image, 8),
+        'unsharp_mask 2': lambda k: k.unsharp_mask(image, 2),
+        'box_filter 4': lambda k: k.box_filter(alpha, 4),
+    }
+    backends = [app.PillowKernels(), app.OpenCVKernels(cv2)]
+    
+    print(f"{width}x{height} RGBA, median of {args.repeat} runs")
+    print(f"{'kernel':<18}{'pillow ms':>12}{'opencv ms':>12}{'speedup':>10}")
+    for name, kernel in kernels.items():
+        pillow_ms, opencv_ms = (median_ms(lambda: kernel(backend), args.repeat) for backend in backends)
+        print(f"{name:<18}{pillow_ms:>12.1f}{opencv_ms:>12.1f}{pillow_ms / opencv_ms:>9.1f}x")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,22 @@
+import os
+import sys
+
+import pytest
+
+# Tests import the app module from the repository root
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+import app as brandkit
+
+@pytest.fixture
+def client():
+    """Test client with CSRF checks and rate limits off"""
+    brandkit.app.config['WTF_CSRF_ENABLED'] = False
+    brandkit.limiter.enabled = False
+    try:
+        yield brandkit.app.test_client()
+    finally:
+        brandkit.app.config['WTF_CSRF_ENABLED'] = True
+        brandkit.limiter.enabled = True
@@ -0,0 +1,89 @@
+"""Renders are admitted by estimated cost, queued FIFO, and rejected with a status to retry on"""
+import io
+import threading
+import time
+
+import pytest
+from PIL import Image
+
+import app
+
+@pytest.fixture
+def isolated(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, 'storage', app.LocalStorage(str(tmp_path)))
+    monkeypatch.setattr(app, 'COALESCE_DIR', str(tmp_path / 'coalesce'))
+
+def upload(client, size=(64, 64)):
+    buf = io.BytesIO()
+    Image.new('RGBA', size, (30, 90, 200, 255)).save(buf, 'PNG')
+    return client.post('/upload', data={
+        'file': (io.BytesIO(buf.getvalue()), 'logo.png'),
+        'selected_formats': ['social'],
+        'output_formats': ['png'],
+    }, content_type='multipart/form-data')
+
+def test_admitted_upload_reports_its_estimate(client, isolated, monkeypatch):
+    monkeypatch.setattr(app, 'admission_controller', app.AdmissionController(capacity=10000, memory_mb=4096, max_queue=4, queue_timeout=1))
+    response = upload(client)
+    assert response.status_code == 200
+    admission = response.get_json()['admission']
+    assert admission['estimated_work'] >= 1 and admission['estimated_memory_mb'] > 0
+    assert admission['queue_position'] == 0
+    assert app.admission_controller.status()['work_in_use'] == 0
+
+def test_render_over_the_memory_budget_is_413(client, isolated, monkeypatch):
+    monkeypatch.setattr(app, 'admission_controller', app.AdmissionController(capacity=10000, memory_mb=10, max_queue=4, queue_timeout=1))
+    response = upload(client)
+    assert response.status_code == 413
+    assert 'too large' in response.get_json()['error']
+    assert 'Retry-After' not in response.headers
+
+def test_full_queue_is_503_with_retry_after(client, isolated, monkeypatch):
+    monkeypatch.setattr(app, 'admission_controller', app.AdmissionController(capacity=10000, memory_mb=4096, max_queue=0, queue_timeout=1))
+    response = upload(client)
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == '5'
+
+def test_queue_timeout_is_503():
+    controller = app.AdmissionController(capacity=10, memory_mb=1000, max_queue=4, queue_timeout=0.1)
+    held = controller.acquire({'work': 10, 'memory_mb': 1})
+    with pytest.raises(app.AdmissionRejected) as rejected:
+        controller.acquire({'work': 1, 'memory_mb': 1})
+    assert rejected.value.status == 503 and rejected.value.retry_after
+    controller.release(held)
+    assert controller.status()['queued'] == 0
+
+def test_cheap_renders_do_not_overtake_the_queue_head():
+    controller = app.AdmissionController(capacity=10, memory_mb=1000, max_queue=4, queue_timeout=5)
+    held = controller.acquire({'work': 6, 'memory_mb': 1})
+    started = []
+    def render(name, work):
+        ticket = controller.acquire({'work': work, 'memory_mb': 1})
+        started.append(name)
+        controller.release(ticket)
+    heavy = threading.Thread(target=render, args=('heavy', 6))
+    heavy.start()
+    while controller.status()['queued'] < 1:
+        time.sleep(0.01)
+    # One unit fits beside the held render, but not beside it and the waiting head
+    cheap = threading.Thread(target=render, args=('cheap', 1))
+    cheap.start()
+    time.sleep(0.2)
+    assert started == []
+    # Once the held render ends, both fit
+    controller.release(held)
+    heavy.join(5)
+    cheap.join(5)
+    assert sorted(started) == ['cheap', 'heavy']
+
+def test_cost_grows_with_source_size_and_variations():
+    formats = app.load_config()['formats']
+    small = app.estimate_render_cost((500, 500), formats, ['social'], ['png'])
+    large = app.estimate_render_cost((4000, 4000), formats, ['social'], ['png'])
+    variations = app.estimate_render_cost((500, 500), formats, ['social'], ['png'], variations_mode=True)
+    assert large['work'] > small['work'] and large['memory_mb'] > small['memory_mb']
+    assert variations['work'] > small['work']
+    # Aliased formats share one render
+    website = app.estimate_render_cost((500, 500), formats, ['website'], ['png'])
+    both = app.estimate_render_cost((500, 500), formats, ['website', 'facebook'], ['png'])
+    assert both == website
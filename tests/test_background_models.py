@@ -0,0 +1,25 @@
+"""Background removal methods resolve to rembg models the mask batcher can batch"""
+import numpy as np
+import pytest
+from PIL import Image
+
+import app
+
+@pytest.mark.parametrize('method, model', [
+    ('auto', 'u2net'),
+    ('object', 'u2net'),
+    ('person', 'u2net_human_seg'),
+    ('anime', 'isnet-anime'),
+])
+def test_methods_use_batchable_models(method, model, monkeypatch):
+    resolved = []
+    
+    def predict(model_name, proxy, deadline=None):
+        resolved.append(model_name)
+        return np.full((proxy.height, proxy.width), 255, dtype=np.uint8)
+    monkeypatch.setattr(app, 'REMBG_AVAILABLE', True)
+    monkeypatch.setattr(app, 'predict_background_mask', predict)
+    monkeypatch.setattr(app, '_background_mask_cache', {})
+    app.remove_background(Image.new('RGB', (64, 64), (255, 255, 255)), method=method)
+    assert resolved == [model]
+    assert model in app.BATCHABLE_MODELS
@@ -0,0 +1,65 @@
+"""Background removal segments a downscaled proxy and upsamples the mask along image edges"""
+import numpy as np
+import pytest
+from PIL import Image, ImageFilter
+
+import app
+
+@pytest.fixture
+def segmented(monkeypatch):
+    """Proxies passed to the model; the fake model keeps the left half of each"""
+    proxies = []
+    def predict(model_name, proxy, deadline=None):
+        proxies.append(proxy.size)
+        mask = np.zeros((proxy.height, proxy.width), dtype=np.uint8)
+        mask[:, :proxy.width // 2] = 255
+        return mask
+    monkeypatch.setattr(app, 'REMBG_AVAILABLE', True)
+    monkeypatch.setattr(app, 'predict_background_mask', predict)
+    monkeypatch.setattr(app, '_background_mask_cache', {})
+    return proxies
+
+def split_image(width, height):
+    """A red object on the left half of a white image"""
+    img = Image.new('RGB', (width, height), (255, 255, 255))
+    img.paste((200, 30, 40), (0, 0, width // 2, height))
+    return img
+
+def test_segmentation_runs_on_a_bounded_proxy(segmented):
+    result = app.remove_background(split_image(2000, 1000))
+    assert segmented == [(app.BG_PROXY_SIZE, app.BG_PROXY_SIZE // 2)]
+    assert result.size == (2000, 1000)
+    alpha = np.asarray(result.getchannel('A'))
+    assert alpha[:, :900].min() == 255 and alpha[:, 1100:].max() == 0
+
+def test_proxy_size_zero_segments_full_resolution(segmented):
+    app.remove_background(split_image(600, 300), proxy_size=0)
+    assert segmented == [(600, 300)]
+
+def test_masks_are_reused_for_the_same_proxy(segmented):
+    image = split_image(1600, 800)
+    first = app.remove_background(image)
+    second = app.remove_background(image.copy())
+    assert len(segmented) == 1
+    assert first.tobytes() == second.tobytes()
+
+def test_upsampled_mask_follows_image_edges():
+    image = split_image(800, 400)
+    ideal = np.zeros((400, 800), dtype=np.uint8)
+    ideal[:, :400] = 255
+    # A coarse, soft mask as a model would return for a 100x50 proxy
+    coarse = Image.fromarray(ideal).resize((100, 50), Image.BOX).filter(ImageFilter.GaussianBlur(1))
+    
+    refined = np.asarray(app.upsample_mask(coarse, image), dtype=np.float32)
+    bilinear = np.asarray(coarse.resize(image.size, Image.BILINEAR), dtype=np.float32)
+    # The soft band snaps to a step at the image edge, between columns 399 and 400
+    steps = refined[:, :-1] - refined[:, 1:]
+    assert (steps.argmax(axis=1) == 399).all()
+    assert steps[:, 399].min() > 2 * (bilinear[:, :-1] - bilinear[:, 1:]).max()
+    # Away from the boundary the upscaled value is kept
+    assert (refined[:, :300] == bilinear[:, :300]).all()
+    assert (refined[:, 500:] == bilinear[:, 500:]).all()
+
+def test_masks_at_image_size_are_not_resampled():
+    mask = Image.new('L', (80, 40), 128)
+    assert app.upsample_mask(mask, split_image(80, 40)).tobytes() == mask.tobytes()
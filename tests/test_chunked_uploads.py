@@ -0,0 +1,65 @@
+"""Chunked uploads survive failed renders until one succeeds"""
+import io
+import json
+
+import pytest
+from PIL import Image
+
+import app
+
+@pytest.fixture(autouse=True)
+def isolated_dirs(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, 'CHUNK_UPLOAD_DIR', str(tmp_path / 'chunks'))
+    monkeypatch.setattr(app, 'COALESCE_DIR', str(tmp_path / 'coalesce'))
+    monkeypatch.setattr(app, 'storage', app.LocalStorage(str(tmp_path / 'outputs')))
+
+def png_bytes():
+    buf = io.BytesIO()
+    Image.new('RGBA', (320, 200), (30, 90, 200, 255)).save(buf, 'PNG')
+    return buf.getvalue()
+
+def send_chunked(client, data):
+    upload = client.post('/uploads', json={'filename': 'logo.png', 'size': len(data)}).get_json()
+    size = upload['chunk_size']
+    for index in upload['missing']:
+        response = client.put(f"/uploads/{upload['upload_id']}/chunks/{index}", data=data[index * size:(index + 1) * size])
+        assert response.status_code == 200
+    return upload['upload_id']
+
+def finalize(client, upload_id, stream=False):
+    headers = {'Accept': 'application/x-ndjson'} if stream else {}
+    return client.post(f'/uploads/{upload_id}/finalize', headers=headers, data={
+        'selected_formats': ['website'],
+        'output_formats': ['png'],
+    })
+
+def test_rejected_render_keeps_upload(client, monkeypatch):
+    upload_id = send_chunked(client, png_bytes())
+    
+    def reject(cost, timeout=None):
+        raise app.AdmissionRejected('Server busy', status=503, retry_after=5)
+    with monkeypatch.context() as patch:
+        patch.setattr(app.admission_controller, 'acquire', reject)
+        assert finalize(client, upload_id).status_code == 503
+    
+    # Still complete on the server, so the client can finalize again
+    assert client.get(f'/uploads/{upload_id}').get_json()['missing'] == []
+    response = finalize(client, upload_id)
+    assert response.status_code == 200
+    assert response.get_json()['success']
+    assert client.get(f'/uploads/{upload_id}').status_code == 404
+
+def test_failed_streamed_render_keeps_upload(client, monkeypatch):
+    upload_id = send_chunked(client, png_bytes())
+    
+    def fail(*args, **kwargs):
+        raise RuntimeError('render failed')
+    with monkeypatch.context() as patch:
+        patch.setattr(app, 'render_upload', fail)
+        events = [json.loads(line) for line in finalize(client, upload_id, stream=True).get_data(as_text=True).splitlines()]
+    assert events[-1]['type'] == 'error'
+    assert client.get(f'/uploads/{upload_id}').status_code == 200
+    
+    events = [json.loads(line) for line in finalize(client, upload_id, stream=True).get_data(as_text=True).splitlines()]
+    assert events[-1]['type'] == 'done'
+    assert client.get(f'/uploads/{upload_id}').status_code == 404
@@ -0,0 +1,68 @@
+"""cli.py renders batches of images into an output directory with a manifest"""
+import json
+import os
+import subprocess
+import sys
+
+from PIL import Image
+
+import app
+import cli
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def run_cli(*args):
+    return subprocess.run([sys.executable, os.path.join(ROOT, 'cli.py'), *args], cwd=ROOT, capture_output=True, text=True, timeout=300)
+
+def write_logo(path, color):
+    Image.new('RGBA', (120, 80), color).save(path)
+
+def test_batch_render(tmp_path):
+    (tmp_path / 'a').mkdir()
+    (tmp_path / 'b').mkdir()
+    write_logo(tmp_path / 'a' / 'logo.png', (200, 40, 60, 255))
+    write_logo(tmp_path / 'b' / 'logo.png', (40, 60, 200, 255))
+    (tmp_path / 'a' / 'notes.txt').write_text('not an image')
+    options = tmp_path / 'options.json'
+    options.write_text(json.dumps({'selected_formats': ['website', 'favicon'], 'output_formats': ['png', 'ico'], 'grayscale': True}))
+    output = tmp_path / 'out'
+    
+    result = run_cli(str(tmp_path / 'a'), str(tmp_path / 'b' / '*.png'), '-o', str(output), '--options', str(options), '-j', '2')
+    assert result.returncode == 0, result.stderr
+    
+    manifest = json.loads((output / 'manifest.json').read_text())
+    assert manifest['summary']['images'] == 2 and manifest['summary']['failed'] == 0
+    # Same file names get distinct prefixes
+    assert sorted(image['prefix'] for image in manifest['images']) == ['logo', 'logo_2']
+    for image in manifest['images']:
+        assert set(image['results']) == {'website', 'favicon_ico'}
+        website = image['results']['website']['outputs']['png']
+        assert 'url' not in website and 'path' not in website
+        with Image.open(output / website['key']) as png:
+            assert png.size == (1200, 630)
+        assert (output / image['results']['favicon_ico']['key']).exists()
+    assert manifest['summary']['outputs'] == 4
+    # The render cache is removed unless --keep-cache is given
+    assert not (output / 'cache').exists()
+
+def test_failed_images_are_reported(tmp_path):
+    (tmp_path / 'broken.png').write_bytes(b'not a png')
+    write_logo(tmp_path / 'logo.png', (200, 40, 60, 255))
+    output = tmp_path / 'out'
+    result = run_cli(str(tmp_path / '*.png'), '-o', str(output), '-j', '1')
+    assert result.returncode == 1
+    manifest = json.loads((output / 'manifest.json').read_text())
+    errors = {os.path.basename(image['source']): 'error' in image for image in manifest['images']}
+    assert errors == {'broken.png': True, 'logo.png': False}
+
+def test_no_matching_inputs(tmp_path):
+    result = run_cli(str(tmp_path / '*.png'), '-o', str(tmp_path / 'out'))
+    assert result.returncode == 1
+    assert 'No images to render' in result.stdout
+
+def test_options_become_form_fields():
+    form = cli.options_form({'selected_formats': ['website', 'favicon'], 'grayscale': True, 'invert': False, 'quality': 90})
+    assert form.getlist('selected_formats') == ['website', 'favicon']
+    assert form['grayscale'] == 'true' and form['invert'] == 'false' and form['quality'] == '90'
+    render_options = app.parse_render_options(form, app.load_config())
+    assert render_options['preprocessing_options']['grayscale'] and render_options['quality'] == 90
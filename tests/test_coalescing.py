@@ -0,0 +1,139 @@
+"""Identical renders share one response instead of each running the pipeline"""
+import io
+import json
+import threading
+import time
+
+import pytest
+from PIL import Image
+
+import app
+
+FORMATS = ['square_logo_small', 'favicon']
+
+@pytest.fixture(autouse=True)
+def isolated(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, 'storage', app.LocalStorage(str(tmp_path)))
+    monkeypatch.setattr(app, 'COALESCE_DIR', str(tmp_path / 'coalesce'))
+    monkeypatch.setattr(app.admission_controller, 'memory_mb', 4096)
+
+@pytest.fixture
+def renders(monkeypatch):
+    calls = []
+    render_upload = app.render_upload
+    def counted(*args, **kwargs):
+        calls.append(args[2])
+        return render_upload(*args, **kwargs)
+    monkeypatch.setattr(app, 'render_upload', counted)
+    return calls
+
+def upload(client, filename='logo.png', headers=None, **form):
+    buf = io.BytesIO()
+    Image.new('RGBA', (64, 64), (30, 90, 200, 255)).save(buf, 'PNG')
+    data = {'file': (io.BytesIO(buf.getvalue()), filename), 'selected_formats': FORMATS, 'output_formats': ['png', 'ico']}
+    return client.post('/upload', data={**data, **form}, headers=headers or {}, content_type='multipart/form-data')
+
+def test_flight_key_is_canonical():
+    options = {'grayscale': False, 'preprocessing_options': {'padding': 10, 'trim': True}}
+    reordered = {'preprocessing_options': {'trim': True, 'padding': 10}, 'grayscale': False}
+    assert app.render_flight_key('abc', 'logo', options) == app.render_flight_key('abc', 'logo', reordered)
+    assert app.render_flight_key('abc', 'logo', options) != app.render_flight_key('abc', 'brand', options)
+    assert app.render_flight_key('abc', 'logo', options) != app.render_flight_key('abc', 'logo', dict(options, grayscale=True))
+
+def test_waiting_request_gets_the_published_response():
+    leader = app.RenderFlight('key')
+    assert leader.join(timeout=1) is None
+    shared = []
+    follower = threading.Thread(target=lambda: shared.append(app.RenderFlight('key').join(timeout=5)))
+    follower.start()
+    time.sleep(0.1)
+    leader.publish({'success': True, 'results': {}}, 200)
+    leader.release()
+    follower.join(5)
+    assert shared == [{'success': True, 'results': {}}]
+
+@pytest.mark.parametrize('response,status', [({'error': 'boom'}, 500), ({'success': True, 'partial': True}, 200)])
+def test_failed_or_partial_render_is_not_shared(response, status):
+    leader = app.RenderFlight('key')
+    assert leader.join(timeout=1) is None
+    follower = app.RenderFlight('key')
+    shared = []
+    thread = threading.Thread(target=lambda: shared.append(follower.join(timeout=5)))
+    thread.start()
+    time.sleep(0.1)
+    leader.publish(response, status)
+    leader.release()
+    thread.join(5)
+    # The follower renders for itself
+    assert shared == [None]
+    follower.release()
+
+def test_join_gives_up_at_the_timeout():
+    leader = app.RenderFlight('key')
+    assert leader.join(timeout=1) is None
+    started = time.monotonic()
+    assert app.RenderFlight('key').join(timeout=0.2) is None
+    assert time.monotonic() - started < 2
+    leader.release()
+
+def test_concurrent_identical_uploads_render_once(client, renders, monkeypatch):
+    release = threading.Event()
+    render_upload = app.render_upload
+    def blocked(*args, **kwargs):
+        release.wait(10)
+        return render_upload(*args, **kwargs)
+    monkeypatch.setattr(app, 'render_upload', blocked)
+    bodies = []
+    def post():
+        bodies.append(upload(app.app.test_client()).get_json())
+    threads = [threading.Thread(target=post) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+        time.sleep(0.3)
+    release.set()
+    for thread in threads:
+        thread.join(30)
+    assert len(renders) == 1
+    assert all(body['success'] for body in bodies)
+    assert sorted(body.get('coalesced', False) for body in bodies) == [False, True]
+    assert bodies[0]['results']['square_logo_small'] == bodies[1]['results']['square_logo_small']
+
+def test_recent_response_is_reused_across_workers(client, renders):
+    first = upload(client).get_json()
+    # Only the shared response file is left, as another worker would find it
+    assert not app._flights
+    second = upload(client).get_json()
+    assert len(renders) == 1
+    assert second['coalesced'] and second['results'] == first['results']
+
+def test_window_zero_disables_reuse(client, renders, monkeypatch):
+    monkeypatch.setattr(app, 'COALESCE_WINDOW_S', 0)
+    upload(client)
+    assert not upload(client).get_json().get('coalesced')
+    assert len(renders) == 2
+
+def test_different_name_or_options_render_again(client, renders):
+    upload(client)
+    assert not upload(client, filename='brand.png').get_json().get('coalesced')
+    assert not upload(client, grayscale='true').get_json().get('coalesced')
+    assert len(renders) == 3
+
+def test_failed_upload_lets_the_next_one_render(client, renders, monkeypatch):
+    render_upload = app.render_upload
+    outcomes = iter([({'error': 'boom'}, 500)])
+    monkeypatch.setattr(app, 'render_upload', lambda *args, **kwargs: next(outcomes, None) or render_upload(*args, **kwargs))
+    assert upload(client).status_code == 500
+    body = upload(client).get_json()
+    assert body['success'] and not body.get('coalesced')
+    assert len(renders) == 1
+
+def test_streamed_request_replays_the_shared_response(client, renders):
+    first = upload(client).get_json()
+    response = upload(client, headers={'Accept': 'application/x-ndjson'})
+    assert response.mimetype == 'application/x-ndjson'
+    events = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    assert events[0]['type'] == 'start' and events[0]['original'] == first['results']['original']
+    results = {event['key']: event['result'] for event in events if event['type'] == 'result'}
+    assert results['square_logo_small'] == first['results']['square_logo_small']
+    assert events[-1]['type'] == 'done' and events[-1]['coalesced']
+    assert len(renders) == 1
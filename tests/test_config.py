@@ -0,0 +1,7 @@
+"""Shipped format configuration"""
+import app
+
+def test_print_formats_upload_full_resolution():
+    formats = app.load_config()['formats']
+    assert formats['print_a4']['full_resolution_upload']
+    assert formats['print_letter']['full_resolution_upload']
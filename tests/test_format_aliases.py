@@ -0,0 +1,47 @@
+"""Formats with the same geometry are rendered and encoded once"""
+import os
+
+import pytest
+from PIL import Image
+
+import app
+
+@pytest.fixture
+def storage(tmp_path, monkeypatch):
+    storage = app.LocalStorage(str(tmp_path / 'outputs'))
+    monkeypatch.setattr(app, 'storage', storage)
+    return storage
+
+@pytest.fixture
+def source(tmp_path):
+    path = tmp_path / 'logo.png'
+    img = Image.new('RGBA', (400, 300), (255, 255, 255, 0))
+    img.paste((30, 90, 200, 255), (100, 75, 300, 225))
+    img.save(path)
+    return str(path)
+
+def test_same_geometry_formats_share_one_encode(storage, source, monkeypatch):
+    encodes = []
+    optimize_image = app.optimize_image
+    def counting_optimize_image(img, output_format, *args, **kwargs):
+        encodes.append((img.size, output_format))
+        return optimize_image(img, output_format, *args, **kwargs)
+    monkeypatch.setattr(app, 'optimize_image', counting_optimize_image)
+    
+    # website and facebook are both 1200x630 in the shipped configuration
+    results = app.generate_formats(source, 'logo', ['website', 'facebook', 'square_1024'], ['png', 'jpg'], {}, fill_white_with_prominent=False, thumbnails=False)
+    
+    assert sorted(encodes) == [((1024, 1024), 'jpg'), ((1024, 1024), 'png'), ((1200, 630), 'jpg'), ((1200, 630), 'png')]
+    assert results['facebook']['alias_of'] == 'website'
+    assert 'alias_of' not in results['website'] and 'alias_of' not in results['square_1024']
+    for output_format in ('png', 'jpg'):
+        website = storage.local_path(f'logo_website.{output_format}')
+        facebook = storage.local_path(f'logo_facebook.{output_format}')
+        assert storage.get(f'logo_website.{output_format}') == storage.get(f'logo_facebook.{output_format}')
+        assert os.path.samefile(website, facebook)
+        assert results['facebook']['outputs'][output_format]['url'] != results['website']['outputs'][output_format]['url']
+
+def test_aliases_keep_configured_order(storage, source):
+    results = app.generate_formats(source, 'logo', ['facebook', 'website'], ['png'], {}, fill_white_with_prominent=False, thumbnails=False)
+    config_order = [name for name in app.load_config()['formats'] if name in results]
+    assert list(results) == config_order
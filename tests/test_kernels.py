@@ -0,0 +1,112 @@
+"""Parity of the OpenCV image kernels with the Pillow reference kernels"""
+import numpy as np
+import pytest
+from PIL import Image, ImageDraw
+
+import app
+
+cv2 = pytest.importorskip('cv2')
+
+PILLOW = app.PillowKernels()
+OPENCV = app.OpenCVKernels(cv2)
+
+def logo_image():
+    """Flat shapes with hard alpha edges"""
+    img = Image.new('RGBA', (600, 400), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(img)
+    draw.ellipse((40, 40, 560, 360), fill=(220, 40, 60, 255))
+    draw.rectangle((200, 130, 400, 270), fill=(255, 255, 255, 255))
+    return img
+
+def photo_image():
+    """Smooth gradients with noise"""
+    rng = np.random.default_rng(0)
+    y, x = np.mgrid[0:400, 0:600]
+    arr = np.stack([x * 255 // 600, y * 255 // 400, (x + y) % 256], -1) + rng.normal(0, 12, (400, 600, 3))
+    return Image.fromarray(np.clip(arr, 0, 255).astype(np.uint8))
+
+def line_art_image():
+    """One-pixel white lines on black: the largest differences an unsharp mask sees"""
+    img = Image.new('L', (600, 400), 0)
+    draw = ImageDraw.Draw(img)
+    for x in range(10, 600, 20):
+        draw.line((x, 0, x, 399), fill=255)
+    for y in range(10, 400, 40):
+        draw.text((15, y), "BrandKit 0123456789", fill=255)
+    return img
+
+IMAGES = {'logo': logo_image(), 'photo': photo_image(), 'line_art': line_art_image()}
+
+def difference(expected, actual):
+    """Mean and 99th percentile of the absolute per-channel difference"""
+    assert expected.mode == actual.mode and expected.size == actual.size
+    if expected.mode == 'RGBA':
+        # Colour under (nearly) transparent pixels is invisible; compare what is shown
+        expected, actual = expected.convert('RGBa'), actual.convert('RGBa')
+    diff = np.abs(np.asarray(expected, np.int16) - np.asarray(actual, np.int16))
+    return float(diff.mean()), float(np.percentile(diff, 99))
+
+# (kernel call, max mean difference, max 99th percentile difference)
+KERNELS = {
+    # INTER_AREA and Lanczos differ only at antialiased edges
+    'thumbnail': (lambda k, img: k.thumbnail(img, (150, 150)), 1.5, 12),
+    'median_3': (lambda k, img: k.median_filter(img, 3), 0, 0),
+    'median_5': (lambda k, img: k.median_filter(img, 5), 0, 0),
+    # Pillow approximates the Gaussian with box blurs
+    'gaussian_blur_1': (lambda k, img: k.gaussian_blur(img, 1), 0.6, 3),
+    'gaussian_blur_4': (lambda k, img: k.gaussian_blur(img, 4), 0.6, 3),
+    'unsharp_mask_1': (lambda k, img: k.unsharp_mask(img, 1, 150, 3), 1.0, 8),
+    'unsharp_mask_2': (lambda k, img: k.unsharp_mask(img, 2, 150, 3), 1.0, 8),
+    'unsharp_mask_strong': (lambda k, img: k.unsharp_mask(img, 2, 300, 0), 1.5, 12),
+}
+
+@pytest.mark.parametrize('image_name', sorted(IMAGES))
+@pytest.mark.parametrize('kernel_name', sorted(KERNELS))
+def test_opencv_matches_pillow(kernel_name, image_name):
+    kernel, max_mean, max_p99 = KERNELS[kernel_name]
+    if kernel_name == 'thumbnail' and image_name == 'line_art':
+        pytest.skip("one-pixel lines alias differently under INTER_AREA and Lanczos by design")
+    image = IMAGES[image_name]
+    mean, p99 = difference(kernel(PILLOW, image), kernel(OPENCV, image))
+    assert mean <= max_mean and p99 <= max_p99, f"mean {mean:.3f}, p99 {p99:.0f}"
+
+@pytest.mark.parametrize('image_name', sorted(IMAGES))
+def test_box_filter_matches(image_name):
+    arr = np.asarray(IMAGES[image_name].convert('L'), np.float32)
+    np.testing.assert_allclose(OPENCV.box_filter(arr, 3), PILLOW.box_filter(arr, 3), atol=1e-3)
+
+def test_unsharp_mask_hard_edges_do_not_wrap():
+    # White lines on black sharpen to white and black, never to the opposite value
+    sharpened = np.asarray(OPENCV.unsharp_mask(IMAGES['line_art'], 2, 200, 3))
+    lines = np.asarray(IMAGES['line_art']) == 255
+    assert sharpened[lines].min() == 255
+
+def test_unsupported_modes_fall_back_to_pillow():
+    image = IMAGES['photo'].convert('CMYK')
+    assert OPENCV.gaussian_blur(image, 2).tobytes() == PILLOW.gaussian_blur(image, 2).tobytes()
+    assert OPENCV.unsharp_mask(image, 2).tobytes() == PILLOW.unsharp_mask(image, 2).tobytes()
+
+@pytest.mark.parametrize('backend, cv2_available, expected', [
+    ('auto', True, 'opencv'),
+    ('auto', False, 'pillow'),
+    ('opencv', False, 'pillow'),
+    ('pillow', True, 'pillow'),
+])
+def test_backend_selection(monkeypatch, backend, cv2_available, expected):
+    monkeypatch.setattr(app, '_kernels', None)
+    monkeypatch.setattr(app, 'load_config', lambda: {'kernel_backend': backend})
+    monkeypatch.setattr(app, '_load_cv2', lambda: cv2 if cv2_available else None)
+    assert app.get_kernels().name == expected
+    # Resolved once per process
+    monkeypatch.setattr(app, 'load_config', lambda: {'kernel_backend': 'pillow' if expected == 'opencv' else 'opencv'})
+    assert app.get_kernels().name == expected
+
+def test_preprocessing_uses_the_selected_backend(monkeypatch):
+    calls = []
+    class RecordingKernels(app.PillowKernels):
+        def gaussian_blur(self, image, radius):
+            calls.append(radius)
+            return super().gaussian_blur(image, radius)
+    monkeypatch.setattr(app, '_kernels', RecordingKernels())
+    app.preprocess_image(IMAGES['logo'].copy(), {'apply_blur': True, 'blur_radius': 3.0})
+    assert calls == [3.0]
@@ -0,0 +1,76 @@
+"""Logging is queued off the emitting thread and tagged with the request's correlation id"""
+import contextvars
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+import time
+
+import app
+
+class SlowHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.records = []
+    
+    def emit(self, record):
+        time.sleep(0.05)
+        self.records.append(record)
+
+def queued_logger(handler):
+    log_queue = queue.SimpleQueue()
+    queue_handler = app.LogQueueHandler(log_queue)
+    queue_handler.addFilter(app.CorrelationIdFilter())
+    test_logger = logging.getLogger('brandkit.test')
+    test_logger.handlers[:] = [queue_handler]
+    test_logger.propagate = False
+    test_logger.setLevel(logging.DEBUG)
+    listener = logging.handlers.QueueListener(log_queue, handler)
+    listener.start()
+    return test_logger, listener
+
+def test_emitting_does_not_wait_for_the_handler():
+    handler = SlowHandler()
+    test_logger, listener = queued_logger(handler)
+    started = time.perf_counter()
+    for i in range(20):
+        test_logger.info("render step %d", i)
+    assert time.perf_counter() - started < 0.5
+    listener.stop()
+    assert [record.msg for record in handler.records] == [f"render step {i}" for i in range(20)]
+
+def test_records_carry_the_correlation_id_across_threads():
+    handler = SlowHandler()
+    test_logger, listener = queued_logger(handler)
+    token = app.correlation_id.set('req-42')
+    try:
+        # Render and warm-up threads are started with a copy of the request context
+        worker = threading.Thread(target=contextvars.copy_context().run, args=(test_logger.info, "from a render thread"))
+        worker.start()
+        worker.join()
+    finally:
+        app.correlation_id.reset(token)
+    test_logger.info("after the request")
+    listener.stop()
+    assert [record.correlation_id for record in handler.records] == ['req-42', '-']
+
+def test_json_format():
+    try:
+        raise ValueError("bad pixel")
+    except ValueError:
+        record = logging.LogRecord('brandkit', logging.ERROR, __file__, 1, "render of %s failed", ('logo',), sys.exc_info())
+    record.correlation_id = 'req-42'
+    record.format_name = 'website'
+    entry = json.loads(app.JsonLogFormatter().format(record))
+    assert entry['message'] == 'render of logo failed'
+    assert entry['level'] == 'ERROR' and entry['correlation_id'] == 'req-42'
+    assert entry['format_name'] == 'website'
+    assert 'ValueError: bad pixel' in entry['exception']
+
+def test_request_ids(client):
+    assert client.get('/format-info', headers={'X-Request-ID': 'abc-123'}).headers['X-Request-ID'] == 'abc-123'
+    generated = client.get('/format-info', headers={'X-Request-ID': 'not valid!'}).headers['X-Request-ID']
+    assert generated != 'not valid!' and len(generated) == 16
+    assert client.get('/format-info').headers['X-Request-ID'] != generated
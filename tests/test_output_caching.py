@@ -0,0 +1,54 @@
+"""Generated outputs carry content-hash ETags, support ranges and are immutable under versioned URLs"""
+import pytest
+
+import app
+
+DATA = bytes(range(256)) * 8
+
+@pytest.fixture(params=['local', 'memory'])
+def storage(request, tmp_path, monkeypatch):
+    storage = app.LocalStorage(str(tmp_path)) if request.param == 'local' else app.MemoryStorage(max_bytes=1024 * 1024)
+    monkeypatch.setattr(app, 'storage', storage)
+    storage.put('logo_website.png', DATA)
+    return storage
+
+def versioned_url(key):
+    with app.app.test_request_context():
+        return app.output_entry(key)['url']
+
+def test_versioned_url_is_immutable(client, storage):
+    url = versioned_url('logo_website.png')
+    response = client.get(url)
+    assert response.status_code == 200
+    assert response.data == DATA
+    assert response.headers['ETag'].strip('"') == storage.digest('logo_website.png')
+    cache_control = response.headers['Cache-Control']
+    assert 'immutable' in cache_control and 'max-age=31536000' in cache_control and 'public' in cache_control
+
+def test_unversioned_url_revalidates(client, storage):
+    response = client.get('/outputs/logo_website.png')
+    assert response.status_code == 200
+    assert response.headers['Cache-Control'] == 'no-cache'
+    response = client.get('/outputs/logo_website.png', headers={'If-None-Match': response.headers['ETag']})
+    assert response.status_code == 304
+    assert response.data == b''
+
+def test_changed_content_gets_a_new_url(client, storage):
+    old_url = versioned_url('logo_website.png')
+    storage.put('logo_website.png', DATA[::-1])
+    new_url = versioned_url('logo_website.png')
+    assert new_url != old_url
+    # The old version string no longer matches, so it is not cached as immutable
+    response = client.get(old_url)
+    assert response.data == DATA[::-1]
+    assert response.headers['Cache-Control'] == 'no-cache'
+
+def test_range_requests(client, storage):
+    response = client.get('/outputs/logo_website.png', headers={'Range': 'bytes=100-199'})
+    assert response.status_code == 206
+    assert response.data == DATA[100:200]
+    assert response.headers['Content-Range'] == f'bytes 100-199/{len(DATA)}'
+
+def test_missing_and_invalid_keys(client, storage):
+    assert client.get('/outputs/nothing.png').status_code == 404
+    assert client.get('/outputs/../app.py').status_code == 404
@@ -0,0 +1,64 @@
+"""Watermarks and drop shadows are composited over the affected region only"""
+import numpy as np
+import pytest
+from PIL import Image, ImageDraw
+
+import app
+
+@pytest.fixture(autouse=True)
+def empty_caches(monkeypatch):
+    monkeypatch.setattr(app, '_text_layer_cache', {})
+    monkeypatch.setattr(app, '_shadow_mask_cache', {})
+
+def logo(size=(600, 400)):
+    img = Image.new('RGBA', size, (0, 0, 0, 0))
+    ImageDraw.Draw(img).ellipse((100, 80, 500, 320), fill=(220, 40, 60, 255))
+    return img
+
+def full_canvas_watermark(image, text, opacity):
+    """The whole-image overlay the region compositing replaces"""
+    font = app.get_font("Arial", 36)
+    watermark = Image.new('RGBA', image.size, (0, 0, 0, 0))
+    draw = ImageDraw.Draw(watermark)
+    text_width, text_height = draw.textbbox((0, 0), text, font=font)[2:4]
+    draw.text((image.width - text_width - 20, image.height - text_height - 20), text, fill=(255, 255, 255, opacity), font=font)
+    return Image.alpha_composite(image, watermark)
+
+@pytest.mark.parametrize('size', [(600, 400), (40, 30)])
+def test_watermark_matches_full_canvas_compositing(size):
+    image = logo(size)
+    options = {'add_watermark': True, 'watermark_text': '© BrandKit', 'watermark_opacity': 0.5}
+    result = app.preprocess_image(image, options)
+    assert result.tobytes() == full_canvas_watermark(image, '© BrandKit', 127).tobytes()
+
+def test_watermark_leaves_the_source_untouched():
+    image = logo()
+    before = image.tobytes()
+    app.preprocess_image(image, {'add_watermark': True, 'watermark_text': 'Draft'})
+    assert image.tobytes() == before
+
+def test_shadow_mask_matches_a_full_image_blur():
+    alpha = logo().getchannel('A')
+    mask, (x, y) = app.get_shadow_mask(alpha, 4, 0.3)
+    assert mask.size[0] < alpha.width or mask.size[1] < alpha.height
+    placed = Image.new('L', alpha.size, 0)
+    placed.paste(mask, (x, y))
+    reference = app.get_kernels().gaussian_blur(alpha, 4).point(lambda value: int(value * 0.3))
+    assert np.abs(np.asarray(placed, dtype=np.int16) - np.asarray(reference, dtype=np.int16)).max() <= 1
+
+def test_shadow_masks_are_reused():
+    alpha = logo().getchannel('A')
+    assert app.get_shadow_mask(alpha, 4, 0.3) is app.get_shadow_mask(alpha.copy(), 4, 0.3)
+
+def test_drop_shadow_sits_at_the_offset():
+    image = logo()
+    result = app.add_drop_shadow(image, offset=(10, 6), blur_radius=4, opacity=0.3)
+    assert result.size == (600 + 10 + 8, 400 + 6 + 8)
+    alpha = np.asarray(result.getchannel('A'))
+    # The original at (blur, blur); its shadow shows past the ellipse's lower right edge
+    assert alpha[4 + 200, 4 + 300] == 255
+    assert 0 < alpha[4 + 6 + 320 - 2, 4 + 10 + 300] <= int(255 * 0.3)
+
+def test_transparent_image_casts_no_shadow():
+    result = app.add_drop_shadow(Image.new('RGBA', (100, 100), (0, 0, 0, 0)))
+    assert result.getchannel('A').getbbox() is None
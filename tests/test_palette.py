@@ -0,0 +1,65 @@
+"""Flat-colour logos get palette PNGs unless quantization would cost fidelity"""
+import io
+
+import numpy as np
+import pytest
+from PIL import Image, ImageDraw
+
+import app
+
+@pytest.fixture
+def storage(tmp_path, monkeypatch):
+    storage = app.LocalStorage(str(tmp_path / 'outputs'))
+    monkeypatch.setattr(app, 'storage', storage)
+    return storage
+
+def flat_logo():
+    img = Image.new('RGBA', (400, 400), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(img)
+    draw.ellipse((20, 20, 380, 380), fill=(220, 40, 60, 255))
+    draw.rectangle((140, 140, 260, 260), fill=(255, 255, 255, 255))
+    return img
+
+def gradient_photo():
+    rng = np.random.default_rng(0)
+    y, x = np.mgrid[0:400, 0:400]
+    arr = np.stack([x * 255 // 400, y * 255 // 400, (x * y) % 256], -1) + rng.normal(0, 8, (400, 400, 3))
+    return Image.fromarray(np.clip(arr, 0, 255).astype(np.uint8)).convert('RGBA')
+
+def test_logo_is_low_color_and_photo_is_not():
+    assert app.is_low_color(app.color_histogram(flat_logo()))
+    assert not app.is_low_color(app.color_histogram(gradient_photo()))
+
+def test_psnr_floor_rejects_lossy_palettes():
+    paletted = app.quantize_palette(flat_logo(), 40)
+    assert paletted is not None and paletted.mode == 'P'
+    # 256 colours cannot hold the photo above the floor
+    assert app.quantize_palette(gradient_photo(), 40) is None
+    assert app.quantize_palette(gradient_photo(), 10) is not None
+
+def test_flat_logo_renders_palette_png(storage, tmp_path):
+    source = tmp_path / 'logo.png'
+    flat_logo().save(source)
+    results = app.generate_formats(str(source), 'logo', ['square_logo_large'], ['png'], {}, fill_white_with_prominent=False, thumbnails=False)
+    assert results['square_logo_large']['outputs']['png']['palette'] is True
+    with Image.open(io.BytesIO(storage.get('logo_square_logo_large.png'))) as png:
+        assert png.mode == 'P'
+        rendered = png.convert('RGBA')
+    # Transparency survives quantization
+    assert rendered.getpixel((0, 0))[3] == 0
+
+def test_ico_frames_are_indexed_when_smaller(storage):
+    full_size, palette = app.save_ico(flat_logo(), 'logo.ico')
+    assert not palette
+    indexed_size, palette = app.save_ico(flat_logo(), 'logo.ico', palette_min_psnr=40)
+    assert palette and indexed_size < full_size
+    with Image.open(io.BytesIO(storage.get('logo.ico'))) as ico:
+        assert max(ico.info['sizes']) == (256, 256)
+
+def test_photo_renders_full_colour_png(storage, tmp_path):
+    source = tmp_path / 'photo.png'
+    gradient_photo().save(source)
+    results = app.generate_formats(str(source), 'photo', ['square_logo_large'], ['png'], {}, fill_white_with_prominent=False, thumbnails=False)
+    assert 'palette' not in results['square_logo_large']['outputs']['png']
+    with Image.open(io.BytesIO(storage.get('photo_square_logo_large.png'))) as png:
+        assert png.mode == 'RGBA'
@@ -0,0 +1,84 @@
+"""/preview applies preprocessing options to a small proxy of a stashed upload"""
+import io
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from PIL import Image
+from werkzeug.datastructures import MultiDict
+
+import app
+
+@pytest.fixture
+def upload_id(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, 'storage', app.LocalStorage(str(tmp_path)))
+    monkeypatch.setattr(app, '_speculative_entries', {})
+    buf = io.BytesIO()
+    Image.new('RGBA', (1600, 800), (200, 60, 40, 255)).save(buf, 'PNG')
+    return app.stash_image_data(buf.getvalue(), background_method=False)
+
+def preview(client, upload_id, **options):
+    return client.get('/preview', query_string={'upload_id': upload_id, **options})
+
+def test_preview_is_a_small_webp(client, upload_id):
+    response = preview(client, upload_id)
+    assert response.status_code == 200
+    assert response.mimetype == 'image/webp'
+    with Image.open(io.BytesIO(response.data)) as img:
+        assert img.size == (app.PREVIEW_EDGE, app.PREVIEW_EDGE // 2)
+
+def test_options_are_applied(client, upload_id):
+    response = preview(client, upload_id, grayscale='true')
+    with Image.open(io.BytesIO(response.data)) as img:
+        r, g, b = img.convert('RGB').getpixel((100, 100))
+    assert max(r, g, b) - min(r, g, b) <= 2
+
+def test_repeated_options_are_cached(client, upload_id, monkeypatch):
+    rendered = []
+    render_preview = app.render_preview
+    def counting_render_preview(entry, options):
+        rendered.append(options['brightness'])
+        return render_preview(entry, options)
+    monkeypatch.setattr(app, 'render_preview', counting_render_preview)
+    first = preview(client, upload_id, brightness='1.2')
+    second = preview(client, upload_id, brightness='1.2')
+    assert first.data == second.data
+    assert rendered == [1.2]
+    revalidated = client.get('/preview', query_string={'upload_id': upload_id, 'brightness': '1.2'}, headers={'If-None-Match': first.headers['ETag']})
+    assert revalidated.status_code == 304
+
+def test_evicted_upload_is_reloaded_from_storage(client, upload_id, monkeypatch):
+    monkeypatch.setattr(app, '_speculative_entries', {})
+    assert preview(client, upload_id).status_code == 200
+
+def test_unknown_and_invalid_ids(client, upload_id):
+    assert preview(client, 'not-a-token').status_code == 400
+    response = preview(client, '0' * 64)
+    assert response.status_code == 410
+    assert response.get_json()['token_expired']
+
+def test_newer_preview_cancels_a_queued_one(client, upload_id, monkeypatch):
+    executor = ThreadPoolExecutor(max_workers=1)
+    monkeypatch.setattr(app, '_preview_executor', executor)
+    busy = threading.Event()
+    executor.submit(busy.wait, 10)
+    statuses = {}
+    older = threading.Thread(target=lambda: statuses.setdefault('older', preview(client, upload_id, brightness='0.8').status_code))
+    older.start()
+    while upload_id not in app._preview_pending:
+        time.sleep(0.01)
+    newer = threading.Thread(target=lambda: statuses.setdefault('newer', preview(client, upload_id, brightness='0.9').status_code))
+    newer.start()
+    older.join(5)
+    busy.set()
+    newer.join(10)
+    executor.shutdown()
+    assert statuses == {'older': 204, 'newer': 200}
+
+def test_pixel_options_are_scaled_to_the_proxy():
+    options = app.parse_render_options(MultiDict({'blur_radius': '4', 'shadow_blur': '8'}), app.load_config())['preprocessing_options']
+    scaled = app.scale_pixel_options(options, 0.25)
+    assert scaled['blur_radius'] == 1.0
+    assert scaled['shadow_blur'] == 2
+    assert scaled['shadow_offset'] == tuple(int(round(v * 0.25)) for v in options['shadow_offset'])
@@ -0,0 +1,53 @@
+"""BRANDKIT_PRELOAD_REMBG loads the model where segmentation runs"""
+import os
+
+import app
+
+FAKE_REMBG = '''
+import os
+
+def new_session(model_name):
+    with open(os.environ['FAKE_REMBG_LOG'], 'a') as f:
+        f.write(f"{os.getpid()} {model_name}\\n")
+    return object()
+'''
+
+def test_preload_loads_the_model_in_the_worker_process(tmp_path, monkeypatch):
+    (tmp_path / 'rembg').mkdir()
+    (tmp_path / 'rembg' / '__init__.py').write_text(FAKE_REMBG)
+    log = tmp_path / 'sessions.log'
+    # The spawned worker inherits the environment and sys.path
+    monkeypatch.setenv('FAKE_REMBG_LOG', str(log))
+    monkeypatch.syspath_prepend(str(tmp_path))
+    monkeypatch.setattr(app, 'BG_REMOVAL_TIMEOUT_S', 60)
+    worker = app.BackgroundRemovalWorker()
+    monkeypatch.setattr(app, 'bg_removal_worker', worker)
+    try:
+        app.preload_rembg('u2net')
+        pid, model_name = log.read_text().split()
+        assert model_name == 'u2net'
+        assert int(pid) == worker._process.pid != os.getpid()
+        # The warm session serves the next request without loading again
+        assert worker.predict_masks('u2net', [], 60) == []
+        assert len(log.read_text().splitlines()) == 1
+    finally:
+        worker._kill()
+
+def test_preload_in_process_without_a_worker(monkeypatch):
+    monkeypatch.setattr(app, 'BG_REMOVAL_TIMEOUT_S', 0)
+    loaded = []
+    monkeypatch.setattr(app, 'get_rembg_session', loaded.append)
+    app.preload_rembg('u2net')
+    assert loaded == ['u2net']
+
+def test_session_load_does_not_hold_the_import_lock(monkeypatch):
+    class FakeRembg:
+        @staticmethod
+        def new_session(model_name):
+            # cv2 and the other lazy imports stay available meanwhile
+            assert app._lazy_import_lock.acquire(timeout=1)
+            app._lazy_import_lock.release()
+            return object()
+    monkeypatch.setattr(app, '_load_rembg', lambda: FakeRembg)
+    monkeypatch.setattr(app, '_rembg_sessions', {})
+    assert app.get_rembg_session('u2net') is app._rembg_sessions['u2net']
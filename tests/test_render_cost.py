@@ -0,0 +1,46 @@
+"""Admission cost of animated GIF/WebP outputs scales with the frames rendered"""
+import io
+
+import pytest
+from PIL import Image
+
+import app
+
+def animated_gif(frames):
+    buf = io.BytesIO()
+    images = [Image.new('RGB', (200, 200), (i * 20 % 256, 80, 160)) for i in range(frames)]
+    images[0].save(buf, 'GIF', save_all=True, append_images=images[1:], duration=50, loop=0)
+    buf.seek(0)
+    return buf
+
+def render_options(output_formats, **preprocessing_options):
+    return {
+        'selected_formats': ['website'],
+        'output_formats': output_formats,
+        'variations_mode': False,
+        'fill_white_with_prominent': False,
+        'preprocessing_options': preprocessing_options,
+    }
+
+def cost(source, options):
+    frames = app.animation_frame_count(source, options)
+    return app.estimate_options_cost((200, 200), app.load_config(), options, frames=frames)['work']
+
+def test_animated_outputs_are_priced_per_frame():
+    still = cost(animated_gif(1), render_options(['gif']))
+    short = cost(animated_gif(5), render_options(['gif']))
+    long = cost(animated_gif(20), render_options(['gif']))
+    assert still < short < long
+    assert long - short == pytest.approx(3 * (short - still), rel=0.2)
+
+def test_background_removal_is_priced_per_frame():
+    options = render_options(['webp'], remove_background=True)
+    assert cost(animated_gif(10), options) >= 10 * app.BG_REMOVAL_WORK
+
+def test_still_outputs_and_long_animations_are_priced_as_stills(monkeypatch):
+    source = animated_gif(20)
+    assert app.animation_frame_count(source, render_options(['png'])) == 1
+    assert app.animation_frame_count(source, dict(render_options(['gif']), variations_mode=True)) == 1
+    monkeypatch.setattr(app, 'ANIMATION_MAX_FRAMES', 10)
+    assert app.animation_frame_count(source, render_options(['gif'])) == 1
+    assert source.tell() == 0
@@ -0,0 +1,100 @@
+"""Renders stop at the request deadline and return the formats finished so far"""
+import io
+
+import pytest
+from PIL import Image
+
+import app
+
+FAKE_REMBG = '''
+import os
+import time
+
+def new_session(model_name):
+    # Hangs like a stuck inference while the marker file exists
+    while os.path.exists(os.environ['FAKE_REMBG_HANG']):
+        time.sleep(0.05)
+    return object()
+'''
+
+def png_bytes(width, height):
+    buf = io.BytesIO()
+    Image.new('RGBA', (width, height), (30, 90, 200, 255)).save(buf, 'PNG')
+    return buf.getvalue()
+
+def test_expired_deadline_returns_partial_results(client, tmp_path, monkeypatch):
+    monkeypatch.setattr(app, 'storage', app.LocalStorage(str(tmp_path)))
+    monkeypatch.setattr(app, 'COALESCE_DIR', str(tmp_path / 'coalesce'))
+    monkeypatch.setattr(app.admission_controller, 'memory_mb', 4096)
+    deadlines = []
+    class RecordedDeadline(app.RenderDeadline):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            deadlines.append(self)
+    monkeypatch.setattr(app, 'RenderDeadline', RecordedDeadline)
+    render_format_image = app.render_format_image
+    def render_then_expire(*args, **kwargs):
+        # The time budget runs out while the first format renders
+        deadlines[-1].expires_at = 0
+        return render_format_image(*args, **kwargs)
+    monkeypatch.setattr(app, 'render_format_image', render_then_expire)
+    
+    response = client.post('/upload', data={
+        'file': (io.BytesIO(png_bytes(64, 64)), 'logo.png'),
+        'selected_formats': ['square_logo_small', 'square_logo_large', 'square_1024'],
+        'output_formats': ['png'],
+        'deadline': '30',
+    }, content_type='multipart/form-data')
+    body = response.get_json()
+    assert response.status_code == 200
+    assert body['partial'] is True
+    assert body['partial_reason'] == 'deadline'
+    rendered = [name for name in ('square_logo_small', 'square_logo_large', 'square_1024') if name in body['results']]
+    assert len(rendered) == 1
+    assert 'zip' in body['results']
+
+def test_requested_deadline_is_capped(monkeypatch):
+    monkeypatch.setattr(app, 'RENDER_DEADLINE_S', 120)
+    assert app.get_render_deadline_seconds('30') == 30
+    assert app.get_render_deadline_seconds('600') == 120
+    assert app.get_render_deadline_seconds('soon') == 120
+
+def test_client_disconnect_cancels(monkeypatch):
+    monkeypatch.setattr(app, 'client_disconnected', lambda environ: True)
+    deadline = app.RenderDeadline(60, environ={})
+    assert deadline.expired()
+    assert deadline.reason == 'client_disconnected'
+
+def test_background_timeout_ends_the_render(monkeypatch):
+    def predict(model_name, proxy, deadline=None):
+        raise TimeoutError("background removal did not finish within 1s")
+    monkeypatch.setattr(app, 'REMBG_AVAILABLE', True)
+    monkeypatch.setattr(app, 'predict_background_mask', predict)
+    monkeypatch.setattr(app, '_background_mask_cache', {})
+    image = Image.new('RGBA', (64, 64), (30, 90, 200, 255))
+    deadline = app.RenderDeadline(60)
+    with pytest.raises(app.RenderDeadlineExceeded):
+        app.remove_background(image, deadline=deadline)
+    assert deadline.reason == 'background_timeout'
+    # Without a request deadline the timeout reaches the caller as is
+    with pytest.raises(TimeoutError):
+        app.remove_background(image)
+
+def test_stuck_worker_is_killed_and_restarted(tmp_path, monkeypatch):
+    (tmp_path / 'rembg').mkdir()
+    (tmp_path / 'rembg' / '__init__.py').write_text(FAKE_REMBG)
+    hang = tmp_path / 'hang'
+    hang.touch()
+    monkeypatch.setenv('FAKE_REMBG_HANG', str(hang))
+    monkeypatch.syspath_prepend(str(tmp_path))
+    worker = app.BackgroundRemovalWorker()
+    try:
+        with pytest.raises(TimeoutError):
+            worker.predict_masks('u2net', [], timeout=1)
+        assert worker._process is None
+        # The next request gets a fresh process
+        hang.unlink()
+        assert worker.predict_masks('u2net', [], timeout=60) == []
+        assert worker._process.is_alive()
+    finally:
+        worker._kill()
@@ -0,0 +1,72 @@
+"""Stored outputs are handed to the front-end server when file offload is enabled"""
+import pytest
+
+import app
+
+DATA = b'\x89PNG stored output bytes'
+
+@pytest.fixture
+def local_storage(tmp_path, monkeypatch):
+    storage = app.LocalStorage(str(tmp_path))
+    monkeypatch.setattr(app, 'storage', storage)
+    storage.put('logo_website.png', DATA)
+    storage.put('logo_brandkit.zip', b'zip bytes')
+    return storage
+
+@pytest.fixture
+def offload(monkeypatch):
+    def enable(mode):
+        monkeypatch.setattr(app, 'SENDFILE_MODE', mode)
+        monkeypatch.setitem(app.app.config, 'USE_X_SENDFILE', mode == 'x-sendfile')
+    return enable
+
+def test_x_accel_redirect(client, local_storage, offload):
+    offload('x-accel-redirect')
+    response = client.get('/outputs/logo_website.png')
+    assert response.status_code == 200
+    assert response.headers['X-Accel-Redirect'] == '/protected-outputs/logo_website.png'
+    assert response.headers['Content-Type'] == 'image/png'
+    assert response.data == b''
+    etag = response.headers['ETag']
+    assert etag.strip('"') == local_storage.digest('logo_website.png')
+    # Revalidation is answered here, without a redirect to nginx
+    response = client.get('/outputs/logo_website.png', headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert 'X-Accel-Redirect' not in response.headers
+
+def test_x_accel_redirect_prefix_and_attachment(client, local_storage, offload, monkeypatch):
+    offload('x-accel-redirect')
+    monkeypatch.setattr(app, 'SENDFILE_PREFIX', '/internal/')
+    response = client.get('/download-zip/logo_brandkit.zip')
+    assert response.headers['X-Accel-Redirect'] == '/internal/logo_brandkit.zip'
+    assert response.headers['Content-Disposition'] == 'attachment; filename=logo_brandkit.zip'
+
+def test_x_sendfile(client, local_storage, offload):
+    offload('x-sendfile')
+    response = client.get('/outputs/logo_website.png')
+    assert response.status_code == 200
+    assert response.headers['X-Sendfile'] == local_storage.local_path('logo_website.png')
+    assert 'X-Accel-Redirect' not in response.headers
+    assert response.data == b''
+
+def test_served_from_python_without_offload(client, local_storage, offload):
+    offload('')
+    response = client.get('/outputs/logo_website.png')
+    assert response.status_code == 200
+    assert response.data == DATA
+    assert 'X-Accel-Redirect' not in response.headers
+    assert 'X-Sendfile' not in response.headers
+    # Ranges are served from Python too
+    response = client.get('/outputs/logo_website.png', headers={'Range': 'bytes=0-3'})
+    assert response.status_code == 206
+    assert response.data == DATA[:4]
+
+def test_storage_without_local_files_is_not_offloaded(client, offload, monkeypatch):
+    offload('x-accel-redirect')
+    storage = app.MemoryStorage(1024 * 1024)
+    storage.put('logo_website.png', DATA)
+    monkeypatch.setattr(app, 'storage', storage)
+    response = client.get('/outputs/logo_website.png')
+    assert response.status_code == 200
+    assert response.data == DATA
+    assert 'X-Accel-Redirect' not in response.headers
@@ -0,0 +1,88 @@
+"""Speculative entries are bounded by bytes and charged against admission memory"""
+import io
+import threading
+
+import pytest
+from PIL import Image
+
+import app
+
+MB = 1024 * 1024
+
+@pytest.fixture(autouse=True)
+def empty_cache(monkeypatch):
+    monkeypatch.setattr(app, '_speculative_entries', {})
+    monkeypatch.setattr(app, 'admission_controller', app.AdmissionController(capacity=100, memory_mb=64, max_queue=4, queue_timeout=1))
+    app.admission_controller.reclaim = app.reclaim_speculative_memory
+
+def png_bytes(width, height):
+    buf = io.BytesIO()
+    Image.new('RGBA', (width, height), (20, 120, 220, 255)).save(buf, 'PNG')
+    return buf.getvalue()
+
+def add_entry(token, megabytes):
+    entry = {'ready': threading.Event(), 'background_ready': threading.Event(), 'stages': {}, 'encodes': {}, 'previews': {}}
+    entry['stages']['{}'] = Image.new('RGBA', (512, 512 * megabytes))
+    app._speculative_entries[token] = entry
+    app.trim_speculative_entries()
+    return entry
+
+def test_entries_are_evicted_by_bytes(monkeypatch):
+    monkeypatch.setattr(app, 'SPECULATIVE_CACHE_MB', 8)
+    add_entry('a', 3)
+    add_entry('b', 3)
+    assert app.admission_controller.cache_memory_mb == 6
+    add_entry('c', 3)
+    assert list(app._speculative_entries) == ['b', 'c']
+    assert app.admission_controller.cache_memory_mb == 6
+
+def test_cached_bytes_count_against_admission():
+    add_entry('a', 20)
+    add_entry('b', 20)
+    assert app.admission_controller.status()['cache_memory_mb'] == 40
+    # 30 MB fit beside 40 MB of cache only once the oldest entry is evicted
+    ticket = app.admission_controller.acquire({'work': 1, 'memory_mb': 30}, timeout=0)
+    assert list(app._speculative_entries) == ['b']
+    assert app.admission_controller.cache_memory_mb == 20
+    app.admission_controller.release(ticket)
+
+def test_work_bound_renders_keep_the_cache():
+    add_entry('a', 20)
+    ticket = app.admission_controller.acquire({'work': 100, 'memory_mb': 1}, timeout=0)
+    with pytest.raises(app.AdmissionRejected):
+        app.admission_controller.acquire({'work': 1, 'memory_mb': 1}, timeout=0)
+    assert list(app._speculative_entries) == ['a']
+    app.admission_controller.release(ticket)
+
+def test_warm_up_results_share_the_budget(monkeypatch):
+    monkeypatch.setattr(app, 'SPECULATIVE_CACHE_MB', 8)
+    monkeypatch.setattr(app, 'REMBG_AVAILABLE', False)
+    add_entry('a', 3)
+    entry = {'ready': threading.Event(), 'background_ready': threading.Event(), 'stages': {}, 'encodes': {}, 'previews': {}}
+    app._speculative_entries['b'] = entry
+    app.warm_speculative_entry(entry, png_bytes(1024, 1536))
+    # The decoded 6 MB image pushes the older entry out
+    assert list(app._speculative_entries) == ['b']
+    assert app.admission_controller.cache_memory_mb == 7
+
+@pytest.mark.parametrize('remove_background, expected', [('false', False), ('true', 'person')])
+def test_uploads_warm_background_removal_only_when_requested(client, tmp_path, monkeypatch, remove_background, expected):
+    monkeypatch.setattr(app, 'storage', app.LocalStorage(str(tmp_path)))
+    monkeypatch.setattr(app, 'COALESCE_DIR', str(tmp_path / 'coalesce'))
+    monkeypatch.setattr(app.admission_controller, 'memory_mb', 4096)
+    warmed = []
+    
+    def warm(entry, data, background_method=None):
+        warmed.append(background_method)
+        entry['ready'].set()
+        entry['background_ready'].set()
+    monkeypatch.setattr(app, 'warm_speculative_entry', warm)
+    response = client.post('/upload', data={
+        'file': (io.BytesIO(png_bytes(64, 64)), 'logo.png'),
+        'selected_formats': ['social'],
+        'output_formats': ['png'],
+        'remove_background': remove_background,
+        'background_removal_method': 'person',
+    }, content_type='multipart/form-data')
+    assert response.status_code == 200
+    assert warmed == [expected]
@@ -0,0 +1,97 @@
+"""S3 output storage against moto's in-memory stand-in for S3"""
+import io
+
+import pytest
+from PIL import Image
+
+import app
+
+pytest.importorskip('boto3')
+moto = pytest.importorskip('moto')
+
+BUCKET = 'brandkit-test'
+PREFIX = 'outputs/'
+
+@pytest.fixture
+def s3_storage(monkeypatch):
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    monkeypatch.delenv('AWS_PROFILE', raising=False)
+    with moto.mock_aws():
+        storage = app.S3Storage(BUCKET, prefix=PREFIX, region='us-east-1')
+        storage.client.create_bucket(Bucket=BUCKET)
+        # Route the app's storage through the bucket
+        monkeypatch.setattr(app, 'storage', storage)
+        yield storage
+
+def png_bytes(size=(64, 48), color=(200, 30, 60, 255)):
+    buf = io.BytesIO()
+    Image.new('RGBA', size, color).save(buf, 'PNG')
+    return buf.getvalue()
+
+def test_put_get_stat_digest(s3_storage):
+    s3_storage.put('logo_website.png', b'png bytes')
+    assert s3_storage.get('logo_website.png') == b'png bytes'
+    size, mtime = s3_storage.stat('logo_website.png')
+    assert size == 9 and mtime > 0
+    # Keys live under the prefix, with a content type from the extension
+    head = s3_storage.client.head_object(Bucket=BUCKET, Key=PREFIX + 'logo_website.png')
+    assert head['ContentType'] == 'image/png'
+    digest = s3_storage.digest('logo_website.png')
+    s3_storage.put('logo_website.png', b'other bytes')
+    assert s3_storage.digest('logo_website.png') != digest
+    assert s3_storage.local_path('logo_website.png') is None
+
+def test_missing_keys(s3_storage):
+    assert s3_storage.get('missing.png') is None
+    assert s3_storage.stat('missing.png') is None
+    assert s3_storage.digest('missing.png') is None
+
+def test_link_delete_list(s3_storage):
+    s3_storage.put('cache/a.png', b'a')
+    s3_storage.link('cache/a.png', 'logo_a.png')
+    assert s3_storage.get('logo_a.png') == b'a'
+    assert sorted(key for key, _, _ in s3_storage.list()) == ['cache/a.png', 'logo_a.png']
+    assert [key for key, _, _ in s3_storage.list('cache/')] == ['cache/a.png']
+    s3_storage.delete('cache/a.png')
+    assert s3_storage.get('cache/a.png') is None
+
+def test_create_storage_selects_s3(s3_storage, monkeypatch):
+    monkeypatch.setattr(app, 'STORAGE_BACKEND', 's3')
+    monkeypatch.setenv('BRANDKIT_S3_BUCKET', BUCKET)
+    monkeypatch.setenv('BRANDKIT_S3_PREFIX', PREFIX)
+    monkeypatch.setenv('BRANDKIT_S3_REGION', 'us-east-1')
+    storage = app.create_storage()
+    assert isinstance(storage, app.S3Storage)
+    assert storage.bucket == BUCKET and storage.prefix == PREFIX
+
+def test_outputs_served_from_bucket(s3_storage, client):
+    data = png_bytes()
+    s3_storage.put('logo_website.png', data)
+    entry = app.output_entry('logo_website.png')
+    response = client.get(entry['url'])
+    assert response.status_code == 200
+    assert response.data == data
+    assert response.mimetype == 'image/png'
+    assert 'immutable' in response.headers['Cache-Control']
+    # The object ETag is the validator
+    revalidated = client.get('/outputs/logo_website.png', headers={'If-None-Match': response.headers['ETag']})
+    assert revalidated.status_code == 304
+    assert client.get('/outputs/missing.png').status_code == 404
+
+def test_upload_renders_into_bucket(s3_storage, client):
+    response = client.post('/upload', data={
+        'file': (io.BytesIO(png_bytes((400, 300))), 'logo.png'),
+        'selected_formats': ['website', 'favicon'],
+        'output_formats': ['png', 'ico'],
+    }, content_type='multipart/form-data')
+    assert response.status_code == 200, response.get_json()
+    results = response.get_json()['results']
+    stored = {key for key, _, _ in s3_storage.list()}
+    for key in (results['website']['outputs']['png']['key'], results['favicon_ico']['key'], results['zip']['key']):
+        assert key in stored
+    # No local file paths with remote storage
+    assert 'path' not in results['website']['outputs']['png']
+    # Every result is served from the bucket
+    assert client.get(results['website']['outputs']['png']['url']).data == s3_storage.get(results['website']['outputs']['png']['key'])
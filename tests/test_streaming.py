@@ -0,0 +1,71 @@
+"""/upload streams NDJSON events as each format finishes"""
+import io
+import json
+import threading
+
+import pytest
+from PIL import Image
+
+import app
+
+FORMATS = ['square_logo_small', 'square_logo_large', 'favicon']
+
+@pytest.fixture(autouse=True)
+def isolated(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, 'storage', app.LocalStorage(str(tmp_path)))
+    monkeypatch.setattr(app, 'COALESCE_DIR', str(tmp_path / 'coalesce'))
+    monkeypatch.setattr(app.admission_controller, 'memory_mb', 4096)
+
+def upload(client, stream=True, **form):
+    buf = io.BytesIO()
+    Image.new('RGBA', (64, 64), (30, 90, 200, 255)).save(buf, 'PNG')
+    headers = {'Accept': 'application/x-ndjson'} if stream else {}
+    data = {'file': (io.BytesIO(buf.getvalue()), form.pop('filename', 'logo.png')), 'selected_formats': FORMATS, 'output_formats': ['png', 'ico']}
+    return client.post('/upload', data={**data, **form}, headers=headers, content_type='multipart/form-data')
+
+def read_events(response):
+    return [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+
+def test_event_order(client):
+    response = upload(client)
+    assert response.mimetype == 'application/x-ndjson'
+    events = read_events(response)
+    assert events[0]['type'] == 'start'
+    assert events[0]['original']['url'] and 'admission' in events[0]
+    assert events[-1]['type'] == 'done' and events[-1]['success']
+    results = [event for event in events if event['type'] == 'result']
+    assert results[-1]['key'] == 'zip'
+    assert sorted(event['key'] for event in results[:-1]) == ['favicon_ico', 'square_logo_large', 'square_logo_small']
+
+def test_streamed_results_match_the_json_response(client):
+    streamed = {event['key']: event['result'] for event in read_events(upload(client)) if event['type'] == 'result'}
+    # A different output name, so the second request is not coalesced with the first
+    body = upload(client, stream=False, filename='brand.png').get_json()
+    assert body['success']
+    assert set(streamed) == set(body['results']) - {'original', 'analysis'}
+    assert streamed['square_logo_small']['dimensions'] == body['results']['square_logo_small']['dimensions']
+
+def test_variation_events_are_labelled(client):
+    events = read_events(upload(client, variations_mode='true'))
+    labelled = [event for event in events if event['type'] == 'result' and event['key'] == 'square_logo_small']
+    assert labelled and all(event['variation'] for event in labelled)
+
+def test_first_result_is_sent_before_the_render_ends(client, monkeypatch):
+    release = threading.Event()
+    render_format_image = app.render_format_image
+    def render_one_at_a_time(image, dimensions, *args, **kwargs):
+        # square_logo_large (100x100) waits until square_logo_small (60x60) has been read
+        if dimensions != (60, 60) and not release.wait(10):
+            raise AssertionError("the first result was not streamed")
+        return render_format_image(image, dimensions, *args, **kwargs)
+    monkeypatch.setattr(app, 'render_format_image', render_one_at_a_time)
+    
+    response = upload(client)
+    lines = response.iter_encoded()
+    assert json.loads(next(lines))['type'] == 'start'
+    first = json.loads(next(lines))
+    while first['key'] == 'favicon_ico':
+        first = json.loads(next(lines))
+    assert first['key'] == 'square_logo_small'
+    release.set()
+    assert json.loads(list(lines)[-1])['type'] == 'done'
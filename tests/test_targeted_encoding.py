@@ -0,0 +1,33 @@
+"""Per-format byte budgets and SSIM floors for JPEG and WebP outputs"""
+import numpy as np
+from PIL import Image
+
+import app
+
+def noisy_image(width=320, height=240):
+    rng = np.random.default_rng(7)
+    pixels = rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+    return Image.fromarray(pixels, 'RGB')
+
+def test_shipped_formats_have_no_targets():
+    for formats in (app.load_config()['formats'], app.DEFAULT_CONFIG['formats']):
+        for name, format_config in formats.items():
+            assert app.get_encoding_target(format_config) is None, name
+
+def test_byte_budget_is_met():
+    data, info = app.encode_to_target(noisy_image(), 'jpg', {'quality': 95}, max_bytes=40000)
+    assert info['target_met']
+    assert len(data) == info['bytes'] <= 40000
+    assert info['quality'] < 95
+
+def test_unreachable_budget_is_reported():
+    data, info = app.encode_to_target(noisy_image(), 'webp', {'quality': 95, 'method': 6}, max_bytes=500)
+    assert not info['target_met']
+    assert info['quality'] == app.TARGET_MIN_QUALITY
+
+def test_ssim_floor_picks_lowest_quality_reaching_it():
+    img = noisy_image()
+    data, info = app.encode_to_target(img, 'jpg', {'quality': 95}, min_ssim=0.9)
+    assert info['target_met']
+    assert app.decoded_ssim(img, data) >= 0.9
+    assert len(data) < len(app.encode_image_bytes(img, {'format': 'JPEG', 'quality': 95}))
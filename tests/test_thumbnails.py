@@ -0,0 +1,44 @@
+"""Each rendered format gets a small WebP thumbnail for the results gallery"""
+import io
+import zipfile
+
+import pytest
+from PIL import Image
+
+import app
+
+@pytest.fixture
+def storage(tmp_path, monkeypatch):
+    storage = app.LocalStorage(str(tmp_path / 'outputs'))
+    monkeypatch.setattr(app, 'storage', storage)
+    return storage
+
+@pytest.fixture
+def source(tmp_path):
+    path = tmp_path / 'logo.png'
+    Image.new('RGBA', (400, 300), (30, 90, 200, 255)).save(path)
+    return str(path)
+
+def test_formats_get_webp_thumbnails(storage, source):
+    results = app.generate_formats(source, 'logo', ['website', 'square_1024'], ['png'], {}, fill_white_with_prominent=False)
+    for name, size in (('website', (128, 67)), ('square_1024', (128, 128))):
+        thumbnail = results[name]['thumbnail']
+        assert thumbnail['key'] == f'logo_{name}.thumb.webp'
+        assert thumbnail['bytes'] < results[name]['outputs']['png']['bytes']
+        with Image.open(io.BytesIO(storage.get(thumbnail['key']))) as img:
+            assert img.format == 'WEBP' and img.size == size
+
+def test_aliases_share_a_thumbnail(storage, source):
+    results = app.generate_formats(source, 'logo', ['website', 'facebook'], ['png'], {}, fill_white_with_prominent=False)
+    assert results['facebook']['thumbnail'] == results['website']['thumbnail']
+
+def test_thumbnails_can_be_skipped(storage, source):
+    results = app.generate_formats(source, 'logo', ['website'], ['png'], {}, fill_white_with_prominent=False, thumbnails=False)
+    assert 'thumbnail' not in results['website']
+    assert not any(key.endswith('.thumb.webp') for key, _, _ in storage.list())
+
+def test_thumbnails_stay_out_of_the_zip(storage, source):
+    results = app.generate_formats(source, 'logo', ['website'], ['png'], {}, fill_white_with_prominent=False)
+    zip_info = app.create_zip_file(results, 'logo')
+    with zipfile.ZipFile(io.BytesIO(storage.get(zip_info['key']))) as archive:
+        assert archive.namelist() == ['logo_website.png']